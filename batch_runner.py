@@ -0,0 +1,325 @@
+"""
+Пакетный запуск ChatList: набор промтов × набор моделей с очередью заданий в БД.
+
+Промты выбираются по тегу, списку ID или поиску (db.search_prompts), модели -
+как в cli.py. Запуск разворачивается в задания таблицы batch_jobs, задания
+выполняются с ограничением параллельности, а результаты сохраняются пачками:
+результат и отметка о выполнении задания пишутся одной транзакцией. Если
+запуск прерван (Ctrl+C, сбой, выключение), resume продолжает его с первого
+невыполненного задания. Модуль, как и cli.py, не импортирует Qt.
+
+Запуск:
+    python batch_runner.py create --prompt-tag ревью --model "openai/*" --name "Ревью кода"
+    python batch_runner.py create --prompt-id 1 2 3 --tag deepseek --no-run
+    python batch_runner.py resume 5 --retry-failed
+    python batch_runner.py status
+"""
+import argparse
+import logging
+import sys
+import time
+from typing import Callable, Dict, List, Optional
+
+import cli
+import db
+import models
+import network
+
+
+# Размер пачки и максимальный интервал (с) между сохранениями результатов в БД
+FLUSH_SIZE = 100
+FLUSH_INTERVAL = 5.0
+# Интервал вывода прогресса, с
+REPORT_INTERVAL = 2.0
+
+
+class BatchProgress:
+    """Счетчики выполнения запуска: скорость и оценка оставшегося времени."""
+
+    def __init__(self, run_id: int, total: int, remaining: int):
+        self.run_id = run_id
+        self.total = total
+        self.remaining = remaining
+        self.done = 0
+        self.failed = 0
+        self.started = time.monotonic()
+
+    @property
+    def finished(self) -> int:
+        """Задания, завершенные в этом сеансе."""
+        return self.done + self.failed
+
+    @property
+    def elapsed(self) -> float:
+        return time.monotonic() - self.started
+
+    @property
+    def jobs_per_sec(self) -> float:
+        elapsed = self.elapsed
+        return self.finished / elapsed if elapsed > 0 else 0.0
+
+    @property
+    def eta(self) -> Optional[float]:
+        """Оценка оставшегося времени в секундах (None - пока нечего оценивать)."""
+        rate = self.jobs_per_sec
+        if not rate:
+            return None
+        return (self.remaining - self.finished) / rate
+
+    def format(self) -> str:
+        completed = self.total - self.remaining + self.finished
+        eta = self.eta
+        eta_text = time.strftime("%H:%M:%S", time.gmtime(eta)) if eta is not None else "—"
+        return (f"[запуск {self.run_id}] {completed}/{self.total} "
+                f"({completed / self.total:.1%}), {self.jobs_per_sec:.1f} заданий/с, "
+                f"осталось ~{eta_text}, ошибок {self.failed}")
+
+
+def _print_progress(progress: BatchProgress) -> None:
+    print(progress.format(), file=sys.stderr, flush=True)
+
+
+class BatchRunner:
+    """
+    Выполняет невыполненные задания пакетного запуска.
+
+    Все задания передаются в network.iter_prompt_jobs одной рассылкой, поэтому
+    общий потолок concurrency, лимиты хостов и ограничители запросов действуют
+    на весь запуск. Готовые ответы копятся в буфере и сохраняются через
+    db.complete_batch_jobs пачками по flush_size или раз в flush_interval секунд.
+    Отмененные запросы остаются в очереди. После сбоя повторно отправляются
+    только задания, результаты которых не успели попасть в БД (не больше одной пачки).
+    """
+
+    def __init__(self, run_id: int, timeout: int = 30, concurrency: int = 16, use_cache: bool = True,
+                 flush_size: int = FLUSH_SIZE, flush_interval: float = FLUSH_INTERVAL,
+                 report: Optional[Callable[[BatchProgress], None]] = _print_progress,
+                 report_interval: float = REPORT_INTERVAL):
+        self.run_id = run_id
+        self.timeout = timeout
+        self.concurrency = concurrency
+        self.use_cache = use_cache
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.report = report
+        self.report_interval = report_interval
+        self.buffer: List[Dict] = []
+        self.progress: Optional[BatchProgress] = None
+
+    def _load_models(self, model_ids: set) -> Dict[int, Dict]:
+        """Данные моделей заданий с API-ключами; удаленные модели отсутствуют в словаре."""
+        loaded = {}
+        for model_id in model_ids:
+            model = models.ModelManager.get_model(model_id)
+            if model:
+                model_dict = dict(model)
+                model_dict['api_key'] = models.ModelManager.get_api_key_for_model(model)
+                loaded[model_id] = model_dict
+        return loaded
+
+    def _add(self, job: Dict, result: Dict) -> None:
+        """Добавляет завершенное задание в буфер сохранения."""
+        if result['success']:
+            self.buffer.append({'job_id': job['id'], 'result': {
+                'prompt_id': job['prompt_id'],
+                'model_id': job['model_id'],
+                'response': result['response'],
+                'tokens_used': result.get('tokens_used'),
+                # Время поиска в кэше не должно попадать в статистику времени ответа
+                'response_time': None if result.get('cached') else result.get('response_time'),
+                'request_id': result.get('request_id')
+            }})
+            self.progress.done += 1
+        else:
+            self.buffer.append({'job_id': job['id'], 'error': result.get('error')})
+            self.progress.failed += 1
+
+    def flush(self) -> None:
+        """Сохраняет накопленные результаты одной транзакцией."""
+        if not self.buffer:
+            return
+        # Метрики запросов должны быть в базе, чтобы связаться с сохраняемыми результатами
+        network.flush_metrics()
+        expected_failed = sum(1 for item in self.buffer if item.get('result') is None)
+        _, failed = db.complete_batch_jobs(self.run_id, self.buffer)
+        self.buffer = []
+        # Ответ, который не удалось сохранить, считается ошибкой
+        self.progress.done -= failed - expected_failed
+        self.progress.failed += failed - expected_failed
+
+    def run(self, retry_failed: bool = False, cancel_token: Optional[network.CancelToken] = None) -> BatchProgress:
+        """
+        Выполняет задания запуска до конца, до отмены cancel_token или до KeyboardInterrupt.
+
+        Уже полученные результаты сохраняются и при прерывании.
+
+        Returns:
+            Счетчики выполнения этого сеанса
+        """
+        run = db.get_batch_run(self.run_id)
+        if run is None:
+            raise ValueError(f"Пакетный запуск с ID {self.run_id} не найден")
+        jobs = db.get_pending_batch_jobs(self.run_id, retry_failed=retry_failed)
+        self.progress = BatchProgress(self.run_id, run['total'], len(jobs))
+
+        loaded = self._load_models({job['model_id'] for job in jobs})
+        runnable = []
+        for job in jobs:
+            if job['prompt'] is None:
+                error = f"Промт с ID {job['prompt_id']} не найден"
+            elif job['model_id'] not in loaded:
+                error = f"Модель с ID {job['model_id']} не найдена"
+            else:
+                runnable.append(job)
+                continue
+            self.buffer.append({'job_id': job['id'], 'error': error})
+            self.progress.failed += 1
+        jobs = runnable
+
+        results = network.iter_prompt_jobs(
+            [(loaded[job['model_id']], job['prompt']) for job in jobs],
+            timeout=self.timeout, max_workers=self.concurrency,
+            use_cache=self.use_cache, cancel_token=cancel_token
+        )
+        last_flush = last_report = time.monotonic()
+        try:
+            for index, result in results:
+                if not result.get('cancelled'):
+                    self._add(jobs[index], result)
+                now = time.monotonic()
+                if len(self.buffer) >= self.flush_size or now - last_flush >= self.flush_interval:
+                    self.flush()
+                    last_flush = now
+                if self.report and now - last_report >= self.report_interval:
+                    self.report(self.progress)
+                    last_report = now
+        finally:
+            # При прерывании незавершенные запросы отменяются сразу, а не при сборке мусора
+            results.close()
+            self.flush()
+            if self.report:
+                self.report(self.progress)
+        return self.progress
+
+
+def select_prompts(tags: List[str], prompt_ids: List[int], queries: List[str], all_prompts: bool) -> List[int]:
+    """ID промтов по тегам, явному списку и поисковым запросам (без повторов, в порядке выбора)."""
+    selected = []
+    if all_prompts:
+        selected.extend(prompt['id'] for prompt in db.get_all_prompts())
+    for tag in tags:
+        selected.extend(prompt['id'] for prompt in db.search_prompts(tags=tag))
+    for query in queries:
+        selected.extend(prompt['id'] for prompt in db.search_prompts(query=query))
+    for prompt_id in prompt_ids:
+        if db.get_prompt(prompt_id) is None:
+            raise ValueError(f"Промт с ID {prompt_id} не найден")
+        selected.append(prompt_id)
+    return list(dict.fromkeys(selected))
+
+
+def _execute(run_id: int, args: argparse.Namespace) -> int:
+    """Выполняет запуск и возвращает код завершения как у cli.py."""
+    runner = BatchRunner(run_id, timeout=args.timeout, concurrency=args.concurrency,
+                         use_cache=not args.no_cache, flush_size=args.flush_size)
+    try:
+        progress = runner.run(retry_failed=getattr(args, 'retry_failed', False))
+    except KeyboardInterrupt:
+        print(f"Запуск {run_id} прерван, продолжить: python batch_runner.py resume {run_id}", file=sys.stderr)
+        return cli.EXIT_INTERRUPTED
+    print(f"Запуск {run_id}: выполнено {progress.done}, с ошибкой {progress.failed} "
+          f"за {progress.elapsed:.1f} с ({progress.jobs_per_sec:.1f} заданий/с)", file=sys.stderr)
+    return cli.EXIT_FAILURES if progress.failed else cli.EXIT_OK
+
+
+def command_create(args: argparse.Namespace) -> int:
+    try:
+        prompt_ids = select_prompts(args.prompt_tag, args.prompt_id, args.search, args.all_prompts)
+        selected = cli.select_models(args.model, args.tag, args.include_inactive)
+    except ValueError as e:
+        logging.error("%s", e)
+        return cli.EXIT_USAGE
+    if not prompt_ids or not selected:
+        logging.error("Не выбрано ни одного промта" if not prompt_ids else "Не выбрано ни одной модели")
+        return cli.EXIT_USAGE
+
+    run_id = db.create_batch_run(prompt_ids, [model['id'] for model in selected], args.name)
+    print(f"Создан запуск {run_id}: {len(prompt_ids)} промтов × {len(selected)} моделей "
+          f"= {len(prompt_ids) * len(selected)} заданий", file=sys.stderr)
+    if args.no_run:
+        print(run_id)
+        return cli.EXIT_OK
+    return _execute(run_id, args)
+
+
+def command_resume(args: argparse.Namespace) -> int:
+    if db.get_batch_run(args.run_id) is None:
+        logging.error("Пакетный запуск с ID %s не найден", args.run_id)
+        return cli.EXIT_USAGE
+    return _execute(args.run_id, args)
+
+
+def command_status(args: argparse.Namespace) -> int:
+    runs = [db.get_batch_run(args.run_id)] if args.run_id else db.get_batch_runs()
+    if runs == [None]:
+        logging.error("Пакетный запуск с ID %s не найден", args.run_id)
+        return cli.EXIT_USAGE
+    print(f"{'ID':>5}  {'создан':<19}  {'заданий':>8}  {'готово':>8}  {'ошибок':>7}  {'осталось':>8}  название")
+    for run in runs:
+        print(f"{run['id']:>5}  {run['created_at']:<19}  {run['total']:>8}  {run['done']:>8}  "
+              f"{run['failed']:>7}  {run['pending']:>8}  {run['name'] or ''}")
+    return cli.EXIT_OK
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Пакетные запуски ChatList: промты × модели")
+    parser.add_argument("--db", help="Путь к файлу БД (по умолчанию - chatlist.db рядом с программой)")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Подробный журнал в stderr")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    def add_run_options(subparser):
+        subparser.add_argument("--concurrency", type=int, default=16, help="Максимум одновременных запросов")
+        subparser.add_argument("--timeout", type=int, default=30, help="Таймаут запроса в секундах")
+        subparser.add_argument("--no-cache", action="store_true", help="Не брать ответы из кэша")
+        subparser.add_argument("--flush-size", type=int, default=FLUSH_SIZE,
+                               help="Результатов в одной транзакции записи")
+
+    create = subparsers.add_parser("create", help="Создать запуск и выполнить его")
+    create.add_argument("--name", help="Название запуска")
+    create.add_argument("--prompt-tag", action="append", default=[], help="Промты с тегом; можно несколько раз")
+    create.add_argument("--prompt-id", type=int, nargs="+", action="extend", default=[], help="ID промтов")
+    create.add_argument("--search", action="append", default=[], help="Промты, найденные по тексту")
+    create.add_argument("--all-prompts", action="store_true", help="Все сохраненные промты")
+    create.add_argument("-m", "--model", action="append", default=[], help="Название модели или шаблон")
+    create.add_argument("-t", "--tag", action="append", default=[], help="Тип модели или провайдер")
+    create.add_argument("--include-inactive", action="store_true", help="Учитывать неактивные модели")
+    create.add_argument("--no-run", action="store_true", help="Только создать задания и вывести ID запуска")
+    add_run_options(create)
+    create.set_defaults(func=command_create)
+
+    resume = subparsers.add_parser("resume", help="Продолжить прерванный запуск")
+    resume.add_argument("run_id", type=int, help="ID запуска")
+    resume.add_argument("--retry-failed", action="store_true", help="Повторить задания, завершившиеся ошибкой")
+    add_run_options(resume)
+    resume.set_defaults(func=command_resume)
+
+    status = subparsers.add_parser("status", help="Состояние запусков")
+    status.add_argument("run_id", type=int, nargs="?", help="ID запуска (по умолчанию - все)")
+    status.set_defaults(func=command_status)
+
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING,
+                        format="%(levelname)s: %(message)s", stream=sys.stderr)
+    if args.db:
+        db.set_db_path(args.db)
+    db.init_database()
+    try:
+        return args.func(args)
+    finally:
+        network.flush_metrics()
+        network.close_sessions()
+        db.close_connections()
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,484 @@
+"""
+Бенчмарк сетевого слоя ChatList на локальном заглушечном HTTP-сервере.
+
+Сервер отвечает в формате OpenAI/OpenRouter и считает новые TCP-соединения
+(рукопожатия). Задержка рукопожатия эмулирует стоимость TCP+TLS до
+openrouter.ai, которой на localhost нет.
+
+Запуск:
+    python bench_network.py pooling --requests 200 --concurrency 10
+    python bench_network.py ratelimit --requests 300 --rpm 1200 --tpm 300000
+    python bench_network.py hedging --requests 300 --slow-fraction 0.05
+    python bench_network.py adaptive --requests 400 --capacity 16
+"""
+import argparse
+import json
+import random
+import statistics
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List
+
+import requests
+
+import network
+
+
+class QuotaBucket:
+    """Квота заглушки: limit единиц в минуту, всплеск до burst_seconds секунд квоты."""
+
+    def __init__(self, per_minute: float, burst_seconds: float):
+        self.rate = per_minute / 60.0
+        self.capacity = max(1.0, self.rate * burst_seconds)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def take(self, amount: float) -> float:
+        """Списывает amount единиц; если их не хватает, возвращает паузу до их появления."""
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens < amount:
+            return (amount - self.tokens) / self.rate
+        self.tokens -= amount
+        return 0.0
+
+
+class StubServer(ThreadingHTTPServer):
+    """
+    Заглушка chat/completions API с подсчетом соединений.
+
+    Если задана квота (rpm и/или tpm), сверх нее сервер отвечает 429 с Retry-After,
+    как провайдер с лимитом на ключ. Доля slow_fraction запросов обрабатывается
+    slow_delay секунд вместо response_delay (хвост задержек перегруженного API).
+
+    Если задана capacity, сервер без замедления обрабатывает capacity запросов
+    одновременно; при большем числе время обработки растет пропорционально
+    нагрузке, а сверх capacity + max_queue запросов сервер отвечает 429 без
+    Retry-After (перегрузка, а не квота).
+    """
+
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, handshake_delay: float = 0.0, response_delay: float = 0.0,
+                 rpm: float = 0, tpm: float = 0, burst_seconds: float = 2.0, completion_tokens: int = 10,
+                 slow_fraction: float = 0.0, slow_delay: float = 0.0, capacity: int = 0, max_queue: int = 0):
+        super().__init__(("127.0.0.1", 0), StubHandler)
+        self.handshake_delay = handshake_delay
+        self.response_delay = response_delay
+        self.rpm_quota = QuotaBucket(rpm, burst_seconds) if rpm else None
+        self.tpm_quota = QuotaBucket(tpm, burst_seconds) if tpm else None
+        self.completion_tokens = completion_tokens
+        self.slow_fraction = slow_fraction
+        self.slow_delay = slow_delay
+        self.capacity = capacity
+        self.max_queue = max_queue
+        self.active = 0
+        self.connections = 0
+        self.requests_received = 0
+        self.requests_served = 0
+        self.rejected = 0
+        self.lock = threading.Lock()
+
+    @property
+    def url(self) -> str:
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}/api/v1/chat/completions"
+
+    def reset_counters(self) -> None:
+        with self.lock:
+            self.connections = 0
+            self.requests_received = 0
+            self.requests_served = 0
+            self.rejected = 0
+
+    def handle_error(self, request, client_address):
+        # Клиент может закрыть keep-alive соединение в любой момент, это не ошибка
+        pass
+
+    def check_quota(self, tokens: int) -> float:
+        """Списывает запрос и токены из квоты; возвращает паузу до повтора, если квоты нет."""
+        with self.lock:
+            retry_after = max(self.rpm_quota.take(1) if self.rpm_quota else 0.0,
+                              self.tpm_quota.take(tokens) if self.tpm_quota else 0.0)
+            if retry_after:
+                self.rejected += 1
+            return retry_after
+
+    def enter(self) -> float:
+        """Принимает запрос в обработку; возвращает множитель времени обработки или 0 при перегрузке."""
+        with self.lock:
+            if self.capacity and self.active >= self.capacity + self.max_queue:
+                self.rejected += 1
+                return 0.0
+            self.active += 1
+            return max(1.0, self.active / self.capacity) if self.capacity else 1.0
+
+    def leave(self) -> None:
+        with self.lock:
+            self.active -= 1
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """Обработчик заглушки: одно соединение может обслужить много запросов (keep-alive)."""
+
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        super().setup()
+        with self.server.lock:
+            self.server.connections += 1
+        if self.server.handshake_delay:
+            time.sleep(self.server.handshake_delay)
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        payload = json.loads(self.rfile.read(length) or b"{}")
+        with self.server.lock:
+            self.server.requests_received += 1
+        # Токены: промт (~4 символа на токен) плюс ответ
+        tokens = (sum(len(m.get("content") or "") for m in payload.get("messages", [])) // 4
+                  + self.server.completion_tokens)
+        retry_after = self.server.check_quota(tokens)
+        if retry_after:
+            self._send_json(429, {"error": {"message": "Rate limit exceeded"}},
+                            {"Retry-After": f"{retry_after:.3f}"})
+            return
+        load = self.server.enter()
+        if not load:
+            self._send_json(429, {"error": {"message": "Server overloaded"}})
+            return
+        try:
+            if self.server.slow_fraction and random.random() < self.server.slow_fraction:
+                time.sleep(self.server.slow_delay * load)
+            elif self.server.response_delay:
+                time.sleep(self.server.response_delay * load)
+        finally:
+            self.server.leave()
+        with self.server.lock:
+            self.server.requests_served += 1
+        if payload.get("stream"):
+            self._send_stream(f"echo: {payload.get('model')}", tokens)
+            return
+        self._send_json(200, {
+            "choices": [{"message": {"role": "assistant", "content": f"echo: {payload.get('model')}"}}],
+            "usage": {"total_tokens": tokens},
+        })
+
+    def _send_json(self, status: int, data: Dict, headers: Dict = None) -> None:
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_stream(self, text: str, tokens: int) -> None:
+        """Отдает ответ в формате SSE по одному слову, chunked-кодированием."""
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        events = [{"choices": [{"delta": {"content": word + " "}}]} for word in text.split()]
+        events.append({"choices": [{"delta": {}}], "usage": {"total_tokens": tokens}})
+        for event in events:
+            self._write_chunk(f"data: {json.dumps(event)}\n\n".encode("utf-8"))
+        self._write_chunk(b"data: [DONE]\n\n")
+        self.wfile.write(b"0\r\n\r\n")
+
+    def _write_chunk(self, data: bytes) -> None:
+        self.wfile.write(f"{len(data):x}\r\n".encode("ascii") + data + b"\r\n")
+
+
+def _percentile(values: List[float], fraction: float) -> float:
+    """Возвращает перцентиль (fraction от 0 до 1) по методу ближайшего ранга."""
+    ordered = sorted(values)
+    index = max(0, min(len(ordered) - 1, int(round(fraction * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+
+def _run_batch(server: StubServer, total: int, concurrency: int) -> Dict:
+    """Отправляет total запросов через send_request_to_openrouter с заданным параллелизмом."""
+    model_data = {
+        "name": "openai/gpt-4",
+        "api_key": "bench",
+        "api_url": server.url,
+        "model_type": "openrouter",
+    }
+    latencies: List[float] = []
+    latencies_lock = threading.Lock()
+
+    def one_request(_):
+        start = time.perf_counter()
+        network.send_request_to_openrouter(model_data, "ping", timeout=10)
+        elapsed = time.perf_counter() - start
+        with latencies_lock:
+            latencies.append(elapsed)
+
+    server.reset_counters()
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(one_request, range(total)))
+    wall = time.perf_counter() - started
+
+    return {
+        "requests": total,
+        "handshakes": server.connections,
+        "p50_ms": _percentile(latencies, 0.50) * 1000,
+        "p95_ms": _percentile(latencies, 0.95) * 1000,
+        "mean_ms": statistics.mean(latencies) * 1000,
+        "wall_s": wall,
+    }
+
+
+def bench_pooling(args) -> None:
+    """Сравнивает запросы через пул сессий и через голый requests.post."""
+    server = StubServer(handshake_delay=args.handshake_delay, response_delay=args.response_delay)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    pooled_post = network._post
+    # Лимиты задаются явно, чтобы бенчмарк не читал настройки из БД
+    network.configure_rate_limits(key_rpm=0, key_tpm=0, model_rpm=0, model_tpm=0)
+    try:
+        network.close_sessions()
+        network.configure_session_pool(pool_maxsize=args.concurrency)
+        pooled = _run_batch(server, args.requests, args.concurrency)
+
+        # Без пула: каждый запрос открывает новое соединение, как было раньше
+        network._post = lambda url, **kwargs: requests.post(url, **kwargs)
+        unpooled = _run_batch(server, args.requests, args.concurrency)
+    finally:
+        network._post = pooled_post
+        network.close_sessions()
+        server.shutdown()
+        server.server_close()
+
+    print(f"Запросов: {args.requests}, параллельно: {args.concurrency}, "
+          f"задержка рукопожатия: {args.handshake_delay * 1000:.0f} мс")
+    print(f"{'режим':<12}{'рукопожатий':>12}{'p50, мс':>10}{'p95, мс':>10}{'всего, с':>10}")
+    for label, stats in (("без пула", unpooled), ("с пулом", pooled)):
+        print(f"{label:<12}{stats['handshakes']:>12}{stats['p50_ms']:>10.1f}"
+              f"{stats['p95_ms']:>10.1f}{stats['wall_s']:>10.2f}")
+
+
+def _run_fanout(server: StubServer, total: int, concurrency: int, prompt: str) -> Dict:
+    """Рассылает prompt в total "моделей" с одним ключом через send_prompt_to_multiple_models."""
+    models = [
+        {"id": i, "name": f"vendor/model-{i}", "api_key": "bench", "api_url": server.url,
+         "model_type": "openrouter"}
+        for i in range(total)
+    ]
+    server.reset_counters()
+    started = time.perf_counter()
+    results = network.send_prompt_to_multiple_models(models, prompt, timeout=30, max_workers=concurrency)
+    wall = time.perf_counter() - started
+    ok = sum(1 for result in results if result["success"])
+    # Время до ответа с учетом ожидания в очереди и повторов
+    latencies = [result["timings"]["total"] for result in results if result["success"]] or [0.0]
+    return {"ok": ok, "failed": total - ok, "rejected": server.rejected, "wall_s": wall,
+            "rpm": ok / wall * 60, "p50_ms": _percentile(latencies, 0.50) * 1000,
+            "p95_ms": _percentile(latencies, 0.95) * 1000}
+
+
+def bench_ratelimit(args) -> None:
+    """Сравнивает веерную рассылку без ограничителя и с ограничителем под квоту заглушки."""
+    server = StubServer(response_delay=args.response_delay, rpm=args.rpm, tpm=args.tpm,
+                        completion_tokens=args.completion_tokens)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    prompt = "x" * args.prompt_chars
+
+    network.configure_response_cache(enabled=False)
+    network.configure_metrics(enabled=False)
+    try:
+        network.configure_rate_limits(key_rpm=0, key_tpm=0, model_rpm=0, model_tpm=0)
+        unlimited = _run_fanout(server, args.requests, args.concurrency, prompt)
+        # Дожидаемся восполнения квоты заглушки перед вторым прогоном
+        time.sleep(2.0)
+        network.configure_rate_limits(key_rpm=args.rpm, key_tpm=args.tpm)
+        limited = _run_fanout(server, args.requests, args.concurrency, prompt)
+    finally:
+        network.configure_rate_limits(key_rpm=0, key_tpm=0)
+        network.close_sessions()
+        server.shutdown()
+        server.server_close()
+
+    tokens = args.prompt_chars // 4 + args.completion_tokens
+    quota_rpm = min(args.rpm or float("inf"), (args.tpm or float("inf")) / tokens)
+    print(f"Запросов: {args.requests}, параллельно: {args.concurrency}, "
+          f"квота: {args.rpm:.0f} запросов/мин, {args.tpm:.0f} токенов/мин "
+          f"(= {quota_rpm:.0f} запросов/мин по {tokens} токенов)")
+    print(f"{'режим':<16}{'успешно':>9}{'ошибок':>8}{'ответов 429':>13}{'запросов/мин':>14}{'всего, с':>10}")
+    for label, stats in (("без ограничения", unlimited), ("с ограничением", limited)):
+        print(f"{label:<16}{stats['ok']:>9}{stats['failed']:>8}{stats['rejected']:>13}"
+              f"{stats['rpm']:>14.0f}{stats['wall_s']:>10.2f}")
+
+
+def _run_sequential(server: StubServer, model: Dict, total: int, concurrency: int) -> Dict:
+    """Отправляет total запросов к одной модели через send_prompt_to_model с заданным параллелизмом."""
+    latencies: List[float] = []
+    latencies_lock = threading.Lock()
+
+    def one_request(_):
+        start = time.perf_counter()
+        network.send_prompt_to_model(model, "ping", timeout=30, max_retries=0, use_cache=False)
+        elapsed = time.perf_counter() - start
+        with latencies_lock:
+            latencies.append(elapsed)
+
+    server.reset_counters()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(one_request, range(total)))
+    return {
+        "sent": server.requests_received,
+        "p50_ms": _percentile(latencies, 0.50) * 1000,
+        "p90_ms": _percentile(latencies, 0.90) * 1000,
+        "p99_ms": _percentile(latencies, 0.99) * 1000,
+        "max_ms": max(latencies) * 1000,
+    }
+
+
+def bench_hedging(args) -> None:
+    """Сравнивает хвост задержек без хеджирования и с ним на заглушке с редкими медленными ответами."""
+    server = StubServer(response_delay=args.response_delay, slow_fraction=args.slow_fraction,
+                        slow_delay=args.slow_delay)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    model = {"id": 1, "name": "vendor/model", "api_key": "bench", "api_url": server.url,
+             "model_type": "openrouter", "hedge": 0}
+
+    network.configure_response_cache(enabled=False)
+    network.configure_metrics(enabled=False)
+    network.configure_rate_limits(key_rpm=0, key_tpm=0, model_rpm=0, model_tpm=0)
+    try:
+        plain = _run_sequential(server, model, args.requests, args.concurrency)
+        # Задержка перед дублем - p90 первого прогона, как по истории результатов в БД
+        network.configure_hedging(budget_percent=args.budget)
+        network._hedge_policy.set_delays({model["id"]: plain["p90_ms"] / 1000})
+        hedged = _run_sequential(server, dict(model, hedge=1), args.requests, args.concurrency)
+    finally:
+        network.close_sessions()
+        server.shutdown()
+        server.server_close()
+
+    print(f"Запросов: {args.requests}, параллельно: {args.concurrency}, "
+          f"медленных: {args.slow_fraction:.0%} по {args.slow_delay:.1f} с, бюджет дублей: {args.budget:.0f}%")
+    print(f"{'режим':<18}{'отправлено':>11}{'p50, мс':>9}{'p90, мс':>9}{'p99, мс':>9}{'макс, мс':>10}")
+    for label, stats in (("без хеджирования", plain), ("с хеджированием", hedged)):
+        print(f"{label:<18}{stats['sent']:>11}{stats['p50_ms']:>9.0f}{stats['p90_ms']:>9.0f}"
+              f"{stats['p99_ms']:>9.0f}{stats['max_ms']:>10.0f}")
+
+
+def bench_adaptive(args) -> None:
+    """Сравнивает фиксированные пулы и адаптивный лимит на заглушке с ограниченной пропускной способностью."""
+    server = StubServer(response_delay=args.response_delay, capacity=args.capacity, max_queue=args.max_queue)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+
+    network.configure_response_cache(enabled=False)
+    network.configure_metrics(enabled=False)
+    network.configure_rate_limits(key_rpm=0, key_tpm=0, model_rpm=0, model_tpm=0)
+    runs = []
+    try:
+        network.configure_adaptive_concurrency(enabled=False)
+        for size in args.fixed:
+            runs.append((f"фиксированный {size}", _run_fanout(server, args.requests, size, "ping"), None))
+            time.sleep(args.response_delay * 2)
+        network.configure_adaptive_concurrency(enabled=True, initial_limit=args.initial, max_limit=args.max_limit)
+        limits: List[int] = []
+        sampling = threading.Event()
+
+        def sample_limit():
+            while not sampling.wait(0.05):
+                limits.extend(state["limit"] for state in network.get_concurrency_state())
+
+        sampler = threading.Thread(target=sample_limit, daemon=True)
+        sampler.start()
+        stats = _run_fanout(server, args.requests, args.max_limit, "ping")
+        sampling.set()
+        sampler.join()
+        runs.append(("адаптивный", stats, limits))
+    finally:
+        network.configure_adaptive_concurrency()
+        network.close_sessions()
+        server.shutdown()
+        server.server_close()
+
+    print(f"Запросов: {args.requests}, емкость заглушки: {args.capacity} одновременно "
+          f"(+{args.max_queue} с замедлением), обработка: {args.response_delay * 1000:.0f} мс")
+    print(f"{'режим':<18}{'успешно':>9}{'ошибок':>8}{'ответов 429':>13}{'запросов/с':>12}"
+          f"{'p50, мс':>9}{'p95, мс':>9}{'всего, с':>10}")
+    for label, stats, _ in runs:
+        print(f"{label:<18}{stats['ok']:>9}{stats['failed']:>8}{stats['rejected']:>13}"
+              f"{stats['ok'] / stats['wall_s']:>12.1f}{stats['p50_ms']:>9.0f}{stats['p95_ms']:>9.0f}"
+              f"{stats['wall_s']:>10.2f}")
+    limits = runs[-1][2]
+    if limits:
+        print(f"Адаптивный лимит: начальный {args.initial}, медиана {statistics.median(limits):.0f}, "
+              f"максимум {max(limits)}, в конце {limits[-1]}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарки сетевого слоя ChatList")
+    subparsers = parser.add_subparsers(dest="scenario", required=True)
+
+    pooling = subparsers.add_parser("pooling", help="Пул HTTP-сессий против requests.post")
+    pooling.add_argument("--requests", type=int, default=200, help="Количество запросов")
+    pooling.add_argument("--concurrency", type=int, default=10, help="Параллельных запросов")
+    pooling.add_argument("--handshake-delay", type=float, default=0.05,
+                         help="Эмулируемая стоимость TCP+TLS рукопожатия, с")
+    pooling.add_argument("--response-delay", type=float, default=0.01,
+                         help="Время обработки запроса сервером, с")
+    pooling.set_defaults(func=bench_pooling)
+
+    ratelimit = subparsers.add_parser("ratelimit", help="Клиентский ограничитель против квоты сервера")
+    ratelimit.add_argument("--requests", type=int, default=300, help="Количество моделей в рассылке")
+    ratelimit.add_argument("--concurrency", type=int, default=64, help="Параллельных запросов")
+    ratelimit.add_argument("--rpm", type=float, default=1200, help="Квота запросов в минуту на ключ")
+    ratelimit.add_argument("--tpm", type=float, default=300000, help="Квота токенов в минуту на ключ")
+    ratelimit.add_argument("--prompt-chars", type=int, default=400, help="Длина промта в символах")
+    ratelimit.add_argument("--completion-tokens", type=int, default=200, help="Токенов в ответе заглушки")
+    ratelimit.add_argument("--response-delay", type=float, default=0.05,
+                           help="Время обработки запроса сервером, с")
+    ratelimit.set_defaults(func=bench_ratelimit)
+
+    hedging = subparsers.add_parser("hedging", help="Дублирование медленных запросов против хвоста задержек")
+    hedging.add_argument("--requests", type=int, default=300, help="Количество запросов")
+    hedging.add_argument("--concurrency", type=int, default=16, help="Параллельных запросов")
+    hedging.add_argument("--response-delay", type=float, default=0.2,
+                         help="Обычное время обработки запроса сервером, с")
+    hedging.add_argument("--slow-fraction", type=float, default=0.05, help="Доля медленных ответов")
+    hedging.add_argument("--slow-delay", type=float, default=2.0, help="Время медленного ответа, с")
+    hedging.add_argument("--budget", type=float, default=10, help="Бюджет дублей, процентов от запросов")
+    hedging.set_defaults(func=bench_hedging)
+
+    adaptive = subparsers.add_parser("adaptive", help="Адаптивный лимит параллельности против фиксированных пулов")
+    adaptive.add_argument("--requests", type=int, default=400, help="Количество моделей в рассылке")
+    adaptive.add_argument("--capacity", type=int, default=16,
+                          help="Сколько запросов заглушка обрабатывает одновременно без замедления")
+    adaptive.add_argument("--max-queue", type=int, default=16,
+                          help="Сколько запросов сверх емкости заглушка принимает с замедлением до ответа 429")
+    adaptive.add_argument("--response-delay", type=float, default=0.1,
+                          help="Время обработки запроса сервером без нагрузки, с")
+    adaptive.add_argument("--fixed", type=lambda value: [int(size) for size in value.split(",")],
+                          default=[4, 16, 64], help="Размеры фиксированных пулов через запятую")
+    adaptive.add_argument("--initial", type=int, default=8, help="Начальный адаптивный лимит")
+    adaptive.add_argument("--max-limit", type=int, default=64, help="Потолок адаптивного лимита")
+    adaptive.set_defaults(func=bench_adaptive)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
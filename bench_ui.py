@@ -0,0 +1,129 @@
+"""
+Бенчмарк отрисовки таблицы сравнения ChatList (ComparisonTableModel + ResponseDelegate).
+
+Замеряет на строках с многокилобайтными ответами расчет высоты строк
+(row_height, разбивка текста на строки), отрисовку всех ячеек ответа (paint)
+в изображение и кадр таблицы, в котором рисуются только видимые строки,
+без открытия окна (платформа Qt offscreen).
+Цель - 100 ответов по несколько КБ обрабатываются быстрее 50 мс.
+
+Запуск:
+    python bench_ui.py --rows 100 --kb 4 --width 600
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import time
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+from PyQt5.QtCore import QRect
+from PyQt5.QtGui import QFontMetrics, QImage, QPainter
+from PyQt5.QtWidgets import QApplication, QStyle, QStyleOptionViewItem, QTableView
+
+from main import RESPONSE_PADDING, ComparisonTableModel, ResponseDelegate
+
+TARGET_MS = 50.0
+
+WORDS = ("запрос", "ответ", "модель", "индекс", "таблица", "кэш", "задержка", "поток",
+         "response", "latency", "throughput", "def", "return", "SELECT", "await", "1024")
+
+
+def _response_text(rng: random.Random, size: int) -> str:
+    """Текст ответа около size символов: абзацы слов, как в ответах моделей."""
+    parts = []
+    length = 0
+    while length < size:
+        word = rng.choice(WORDS)
+        separator = "\n\n" if rng.random() < 0.02 else " "
+        parts.append(word + separator)
+        length += len(word) + len(separator)
+    return "".join(parts)
+
+
+def _build_model(rows: int, size: int) -> ComparisonTableModel:
+    rng = random.Random(9)
+    model = ComparisonTableModel()
+    model.set_models([{'id': row, 'name': f"vendor/model-{row}"} for row in range(rows)])
+    for row in range(rows):
+        result = {'success': True, 'model_id': row}
+        model.set_result(row, result, _response_text(rng, size), "Готово")
+    return model
+
+
+def _measure(model: ComparisonTableModel, view: QTableView, width: int) -> dict:
+    """Один проход с пустым кэшем разбивок: высоты строк, первая и повторная отрисовка, кадр таблицы."""
+    delegate = ResponseDelegate(view)
+    font = view.font()
+    column = ComparisonTableModel.COLUMN_RESPONSE
+    rows = model.rowCount()
+
+    start = time.perf_counter()
+    heights = [delegate.row_height(model.response_text(row), width, font) for row in range(rows)]
+    size_hint_ms = (time.perf_counter() - start) * 1000
+
+    image = QImage(width, max(heights), QImage.Format.Format_ARGB32_Premultiplied)
+    option = QStyleOptionViewItem()
+    option.font = font
+    option.fontMetrics = QFontMetrics(font)
+    option.palette = view.palette()
+    option.state = QStyle.StateFlag.State_Enabled
+
+    def paint_all() -> float:
+        painter = QPainter(image)
+        start = time.perf_counter()
+        for row in range(rows):
+            option.rect = QRect(0, 0, width, heights[row])
+            delegate.paint(painter, option, model.index(row, column))
+        elapsed = (time.perf_counter() - start) * 1000
+        painter.end()
+        return elapsed
+
+    paint_ms = paint_all()
+    repaint_ms = paint_all()
+
+    # Кадр таблицы целиком: представление рисует только видимые строки
+    view.setItemDelegateForColumn(column, delegate)
+    view.setColumnWidth(column, width + 2 * RESPONSE_PADDING)
+    for row, height in enumerate(heights):
+        view.setRowHeight(row, height)
+    start = time.perf_counter()
+    view.grab()
+    frame_ms = (time.perf_counter() - start) * 1000
+    return {'size_hint_ms': size_hint_ms, 'paint_ms': paint_ms, 'repaint_ms': repaint_ms,
+            'total_ms': size_hint_ms + paint_ms, 'frame_ms': frame_ms}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Бенчмарк отрисовки таблицы сравнения ChatList")
+    parser.add_argument("--rows", type=int, default=100, help="Количество строк (моделей)")
+    parser.add_argument("--kb", type=float, default=4, help="Размер ответа в КБ текста")
+    parser.add_argument("--width", type=int, default=600, help="Ширина столбца ответа, пиксели")
+    parser.add_argument("--view-width", type=int, default=1200, help="Ширина окна таблицы, пиксели")
+    parser.add_argument("--view-height", type=int, default=800, help="Высота окна таблицы, пиксели")
+    parser.add_argument("--repeat", type=int, default=5, help="Число замеров (выводится медиана)")
+    args = parser.parse_args()
+
+    app = QApplication.instance() or QApplication(sys.argv)
+    model = _build_model(args.rows, int(args.kb * 1024))
+    view = QTableView()
+    view.setModel(model)
+    view.resize(args.view_width, args.view_height)
+    runs = [_measure(model, view, args.width) for _ in range(args.repeat)]
+    median = {key: statistics.median(run[key] for run in runs) for key in runs[0]}
+
+    print(f"Строк: {args.rows}, ответ: {args.kb:g} КБ, ширина столбца: {args.width} пикс., "
+          f"платформа Qt: {app.platformName()}, медиана {args.repeat} замеров")
+    print(f"{'этап':<34}{'мс':>9}")
+    print(f"{'высота строк (row_height)':<34}{median['size_hint_ms']:>9.1f}")
+    print(f"{'отрисовка (paint)':<34}{median['paint_ms']:>9.1f}")
+    print(f"{'повторная отрисовка (кэш)':<34}{median['repaint_ms']:>9.1f}")
+    print(f"{'кадр таблицы ' + str(args.view_width) + 'x' + str(args.view_height):<34}{median['frame_ms']:>9.1f}")
+    verdict = "в пределах цели" if median['total_ms'] < TARGET_MS else "ЦЕЛЬ НЕ ДОСТИГНУТА"
+    print(f"{'всего':<34}{median['total_ms']:>9.1f}  ({verdict} {TARGET_MS:.0f} мс)")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,271 @@
+"""
+Запуск сравнения моделей ChatList из командной строки, без графического интерфейса.
+
+Модуль не импортирует Qt и подходит для cron и CI. Промты берутся из
+аргументов, файлов или стандартного ввода, модели выбираются по названию
+(допускаются шаблоны вида "openai/*") или по тегу - типу модели либо
+провайдеру в названии ("openai" для "openai/gpt-4"). Результаты выводятся
+в stdout в формате JSONL (одна строка на ответ модели) и/или сохраняются в БД.
+
+Запуск:
+    python cli.py "Что такое SQLite?" --model openai/gpt-4 --model "qwen/*"
+    python cli.py --file prompts.txt --split-lines --tag openrouter --save
+    echo "Привет" | python cli.py --save --quiet
+    python cli.py --list-models
+"""
+import argparse
+import fnmatch
+import json
+import logging
+import os
+import sys
+from typing import Dict, List, Optional
+
+import db
+import models
+import network
+
+
+# Коды завершения: все запросы успешны / есть неудачные ответы / ошибка запуска / прервано
+EXIT_OK = 0
+EXIT_FAILURES = 1
+EXIT_USAGE = 2
+EXIT_INTERRUPTED = 130
+
+
+def read_prompts(prompts: List[str], files: List[str], split_lines: bool) -> List[str]:
+    """
+    Собирает промты из аргументов, файлов и стандартного ввода.
+
+    Аргумент "-" и файл "-" означают стандартный ввод; если промты не заданы
+    совсем и ввод перенаправлен, он читается автоматически. С split_lines
+    каждая непустая строка файла или ввода - отдельный промт, иначе весь
+    текст - один промт.
+    """
+    texts = []
+    sources = list(files)
+    for prompt in prompts:
+        if prompt == "-":
+            sources.append("-")
+        else:
+            texts.append(prompt)
+    if not texts and not sources and not sys.stdin.isatty():
+        sources.append("-")
+
+    for source in sources:
+        if source == "-":
+            content = sys.stdin.read()
+        else:
+            with open(source, encoding="utf-8") as file:
+                content = file.read()
+        texts.extend(content.splitlines() if split_lines else [content])
+
+    return [text.strip() for text in texts if text.strip()]
+
+
+def _model_tags(model: Dict) -> set:
+    """Теги модели: тип модели и провайдер из названия ("openai" для "openai/gpt-4")."""
+    tags = {models.normalize_model_type(model.get('model_type'), model.get('api_url'))}
+    if '/' in model['name']:
+        tags.add(model['name'].split('/', 1)[0].lower())
+    return tags
+
+
+def select_models(names: List[str], tags: List[str], include_inactive: bool = False) -> List[Dict]:
+    """
+    Выбирает модели по названиям (или шаблонам) и тегам.
+
+    Без фильтров возвращаются активные модели. Неактивные модели попадают
+    в выборку, только если include_inactive или модель названа явно, без шаблона.
+
+    Raises:
+        ValueError: Если названию или шаблону не соответствует ни одна модель
+    """
+    all_models = models.ModelManager.get_all_models()
+    if not names and not tags:
+        candidates = all_models if include_inactive else [m for m in all_models if m['is_active']]
+        return [_with_key(model) for model in candidates]
+
+    selected = {}
+    for name in names:
+        matched = [model for model in all_models if fnmatch.fnmatchcase(model['name'], name)]
+        if not matched:
+            raise ValueError(f"Модель не найдена: {name}")
+        is_pattern = any(char in name for char in "*?[")
+        for model in matched:
+            if model['is_active'] or include_inactive or not is_pattern:
+                selected.setdefault(model['id'], model)
+    wanted_tags = {tag.lower() for tag in tags}
+    for model in all_models:
+        if (model['is_active'] or include_inactive) and _model_tags(model) & wanted_tags:
+            selected.setdefault(model['id'], model)
+
+    return [_with_key(model) for model in sorted(selected.values(), key=lambda m: m['name'])]
+
+
+def _with_key(model: Dict) -> Dict:
+    """Данные модели с API-ключом для запроса."""
+    model_dict = dict(model)
+    model_dict['api_key'] = models.ModelManager.get_api_key_for_model(model)
+    return model_dict
+
+
+def _output_record(result: Dict, prompt_index: int, prompt_id: Optional[int],
+                   result_id: Optional[int]) -> Dict:
+    """Строка JSONL для результата одной модели."""
+    record = {
+        'prompt_index': prompt_index,
+        'prompt_id': prompt_id,
+        'model_id': result['model_id'],
+        'model_name': result['model_name'],
+        'success': result['success'],
+    }
+    if result['success']:
+        record.update(response=result['response'], tokens_used=result.get('tokens_used'),
+                      response_time=result.get('response_time'), cached=result.get('cached', False),
+                      result_id=result_id)
+    else:
+        record.update(error=result.get('error'), cancelled=result.get('cancelled', False))
+    return record
+
+
+def _save_results(prompt_id: int, results: List[Dict]) -> Dict[int, int]:
+    """
+    Сохраняет успешные ответы одной транзакцией (как кнопка "Сохранить" в главном окне).
+
+    Returns:
+        Словарь {id модели: id сохраненного результата}
+    """
+    successful = [result for result in results if result['success']]
+    if not successful:
+        return {}
+    # Метрики запросов должны быть в базе, чтобы связаться с сохраняемыми результатами
+    network.flush_metrics()
+    ids, failures = db.create_results_bulk([
+        {
+            'prompt_id': prompt_id,
+            'model_id': result['model_id'],
+            'response': result['response'],
+            'tokens_used': result.get('tokens_used'),
+            # Время поиска в кэше не должно попадать в статистику времени ответа
+            'response_time': None if result.get('cached') else result.get('response_time'),
+            'request_id': result.get('request_id')
+        }
+        for result in successful
+    ])
+    for index, message in failures:
+        logging.warning("Результат %s не сохранен: %s", successful[index]['model_name'], message)
+    return {result['model_id']: result_id for result, result_id in zip(successful, ids) if result_id is not None}
+
+
+def _write_record(record: Dict) -> None:
+    sys.stdout.write(json.dumps(record, ensure_ascii=False) + "\n")
+    sys.stdout.flush()
+
+
+def run(args: argparse.Namespace) -> int:
+    """Выполняет сравнение по разобранным аргументам и возвращает код завершения."""
+    if args.db:
+        db.set_db_path(args.db)
+    db.init_database()
+
+    if args.list_models:
+        for model in models.ModelManager.get_all_models():
+            _write_record({'id': model['id'], 'name': model['name'], 'is_active': bool(model['is_active']),
+                           'tags': sorted(_model_tags(model))})
+        return EXIT_OK
+
+    try:
+        prompts = read_prompts(args.prompts, args.file, args.split_lines)
+        selected = select_models(args.model, args.tag, args.include_inactive)
+    except (OSError, ValueError) as e:
+        logging.error("%s", e)
+        return EXIT_USAGE
+    if not prompts:
+        logging.error("Не задано ни одного промта")
+        return EXIT_USAGE
+    if not selected:
+        logging.error("Не выбрано ни одной модели")
+        return EXIT_USAGE
+
+    for problem in network.prepare_models(selected):
+        logging.warning("%s", problem)
+
+    timeout = args.timeout
+    if timeout is None:
+        setting = db.get_setting("api_timeout")
+        timeout = int(setting) if setting and setting.isdigit() else 30
+
+    exit_code = EXIT_OK
+    cancel_token = network.CancelToken()
+    try:
+        for prompt_index, prompt in enumerate(prompts):
+            prompt_id = db.create_prompt(prompt, args.prompt_tags) if args.save else None
+            results = []
+            # Без сохранения строки выводятся сразу по готовности ответа,
+            # с сохранением - после записи, чтобы содержать result_id
+            for result in network.iter_prompt_to_multiple_models(
+                selected, prompt, timeout=timeout, max_workers=args.concurrency,
+                use_cache=not args.no_cache, cancel_token=cancel_token
+            ):
+                results.append(result)
+                if not args.save and not args.quiet:
+                    _write_record(_output_record(result, prompt_index, None, None))
+
+            if args.save:
+                result_ids = _save_results(prompt_id, results)
+                if not args.quiet:
+                    for result in results:
+                        _write_record(_output_record(result, prompt_index, prompt_id,
+                                                     result_ids.get(result['model_id'])))
+            if not all(result['success'] for result in results):
+                exit_code = EXIT_FAILURES
+    except KeyboardInterrupt:
+        cancel_token.cancel()
+        return EXIT_INTERRUPTED
+    finally:
+        network.flush_metrics()
+        network.close_sessions()
+        db.close_connections()
+
+    return exit_code
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(
+        description="Отправка промтов в модели ChatList без графического интерфейса (результаты - JSONL в stdout)"
+    )
+    parser.add_argument("prompts", nargs="*", metavar="PROMPT", help="Текст промта ('-' - стандартный ввод)")
+    parser.add_argument("-f", "--file", action="append", default=[],
+                        help="Файл с промтом ('-' - стандартный ввод); можно указать несколько раз")
+    parser.add_argument("--split-lines", action="store_true",
+                        help="Каждая непустая строка файлов и ввода - отдельный промт")
+    parser.add_argument("-m", "--model", action="append", default=[],
+                        help="Название модели или шаблон (например, 'openai/*'); можно указать несколько раз")
+    parser.add_argument("-t", "--tag", action="append", default=[],
+                        help="Тип модели или провайдер из названия (например, openrouter, openai)")
+    parser.add_argument("--include-inactive", action="store_true", help="Учитывать неактивные модели")
+    parser.add_argument("--list-models", action="store_true", help="Вывести список моделей и выйти")
+    parser.add_argument("--save", action="store_true", help="Сохранить промты и успешные ответы в БД")
+    parser.add_argument("--prompt-tags", help="Теги сохраняемых промтов")
+    parser.add_argument("-q", "--quiet", action="store_true", help="Не выводить результаты в stdout")
+    parser.add_argument("--timeout", type=int, help="Таймаут запроса в секундах (по умолчанию - из настроек)")
+    parser.add_argument("--concurrency", type=int, default=network.DEFAULT_MAX_CONCURRENCY,
+                        help="Максимум одновременных запросов")
+    parser.add_argument("--no-cache", action="store_true", help="Не брать ответы из кэша")
+    parser.add_argument("--db", help="Путь к файлу БД (по умолчанию - chatlist.db рядом с программой)")
+    parser.add_argument("-v", "--verbose", action="store_true", help="Подробный журнал в stderr")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING,
+                        format="%(levelname)s: %(message)s", stream=sys.stderr)
+    try:
+        return run(args)
+    except BrokenPipeError:
+        # Получатель вывода закрылся раньше времени (например, "| head")
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        return EXIT_FAILURES
+
+
+if __name__ == "__main__":
+    sys.exit(main())
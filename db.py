@@ -4,8 +4,11 @@
 """
 import sqlite3
 import os
+import json
+import math
+import threading
 from datetime import datetime
-from typing import List, Dict, Optional, Tuple
+from typing import Callable, List, Dict, Optional, Tuple
 
 
 DB_NAME = "chatlist.db"
@@ -37,94 +40,654 @@ def get_db_path() -> str:
         return os.path.join(script_dir, DB_NAME)
 
 
+# Токенизатор полнотекстового поиска: регистр и диакритика не учитываются
+FTS_TOKENIZER = "unicode61 remove_diacritics 2"
+# Длины префиксов, для которых FTS5 строит отдельный индекс (поиск идет по началу слов)
+FTS_PREFIX_INDEX = "2 3 4"
+# Маркеры совпадений во фрагментах, которые возвращает search()
+SNIPPET_START = "["
+SNIPPET_END = "]"
+# Количество слов во фрагменте и длина превью текста в результатах поиска
+SNIPPET_TOKENS = 12
+PREVIEW_LENGTH = 200
+
+# Параметры соединений: таймаут ожидания блокировки (с), размер кэша
+# подготовленных выражений, кэш страниц (отрицательное значение - в КиБ) и mmap (байт)
+BUSY_TIMEOUT = 5.0
+STATEMENT_CACHE_SIZE = 256
+PAGE_CACHE_KIB = 16384
+MMAP_SIZE = 256 * 1024 * 1024
+
+
+class ConnectionManager:
+    """
+    Менеджер долгоживущих соединений с БД.
+    
+    Каждый поток получает свое соединение, которое создается при первом
+    обращении и затем переиспользуется. Соединения работают в режиме WAL,
+    поэтому фоновые потоки могут записывать результаты, пока интерфейс
+    читает данные, без ошибок "database is locked".
+    """
+    
+    def __init__(self, db_path: Optional[str] = None):
+        self._db_path = db_path
+        self._local = threading.local()
+        self._connections: List[Tuple[threading.Thread, sqlite3.Connection]] = []
+        self._lock = threading.Lock()
+    
+    @property
+    def db_path(self) -> str:
+        """Путь к файлу БД (определяется один раз)."""
+        if self._db_path is None:
+            self._db_path = get_db_path()
+        return self._db_path
+    
+    def _connect(self) -> sqlite3.Connection:
+        """Открывает соединение и настраивает его для совместной работы потоков."""
+        conn = sqlite3.connect(
+            self.db_path,
+            timeout=BUSY_TIMEOUT,
+            cached_statements=STATEMENT_CACHE_SIZE,
+            check_same_thread=False  # Соединение используется одним потоком, но закрыть его может любой
+        )
+        conn.row_factory = sqlite3.Row  # Для доступа к полям по имени
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA cache_size=-{PAGE_CACHE_KIB}")
+        conn.execute(f"PRAGMA mmap_size={MMAP_SIZE}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        return conn
+    
+    def get(self) -> sqlite3.Connection:
+        """Возвращает соединение текущего потока, создавая его при необходимости."""
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._connect()
+            self._local.conn = conn
+            with self._lock:
+                self._close_dead_threads()
+                self._connections.append((threading.current_thread(), conn))
+        return conn
+    
+    def _close_dead_threads(self) -> None:
+        """Закрывает соединения завершившихся потоков. Вызывается под блокировкой."""
+        alive = []
+        for thread, conn in self._connections:
+            if thread.is_alive():
+                alive.append((thread, conn))
+            else:
+                conn.close()
+        self._connections = alive
+    
+    def close_all(self) -> None:
+        """Закрывает все соединения (например, при выходе из приложения)."""
+        with self._lock:
+            for _, conn in self._connections:
+                conn.close()
+            self._connections = []
+        self._local = threading.local()
+    
+    def set_db_path(self, db_path: Optional[str]) -> None:
+        """Переключает менеджер на другой файл БД (None - путь по умолчанию)."""
+        self.close_all()
+        self._db_path = db_path
+
+
+_manager = ConnectionManager()
+
+
 def get_connection() -> sqlite3.Connection:
-    """Создает и возвращает соединение с базой данных."""
-    conn = sqlite3.connect(get_db_path())
-    conn.row_factory = sqlite3.Row  # Для доступа к полям по имени
-    return conn
+    """Возвращает соединение с базой данных для текущего потока."""
+    return _manager.get()
+
+
+def close_connections() -> None:
+    """Закрывает все соединения с базой данных."""
+    _manager.close_all()
+
+
+def set_db_path(db_path: Optional[str]) -> None:
+    """Задает путь к файлу базы данных (например, для скриптов импорта)."""
+    _manager.set_db_path(db_path)
 
 
 def init_database() -> None:
-    """Инициализирует базу данных и создает все необходимые таблицы."""
+    """
+    Готовит базу данных к работе: применяет недостающие миграции схемы.
+    
+    Версия схемы хранится в PRAGMA user_version, поэтому при обычном запуске
+    выполняется только чтение номера версии.
+    """
+    if get_schema_version() < SCHEMA_VERSION:
+        migrate()
+
+
+# ==================== Миграции схемы ====================
+
+# Размер порции (диапазон id) при заполнении новых таблиц по существующим строкам
+MIGRATION_BATCH_SIZE = 5000
+
+
+def _migration_base_schema(cursor: sqlite3.Cursor) -> None:
+    """Основные таблицы: промты, модели, результаты и настройки."""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS prompts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            date TEXT NOT NULL,
+            prompt TEXT NOT NULL,
+            tags TEXT
+        )
+    """)
+    
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_prompts_date ON prompts(date)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_prompts_tags ON prompts(tags)")
+    
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS models (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL UNIQUE,
+            api_url TEXT NOT NULL,
+            api_id TEXT NOT NULL,
+            is_active INTEGER NOT NULL DEFAULT 1,
+            model_type TEXT,
+            created_at TEXT NOT NULL
+        )
+    """)
+    
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_models_is_active ON models(is_active)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_models_name ON models(name)")
+    
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS results (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            prompt_id INTEGER NOT NULL,
+            model_id INTEGER NOT NULL,
+            response TEXT NOT NULL,
+            saved_at TEXT NOT NULL,
+            tokens_used INTEGER,
+            response_time REAL,
+            FOREIGN KEY (prompt_id) REFERENCES prompts(id) ON DELETE CASCADE,
+            FOREIGN KEY (model_id) REFERENCES models(id) ON DELETE CASCADE
+        )
+    """)
+    
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_results_prompt_id ON results(prompt_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_results_model_id ON results(model_id)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_results_saved_at ON results(saved_at)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_results_prompt_model ON results(prompt_id, model_id)")
+    
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS settings (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            key TEXT NOT NULL UNIQUE,
+            value TEXT,
+            description TEXT,
+            updated_at TEXT NOT NULL
+        )
+    """)
+    
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_settings_key ON settings(key)")
+    
+    # Начальные данные добавляются только в пустую БД
+    _add_initial_data(cursor)
+
+
+def _migration_results_pagination(cursor: sqlite3.Cursor) -> None:
+    """Индекс для постраничного просмотра истории результатов по модели."""
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_results_model_saved_at ON results(model_id, saved_at)")
+
+
+def _migration_response_cache(cursor: sqlite3.Cursor) -> None:
+    """Кэш ответов моделей (ключ - хэш модели, сообщений и параметров запроса)."""
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS response_cache (
+            key TEXT PRIMARY KEY,
+            model TEXT NOT NULL,
+            response TEXT NOT NULL,
+            tokens_used INTEGER,
+            response_time REAL,
+            size INTEGER NOT NULL,
+            created_at REAL NOT NULL,
+            last_used REAL NOT NULL
+        ) WITHOUT ROWID
+    """)
+    
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_response_cache_last_used ON response_cache(last_used)")
+
+
+def _migration_resolved_name(cursor: sqlite3.Cursor) -> None:
+    """Имя модели для маршрутизации OpenRouter, вычисленное по названию (NULL - еще не вычислено)."""
+    _ensure_column(cursor, "models", "resolved_name", "TEXT")
+
+
+def _migration_models_hedge(cursor: sqlite3.Cursor) -> None:
+    """Признак дублирования медленных запросов к модели (хеджирование)."""
+    _ensure_column(cursor, "models", "hedge", "INTEGER NOT NULL DEFAULT 0")
+
+
+def _migration_request_metrics(cursor: sqlite3.Cursor) -> None:
+    """
+    Разбивка времени каждого запроса к API (в том числе неудачных и из кэша);
+    result_id заполняется, когда ответ сохраняется в results.
+    """
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS request_metrics (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            request_id TEXT NOT NULL UNIQUE,
+            model_id INTEGER,
+            model_name TEXT,
+            result_id INTEGER,
+            created_at TEXT NOT NULL,
+            success INTEGER NOT NULL,
+            status INTEGER,
+            error TEXT,
+            cached INTEGER NOT NULL DEFAULT 0,
+            streamed INTEGER NOT NULL DEFAULT 0,
+            hedged INTEGER NOT NULL DEFAULT 0,
+            queue_wait REAL,
+            connect REAL,
+            ttfb REAL,
+            download REAL,
+            parse REAL,
+            total REAL,
+            retries INTEGER,
+            bytes_sent INTEGER,
+            bytes_received INTEGER,
+            tokens_used INTEGER,
+            FOREIGN KEY (result_id) REFERENCES results(id) ON DELETE SET NULL
+        )
+    """)
+    
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_request_metrics_model_created ON request_metrics(model_id, created_at)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_request_metrics_created_at ON request_metrics(created_at)")
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_request_metrics_result_id ON request_metrics(result_id)")
+
+
+def get_schema_version() -> int:
+    """Текущая версия схемы БД (PRAGMA user_version; 0 - до появления миграций)."""
+    return get_connection().execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(progress: Optional[Callable[[str, int, int], None]] = None) -> int:
+    """
+    Применяет к БД все миграции новее ее текущей версии.
+    
+    Каждая миграция выполняется в своей транзакции (BEGIN IMMEDIATE), версия
+    перепроверяется внутри нее, поэтому одновременный запуск из нескольких
+    процессов безопасен. Заполнение новых таблиц по существующим строкам идет
+    порциями: между ними блокировка записи освобождается, а прогресс хранится
+    в schema_backfills, так что прерванная миграция продолжается с того же места.
+    Верхняя граница id фиксируется вместе с созданием триггеров, более новые
+    строки учитывают сами триггеры.
+    
+    Args:
+        progress: Функция progress(описание, сделано, всего), вызывается после
+            каждой порции (например, чтобы обновить окно прогресса)
+            
+    Returns:
+        Версия схемы после миграции
+    """
     conn = get_connection()
     cursor = conn.cursor()
     
     try:
-        # Таблица prompts
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS prompts (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                date TEXT NOT NULL,
-                prompt TEXT NOT NULL,
-                tags TEXT
-            )
-        """)
-        
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_prompts_date ON prompts(date)")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_prompts_tags ON prompts(tags)")
-        
-        # Таблица models
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS models (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                name TEXT NOT NULL UNIQUE,
-                api_url TEXT NOT NULL,
-                api_id TEXT NOT NULL,
-                is_active INTEGER NOT NULL DEFAULT 1,
-                model_type TEXT,
-                created_at TEXT NOT NULL
-            )
-        """)
-        
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_models_is_active ON models(is_active)")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_models_name ON models(name)")
-        
-        # Таблица results
         cursor.execute("""
-            CREATE TABLE IF NOT EXISTS results (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                prompt_id INTEGER NOT NULL,
-                model_id INTEGER NOT NULL,
-                response TEXT NOT NULL,
-                saved_at TEXT NOT NULL,
-                tokens_used INTEGER,
-                response_time REAL,
-                FOREIGN KEY (prompt_id) REFERENCES prompts(id) ON DELETE CASCADE,
-                FOREIGN KEY (model_id) REFERENCES models(id) ON DELETE CASCADE
+            CREATE TABLE IF NOT EXISTS schema_backfills (
+                version INTEGER NOT NULL,
+                name TEXT NOT NULL,
+                statements TEXT NOT NULL,
+                position INTEGER NOT NULL,
+                target INTEGER NOT NULL,
+                PRIMARY KEY (version, name)
             )
         """)
         
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_results_prompt_id ON results(prompt_id)")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_results_model_id ON results(model_id)")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_results_saved_at ON results(saved_at)")
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_results_prompt_model ON results(prompt_id, model_id)")
-        
-        # Таблица settings
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS settings (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                key TEXT NOT NULL UNIQUE,
-                value TEXT,
-                description TEXT,
-                updated_at TEXT NOT NULL
-            )
-        """)
-        
-        cursor.execute("CREATE INDEX IF NOT EXISTS idx_settings_key ON settings(key)")
-        
-        conn.commit()
-        
-        # Добавляем начальные данные, если таблицы пусты
-        _add_initial_data(cursor, conn)
+        for version, description, apply in MIGRATIONS:
+            cursor.execute("BEGIN IMMEDIATE")
+            if cursor.execute("PRAGMA user_version").fetchone()[0] >= version:
+                conn.rollback()
+                continue
+            for table, statements in apply(cursor) or []:
+                # Порядок id в таблице не меняется, поэтому граница задается максимальным id
+                target = cursor.execute(f"SELECT COALESCE(MAX(id), 0) FROM {table}").fetchone()[0]
+                cursor.execute("""
+                    INSERT OR IGNORE INTO schema_backfills (version, name, statements, position, target)
+                    VALUES (?, ?, ?, 0, ?)
+                """, (version, table, json.dumps(statements), target))
+            conn.commit()
+            
+            _run_backfills(conn, version, description, progress)
+            
+            cursor.execute("BEGIN IMMEDIATE")
+            cursor.execute(f"PRAGMA user_version = {int(version)}")
+            conn.commit()
         
+        return get_schema_version()
     except sqlite3.Error as e:
         conn.rollback()
-        raise Exception(f"Ошибка при инициализации БД: {e}")
-    finally:
-        conn.close()
+        raise Exception(f"Ошибка при миграции БД: {e}")
+
+
+def _run_backfills(conn: sqlite3.Connection, version: int, description: str,
+                   progress: Optional[Callable[[str, int, int], None]]) -> None:
+    """Выполняет незавершенные заполнения миграции version порциями, по транзакции на порцию."""
+    cursor = conn.cursor()
+    cursor.execute("SELECT name FROM schema_backfills WHERE version = ? ORDER BY name", (version,))
+    for name in [row['name'] for row in cursor.fetchall()]:
+        while True:
+            cursor.execute("BEGIN IMMEDIATE")
+            cursor.execute("SELECT statements, position, target FROM schema_backfills WHERE version = ? AND name = ?",
+                           (version, name))
+            row = cursor.fetchone()
+            if row['position'] >= row['target']:
+                cursor.execute("DELETE FROM schema_backfills WHERE version = ? AND name = ?", (version, name))
+                conn.commit()
+                break
+            high = min(row['position'] + MIGRATION_BATCH_SIZE, row['target'])
+            for statement in json.loads(row['statements']):
+                cursor.execute(statement, (row['position'], high))
+            cursor.execute("UPDATE schema_backfills SET position = ? WHERE version = ? AND name = ?",
+                           (high, version, name))
+            conn.commit()
+            if progress:
+                progress(description, high, row['target'])
+
+
+def _ensure_column(cursor: sqlite3.Cursor, table: str, column: str, definition: str) -> None:
+    """Добавляет столбец в существующую таблицу, если его там еще нет (для старых БД)."""
+    cursor.execute(f"PRAGMA table_info({table})")
+    if column not in {row['name'] for row in cursor.fetchall()}:
+        cursor.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+
+
+def _init_fulltext_search(cursor: sqlite3.Cursor) -> List[Tuple[str, List[str]]]:
+    """
+    Создает FTS5-индексы prompts_fts и results_fts и триггеры синхронизации.
+    
+    Индексы хранят только токены (external content), тексты берутся из
+    исходных таблиц. При первом создании возвращает заполнения индексов
+    существующими строками (см. MIGRATIONS).
+    """
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name IN ('prompts_fts', 'results_fts')")
+    existing = {row['name'] for row in cursor.fetchall()}
+    
+    cursor.execute(f"""
+        CREATE VIRTUAL TABLE IF NOT EXISTS prompts_fts USING fts5(
+            prompt, tags, content='prompts', content_rowid='id',
+            tokenize='{FTS_TOKENIZER}', prefix='{FTS_PREFIX_INDEX}'
+        )
+    """)
+    cursor.execute(f"""
+        CREATE VIRTUAL TABLE IF NOT EXISTS results_fts USING fts5(
+            response, content='results', content_rowid='id',
+            tokenize='{FTS_TOKENIZER}', prefix='{FTS_PREFIX_INDEX}'
+        )
+    """)
+    
+    # Триггеры поддерживают индексы в актуальном состоянии при любых изменениях
+    for trigger in (
+        """
+        CREATE TRIGGER IF NOT EXISTS prompts_fts_insert AFTER INSERT ON prompts BEGIN
+            INSERT INTO prompts_fts(rowid, prompt, tags) VALUES (new.id, new.prompt, new.tags);
+        END""",
+        """
+        CREATE TRIGGER IF NOT EXISTS prompts_fts_delete AFTER DELETE ON prompts BEGIN
+            INSERT INTO prompts_fts(prompts_fts, rowid, prompt, tags) VALUES ('delete', old.id, old.prompt, old.tags);
+        END""",
+        """
+        CREATE TRIGGER IF NOT EXISTS prompts_fts_update AFTER UPDATE OF prompt, tags ON prompts BEGIN
+            INSERT INTO prompts_fts(prompts_fts, rowid, prompt, tags) VALUES ('delete', old.id, old.prompt, old.tags);
+            INSERT INTO prompts_fts(rowid, prompt, tags) VALUES (new.id, new.prompt, new.tags);
+        END""",
+        """
+        CREATE TRIGGER IF NOT EXISTS results_fts_insert AFTER INSERT ON results BEGIN
+            INSERT INTO results_fts(rowid, response) VALUES (new.id, new.response);
+        END""",
+        """
+        CREATE TRIGGER IF NOT EXISTS results_fts_delete AFTER DELETE ON results BEGIN
+            INSERT INTO results_fts(results_fts, rowid, response) VALUES ('delete', old.id, old.response);
+        END""",
+        """
+        CREATE TRIGGER IF NOT EXISTS results_fts_update AFTER UPDATE OF response ON results BEGIN
+            INSERT INTO results_fts(results_fts, rowid, response) VALUES ('delete', old.id, old.response);
+            INSERT INTO results_fts(rowid, response) VALUES (new.id, new.response);
+        END""",
+    ):
+        cursor.execute(trigger)
+    
+    # Перенос существующих строк в только что созданные индексы
+    backfills = []
+    if 'prompts_fts' not in existing:
+        backfills.append(("prompts", [
+            "INSERT INTO prompts_fts(rowid, prompt, tags) SELECT id, prompt, tags FROM prompts WHERE id > ? AND id <= ?"
+        ]))
+    if 'results_fts' not in existing:
+        backfills.append(("results", [
+            "INSERT INTO results_fts(rowid, response) SELECT id, response FROM results WHERE id > ? AND id <= ?"
+        ]))
+    return backfills
+
+
+# Периоды агрегирования статистики: длина префикса saved_at / created_at ("YYYY-MM-DD HH:MM:SS")
+TREND_PERIODS = {'hour': 13, 'day': 10}
+
+# Верхние границы корзин гистограммы времени ответа в секундах; последняя корзина
+# (h{len(LATENCY_BUCKETS)}) - все, что дольше. После изменения границ агрегаты нужно
+# пересчитать через rebuild_rollups()
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 0.75, 1, 1.5, 2, 3, 4, 5, 7.5, 10, 15, 20, 30, 45, 60, 90, 120)
+
+ROLLUP_HISTOGRAM = tuple(f"h{index}" for index in range(len(LATENCY_BUCKETS) + 1))
+ROLLUP_COLUMNS = ('count', 'time_sum', 'time_min', 'time_max', 'tokens', 'tokens_time',
+                  'requests', 'errors', 'cached') + ROLLUP_HISTOGRAM
+
+
+def _latency_bucket_sql(value: str) -> str:
+    """SQL-выражение номера корзины гистограммы для времени ответа value."""
+    cases = " ".join(f"WHEN {value} < {bound} THEN {index}" for index, bound in enumerate(LATENCY_BUCKETS))
+    return f"(CASE {cases} ELSE {len(LATENCY_BUCKETS)} END)"
 
 
-def _add_initial_data(cursor: sqlite3.Cursor, conn: sqlite3.Connection) -> None:
+def _rollup_results_select(row: str, period: str) -> str:
+    """
+    SELECT, сворачивающий результаты в строки result_rollups для периода period.
+    
+    row - 'new'/'old' для одной строки в триггере или псевдоним results
+    при пересчете с GROUP BY.
+    """
+    bucket = _latency_bucket_sql(f"{row}.response_time")
+    histogram = ", ".join(f"SUM({bucket} = {index})" for index in range(len(ROLLUP_HISTOGRAM)))
+    return f"""
+        SELECT {row}.model_id, '{period}', substr({row}.saved_at, 1, {TREND_PERIODS[period]}),
+               COUNT(*), SUM({row}.response_time), MIN({row}.response_time), MAX({row}.response_time),
+               COALESCE(SUM({row}.tokens_used), 0),
+               COALESCE(SUM(CASE WHEN {row}.tokens_used IS NOT NULL THEN {row}.response_time END), 0),
+               0, 0, 0, {histogram}"""
+
+
+def _rollup_requests_select(row: str, period: str) -> str:
+    """SELECT, сворачивающий записи request_metrics в строки result_rollups (аналог _rollup_results_select)."""
+    histogram = ", ".join("0" for _ in ROLLUP_HISTOGRAM)
+    return f"""
+        SELECT {row}.model_id, '{period}', substr({row}.created_at, 1, {TREND_PERIODS[period]}),
+               0, 0, NULL, NULL, 0, 0,
+               COUNT(*), SUM({row}.success = 0), SUM({row}.cached), {histogram}"""
+
+
+# Слияние новой порции с уже накопленной строкой агрегата
+_ROLLUP_UPSERT = f"""
+    ON CONFLICT (model_id, period, bucket) DO UPDATE SET
+        count = count + excluded.count,
+        time_sum = time_sum + excluded.time_sum,
+        time_min = COALESCE(MIN(time_min, excluded.time_min), time_min, excluded.time_min),
+        time_max = COALESCE(MAX(time_max, excluded.time_max), time_max, excluded.time_max),
+        tokens = tokens + excluded.tokens,
+        tokens_time = tokens_time + excluded.tokens_time,
+        requests = requests + excluded.requests,
+        errors = errors + excluded.errors,
+        cached = cached + excluded.cached,
+        {", ".join(f"{column} = {column} + excluded.{column}" for column in ROLLUP_HISTOGRAM)}
+"""
+
+
+def _rollup_insert_sql(select: str, where: str, group_by: str) -> str:
+    """
+    INSERT ... SELECT в result_rollups со слиянием с существующими строками.
+    
+    GROUP BY обязателен и для триггеров: без него агрегатный SELECT вернул бы
+    пустую строку, даже если условие where не выполнено.
+    """
+    return f"""
+        INSERT INTO result_rollups (model_id, period, bucket, {', '.join(ROLLUP_COLUMNS)})
+        {select}
+        {where} {group_by}
+        {_ROLLUP_UPSERT}"""
+
+
+def _rollup_remove_results_sql(period: str) -> str:
+    """
+    Операторы триггера, вычитающие строку old таблицы results из агрегата периода.
+    
+    Минимум и максимум вычесть нельзя, поэтому, если удаляемое значение было
+    крайним, они пересчитываются по оставшимся результатам этого периода.
+    Опустевшая строка агрегата удаляется.
+    """
+    key = (f"model_id = old.model_id AND period = '{period}' "
+           f"AND bucket = substr(old.saved_at, 1, {TREND_PERIODS[period]})")
+    bucket = _latency_bucket_sql("old.response_time")
+    histogram = ", ".join(f"{column} = {column} - ({bucket} = {index})"
+                          for index, column in enumerate(ROLLUP_HISTOGRAM))
+    bucket_range = ("r.model_id = result_rollups.model_id "
+                    "AND r.saved_at >= result_rollups.bucket AND r.saved_at < result_rollups.bucket || '~'")
+    return f"""
+            UPDATE result_rollups SET
+                count = count - 1,
+                time_sum = time_sum - old.response_time,
+                tokens = tokens - COALESCE(old.tokens_used, 0),
+                tokens_time = tokens_time - (CASE WHEN old.tokens_used IS NOT NULL THEN old.response_time ELSE 0 END),
+                {histogram}
+            WHERE {key} AND old.response_time IS NOT NULL;
+            UPDATE result_rollups SET
+                time_min = (SELECT MIN(r.response_time) FROM results r WHERE {bucket_range}),
+                time_max = (SELECT MAX(r.response_time) FROM results r WHERE {bucket_range})
+            WHERE {key} AND old.response_time IS NOT NULL
+                AND (time_min >= old.response_time OR time_max <= old.response_time);
+            DELETE FROM result_rollups WHERE {key} AND count <= 0 AND requests <= 0;"""
+
+
+def _init_rollups(cursor: sqlite3.Cursor) -> List[Tuple[str, List[str]]]:
+    """
+    Создает таблицу агрегатов result_rollups и триггеры ее обновления.
+    
+    На каждую модель и каждый час/сутки хранится одна строка: число ответов,
+    сумма/минимум/максимум времени ответа, сумма токенов, гистограмма времени
+    ответа по корзинам LATENCY_BUCKETS, а также число запросов к API, ошибок и
+    ответов из кэша по request_metrics. Учитываются только результаты с известным
+    временем ответа. Триггеры поддерживают агрегаты при любых изменениях results и
+    request_metrics, поэтому статистика не читает исходные таблицы. При первом
+    создании возвращает заполнения агрегатов по существующим строкам.
+    """
+    cursor.execute("SELECT name FROM sqlite_master WHERE type = 'table' AND name = 'result_rollups'")
+    existing = cursor.fetchone() is not None
+    
+    histogram = ",\n".join(f"                {column} INTEGER NOT NULL DEFAULT 0" for column in ROLLUP_HISTOGRAM)
+    cursor.execute(f"""
+            CREATE TABLE IF NOT EXISTS result_rollups (
+                model_id INTEGER NOT NULL,
+                period TEXT NOT NULL,
+                bucket TEXT NOT NULL,
+                count INTEGER NOT NULL DEFAULT 0,
+                time_sum REAL NOT NULL DEFAULT 0,
+                time_min REAL,
+                time_max REAL,
+                tokens INTEGER NOT NULL DEFAULT 0,
+                tokens_time REAL NOT NULL DEFAULT 0,
+                requests INTEGER NOT NULL DEFAULT 0,
+                errors INTEGER NOT NULL DEFAULT 0,
+                cached INTEGER NOT NULL DEFAULT 0,
+{histogram},
+                PRIMARY KEY (model_id, period, bucket)
+            ) WITHOUT ROWID
+    """)
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_result_rollups_period ON result_rollups(period, bucket)")
+    
+    add_result = "".join(
+        _rollup_insert_sql(_rollup_results_select("new", period), "WHERE new.response_time IS NOT NULL",
+                           "GROUP BY new.model_id") + ";"
+        for period in TREND_PERIODS
+    )
+    remove_result = "".join(_rollup_remove_results_sql(period) for period in TREND_PERIODS)
+    add_request = "".join(
+        _rollup_insert_sql(_rollup_requests_select("new", period), "WHERE new.model_id IS NOT NULL",
+                           "GROUP BY new.model_id") + ";"
+        for period in TREND_PERIODS
+    )
+    remove_request = "".join(f"""
+            UPDATE result_rollups SET
+                requests = requests - 1,
+                errors = errors - (old.success = 0),
+                cached = cached - old.cached
+            WHERE model_id = old.model_id AND period = '{period}'
+                AND bucket = substr(old.created_at, 1, {length});
+            DELETE FROM result_rollups WHERE model_id = old.model_id AND period = '{period}'
+                AND bucket = substr(old.created_at, 1, {length}) AND count <= 0 AND requests <= 0;"""
+        for period, length in TREND_PERIODS.items()
+    )
+    
+    for trigger in (
+        f"""
+        CREATE TRIGGER IF NOT EXISTS result_rollups_insert AFTER INSERT ON results BEGIN{add_result}
+        END""",
+        f"""
+        CREATE TRIGGER IF NOT EXISTS result_rollups_delete AFTER DELETE ON results BEGIN{remove_result}
+        END""",
+        f"""
+        CREATE TRIGGER IF NOT EXISTS result_rollups_update
+        AFTER UPDATE OF model_id, saved_at, response_time, tokens_used ON results BEGIN{remove_result}{add_result}
+        END""",
+        f"""
+        CREATE TRIGGER IF NOT EXISTS request_rollups_insert AFTER INSERT ON request_metrics BEGIN{add_request}
+        END""",
+        f"""
+        CREATE TRIGGER IF NOT EXISTS request_rollups_delete AFTER DELETE ON request_metrics
+        WHEN old.model_id IS NOT NULL BEGIN{remove_request}
+        END""",
+    ):
+        cursor.execute(trigger)
+    
+    # Статистика читается из агрегатов, отдельный индекс по results больше не нужен
+    cursor.execute("DROP INDEX IF EXISTS idx_results_model_stats")
+    
+    # Перенос существующих данных в только что созданную таблицу
+    if existing:
+        return []
+    return list(_rollup_backfills().items())
+
+
+def _rollup_backfills() -> Dict[str, List[str]]:
+    """SQL заполнения result_rollups по диапазону id (low, high] для results и request_metrics."""
+    backfills = {'results': [], 'request_metrics': []}
+    for period, length in TREND_PERIODS.items():
+        backfills['results'].append(_rollup_insert_sql(
+            _rollup_results_select("r", period) + " FROM results r",
+            "WHERE r.response_time IS NOT NULL AND r.id > ? AND r.id <= ?",
+            f"GROUP BY r.model_id, substr(r.saved_at, 1, {length})"
+        ))
+        backfills['request_metrics'].append(_rollup_insert_sql(
+            _rollup_requests_select("m", period) + " FROM request_metrics m",
+            "WHERE m.model_id IS NOT NULL AND m.id > ? AND m.id <= ?",
+            f"GROUP BY m.model_id, substr(m.created_at, 1, {length})"
+        ))
+    return backfills
+
+
+def _fill_rollups(cursor: sqlite3.Cursor) -> None:
+    """Заполняет result_rollups полным пересчетом по results и request_metrics."""
+    for statements in _rollup_backfills().values():
+        for statement in statements:
+            cursor.execute(statement, (0, 2 ** 63 - 1))
+
+
+def _add_initial_data(cursor: sqlite3.Cursor) -> None:
     """Добавляет начальные данные в БД (примеры моделей и настройки)."""
     # Проверяем, есть ли уже модели
     cursor.execute("SELECT COUNT(*) as count FROM models")
@@ -156,14 +719,91 @@ def _add_initial_data(cursor: sqlite3.Cursor, conn: sqlite3.Connection) -> None:
         ("font_size", "10", "Размер шрифта панелей в пунктах", now),
         ("api_timeout", "30", "Таймаут запросов к API в секундах", now),
         ("default_export_format", "markdown", "Формат экспорта по умолчанию (markdown/json)", now),
+        ("response_cache_enabled", "0", "Кэшировать ответы моделей (0/1)", now),
+        ("response_cache_ttl", "86400", "Время жизни записи кэша ответов в секундах", now),
+        ("response_cache_max_mb", "100", "Максимальный размер кэша ответов в МБ", now),
+        ("rate_limit_key_rpm", "0", "Лимит запросов в минуту на один API-ключ (0 - без ограничения)", now),
+        ("rate_limit_key_tpm", "0", "Лимит токенов в минуту на один API-ключ (0 - без ограничения)", now),
+        ("rate_limit_model_rpm", "0", "Лимит запросов в минуту к одной модели (0 - без ограничения)", now),
+        ("rate_limit_model_tpm", "0", "Лимит токенов в минуту к одной модели (0 - без ограничения)", now),
+        ("request_metrics_enabled", "1", "Записывать разбивку времени запросов к API (0/1)", now),
+        ("hedge_budget_percent", "10", "Доля дублирующих запросов при хеджировании в процентах от числа запросов", now),
+        ("adaptive_concurrency_enabled", "1", "Подбирать число одновременных запросов к API по задержке и ошибкам (0/1)", now),
+        ("adaptive_concurrency_initial", "8", "Начальное число одновременных запросов к одному хосту API", now),
+        ("circuit_breaker_enabled", "1", "Не отправлять запросы к модели, недоступной по последним ошибкам (0/1)", now),
     ]
     
     cursor.executemany("""
         INSERT INTO settings (key, value, description, updated_at)
         VALUES (?, ?, ?, ?)
     """, initial_settings)
+
+
+def _migration_batch_jobs(cursor: sqlite3.Cursor) -> None:
+    """
+    Пакетные запуски: матрица промтов и моделей, развернутая в задания.
+    
+    Задание выполнено, когда его результат сохранен (result_id) или записана
+    ошибка; незавершенные задания остаются в статусе 'pending' и выполняются
+    при возобновлении запуска.
+    """
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS batch_runs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT,
+            created_at TEXT NOT NULL,
+            finished_at TEXT,
+            total INTEGER NOT NULL DEFAULT 0
+        )
+    """)
+    
+    cursor.execute("""
+        CREATE TABLE IF NOT EXISTS batch_jobs (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            run_id INTEGER NOT NULL,
+            prompt_id INTEGER NOT NULL,
+            model_id INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'pending',
+            result_id INTEGER,
+            error TEXT,
+            updated_at TEXT,
+            UNIQUE (run_id, prompt_id, model_id),
+            FOREIGN KEY (run_id) REFERENCES batch_runs(id) ON DELETE CASCADE
+        )
+    """)
     
-    conn.commit()
+    cursor.execute("CREATE INDEX IF NOT EXISTS idx_batch_jobs_run_status ON batch_jobs(run_id, status)")
+
+
+def _migration_request_metrics_retryable(cursor: sqlite3.Cursor) -> None:
+    """
+    Признак временной ошибки запроса (429, 5xx, таймаут, обрыв соединения): по нему
+    предохранитель моделей отличает недоступность модели от ошибок запроса.
+    NULL - успешный запрос или запись, сделанная до этой миграции.
+    """
+    _ensure_column(cursor, "request_metrics", "retryable", "INTEGER")
+
+
+# Миграции в порядке применения: (версия, описание, функция). Функция выполняется
+# в транзакции, должна быть идемпотентной (базы без user_version уже могут содержать
+# часть изменений) и может вернуть список заполнений [(таблица, [SQL, ...]), ...]:
+# каждый SQL принимает границы диапазона id (low, high] строк таблицы и выполняется
+# порциями по MIGRATION_BATCH_SIZE отдельными транзакциями. Существующие миграции
+# не меняются - изменения схемы добавляются новой миграцией в конец списка.
+MIGRATIONS = [
+    (1, "Основные таблицы", _migration_base_schema),
+    (2, "Полнотекстовый поиск", _init_fulltext_search),
+    (3, "Индекс истории результатов", _migration_results_pagination),
+    (4, "Кэш ответов", _migration_response_cache),
+    (5, "Имена моделей для маршрутизации", _migration_resolved_name),
+    (6, "Хеджирование запросов", _migration_models_hedge),
+    (7, "Метрики запросов", _migration_request_metrics),
+    (8, "Агрегаты статистики моделей", _init_rollups),
+    (9, "Пакетные запуски", _migration_batch_jobs),
+    (10, "Временные ошибки в метриках запросов", _migration_request_metrics_retryable),
+]
+
+SCHEMA_VERSION = MIGRATIONS[-1][0]
 
 
 # ==================== Функции для работы с таблицей prompts ====================
@@ -184,8 +824,6 @@ def create_prompt(prompt_text: str, tags: Optional[str] = None) -> int:
     except sqlite3.Error as e:
         conn.rollback()
         raise Exception(f"Ошибка при создании промта: {e}")
-    finally:
-        conn.close()
 
 
 def get_prompt(prompt_id: int) -> Optional[Dict]:
@@ -193,12 +831,9 @@ def get_prompt(prompt_id: int) -> Optional[Dict]:
     conn = get_connection()
     cursor = conn.cursor()
     
-    try:
-        cursor.execute("SELECT * FROM prompts WHERE id = ?", (prompt_id,))
-        row = cursor.fetchone()
-        return dict(row) if row else None
-    finally:
-        conn.close()
+    cursor.execute("SELECT * FROM prompts WHERE id = ?", (prompt_id,))
+    row = cursor.fetchone()
+    return dict(row) if row else None
 
 
 def get_all_prompts() -> List[Dict]:
@@ -206,39 +841,131 @@ def get_all_prompts() -> List[Dict]:
     conn = get_connection()
     cursor = conn.cursor()
     
-    try:
-        cursor.execute("SELECT * FROM prompts ORDER BY date DESC")
-        return [dict(row) for row in cursor.fetchall()]
-    finally:
-        conn.close()
+    cursor.execute("SELECT * FROM prompts ORDER BY date DESC")
+    return [dict(row) for row in cursor.fetchall()]
 
 
 def search_prompts(query: str = None, tags: str = None) -> List[Dict]:
-    """Поиск промтов по тексту или тегам."""
+    """Ищет промты по тексту и тегам (полнотекстовый поиск по началу слов)."""
+    if not _fts_terms(query) and not _fts_terms(tags):
+        return get_all_prompts()
+    return search(query, scope="prompts", tags=tags, limit=None)
+
+
+def _fts_terms(text: Optional[str]) -> str:
+    """
+    Превращает пользовательский ввод в выражение FTS5.
+    
+    Каждое слово берется в кавычки (служебные символы FTS5 не интерпретируются)
+    и ищется по префиксу; слова объединяются через AND.
+    """
+    if not text:
+        return ""
+    words = text.split()
+    return " ".join('"' + word.replace('"', '""') + '"*' for word in words)
+
+
+def _fts_match(columns: str, query: Optional[str], tags: Optional[str] = None) -> str:
+    """Собирает выражение MATCH с фильтрами по столбцам."""
+    parts = []
+    if _fts_terms(query):
+        parts.append(f"{columns} : ({_fts_terms(query)})")
+    if _fts_terms(tags):
+        parts.append(f"tags : ({_fts_terms(tags)})")
+    return " AND ".join(parts)
+
+
+def search(query: str, scope: str = "prompts", tags: str = None,
+           limit: Optional[int] = 100) -> List[Dict]:
+    """
+    Ранжированный полнотекстовый поиск.
+    
+    scope="prompts" - поиск по тексту промтов (и по тегам, если задан tags);
+    scope="results" - поиск по ответам моделей и по тексту их промтов.
+    Результаты отсортированы по релевантности (bm25), поле snippet содержит
+    фрагмент текста, где совпадения выделены SNIPPET_START/SNIPPET_END.
+    limit=None - без ограничения (в SQL передается -1).
+    """
     conn = get_connection()
     cursor = conn.cursor()
     
+    if scope == "prompts":
+        match = _fts_match("prompt", query, tags)
+        if not match:
+            return []
+        sql = f"""
+            SELECT p.*, snippet(prompts_fts, 0, ?, ?, '…', {SNIPPET_TOKENS}) AS snippet,
+                   bm25(prompts_fts) AS rank
+            FROM prompts_fts
+            JOIN prompts p ON p.id = prompts_fts.rowid
+            WHERE prompts_fts MATCH ?
+            ORDER BY rank
+            LIMIT ?
+        """
+        params = [SNIPPET_START, SNIPPET_END, match, -1 if limit is None else limit]
+    elif scope == "results":
+        terms = _fts_terms(query)
+        if not terms:
+            return []
+        # Сначала отбираются лучшие по рангу совпадения в ответах и в тексте
+        # промтов, и только для них строятся превью и фрагменты: стоимость
+        # запроса не растет с числом совпадений частого слова
+        sql = f"""
+            WITH response_hits AS (
+                SELECT rowid AS id, rank, 0 AS source
+                FROM results_fts WHERE results_fts MATCH :match
+                ORDER BY rank LIMIT :limit
+            ),
+            prompt_hits AS (
+                SELECT r.id, ph.rank, 1 AS source
+                FROM (
+                    SELECT rowid AS prompt_id, rank
+                    FROM prompts_fts WHERE prompts_fts MATCH :prompt_match
+                    ORDER BY rank LIMIT :limit
+                ) ph
+                JOIN results r ON r.prompt_id = ph.prompt_id
+            ),
+            hits AS (
+                SELECT id, MIN(rank) AS rank, source
+                FROM (SELECT * FROM response_hits UNION ALL SELECT * FROM prompt_hits)
+                GROUP BY id
+                ORDER BY rank LIMIT :limit
+            )
+            SELECT r.id, r.prompt_id, r.model_id, r.saved_at, r.tokens_used, r.response_time,
+                   m.name AS model_name, substr(p.prompt, 1, {PREVIEW_LENGTH}) AS prompt_text,
+                   substr(r.response, 1, {PREVIEW_LENGTH}) AS response_preview,
+                   CASE h.source
+                       WHEN 0 THEN (
+                           SELECT snippet(results_fts, 0, :start, :end, '…', {SNIPPET_TOKENS})
+                           FROM results_fts WHERE results_fts MATCH :match AND rowid = h.id
+                       )
+                       ELSE (
+                           SELECT snippet(prompts_fts, 0, :start, :end, '…', {SNIPPET_TOKENS})
+                           FROM prompts_fts WHERE prompts_fts MATCH :prompt_match AND rowid = r.prompt_id
+                       )
+                   END AS snippet,
+                   h.rank
+            FROM hits h
+            JOIN results r ON r.id = h.id
+            JOIN models m ON r.model_id = m.id
+            JOIN prompts p ON r.prompt_id = p.id
+            ORDER BY h.rank
+        """
+        params = {
+            'match': terms,
+            'prompt_match': f"prompt : ({terms})",
+            'start': SNIPPET_START,
+            'end': SNIPPET_END,
+            'limit': -1 if limit is None else limit,
+        }
+    else:
+        raise ValueError(f"Неизвестная область поиска: {scope}")
+    
     try:
-        conditions = []
-        params = []
-        
-        if query:
-            conditions.append("prompt LIKE ?")
-            params.append(f"%{query}%")
-        
-        if tags:
-            conditions.append("tags LIKE ?")
-            params.append(f"%{tags}%")
-        
-        sql = "SELECT * FROM prompts"
-        if conditions:
-            sql += " WHERE " + " AND ".join(conditions)
-        sql += " ORDER BY date DESC"
-        
         cursor.execute(sql, params)
-        return [dict(row) for row in cursor.fetchall()]
-    finally:
-        conn.close()
+    except sqlite3.OperationalError as e:
+        raise Exception(f"Ошибка полнотекстового поиска: {e}")
+    return [dict(row) for row in cursor.fetchall()]
 
 
 def update_prompt(prompt_id: int, prompt_text: str = None, tags: str = None) -> bool:
@@ -268,8 +995,6 @@ def update_prompt(prompt_id: int, prompt_text: str = None, tags: str = None) ->
     except sqlite3.Error as e:
         conn.rollback()
         raise Exception(f"Ошибка при обновлении промта: {e}")
-    finally:
-        conn.close()
 
 
 def delete_prompt(prompt_id: int) -> bool:
@@ -284,13 +1009,12 @@ def delete_prompt(prompt_id: int) -> bool:
     except sqlite3.Error as e:
         conn.rollback()
         raise Exception(f"Ошибка при удалении промта: {e}")
-    finally:
-        conn.close()
 
 
 # ==================== Функции для работы с таблицей models ====================
 
-def create_model(name: str, api_url: str, api_id: str, model_type: str = None, is_active: int = 1) -> int:
+def create_model(name: str, api_url: str, api_id: str, model_type: str = None, is_active: int = 1,
+                 hedge: int = 0) -> int:
     """Создает новую модель и возвращает ее ID."""
     conn = get_connection()
     cursor = conn.cursor()
@@ -298,16 +1022,14 @@ def create_model(name: str, api_url: str, api_id: str, model_type: str = None, i
     try:
         created_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
         cursor.execute("""
-            INSERT INTO models (name, api_url, api_id, is_active, model_type, created_at)
-            VALUES (?, ?, ?, ?, ?, ?)
-        """, (name, api_url, api_id, is_active, model_type, created_at))
+            INSERT INTO models (name, api_url, api_id, is_active, model_type, created_at, hedge)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, (name, api_url, api_id, is_active, model_type, created_at, hedge))
         conn.commit()
         return cursor.lastrowid
     except sqlite3.Error as e:
         conn.rollback()
         raise Exception(f"Ошибка при создании модели: {e}")
-    finally:
-        conn.close()
 
 
 def get_model(model_id: int) -> Optional[Dict]:
@@ -315,12 +1037,9 @@ def get_model(model_id: int) -> Optional[Dict]:
     conn = get_connection()
     cursor = conn.cursor()
     
-    try:
-        cursor.execute("SELECT * FROM models WHERE id = ?", (model_id,))
-        row = cursor.fetchone()
-        return dict(row) if row else None
-    finally:
-        conn.close()
+    cursor.execute("SELECT * FROM models WHERE id = ?", (model_id,))
+    row = cursor.fetchone()
+    return dict(row) if row else None
 
 
 def get_all_models() -> List[Dict]:
@@ -328,11 +1047,8 @@ def get_all_models() -> List[Dict]:
     conn = get_connection()
     cursor = conn.cursor()
     
-    try:
-        cursor.execute("SELECT * FROM models ORDER BY name")
-        return [dict(row) for row in cursor.fetchall()]
-    finally:
-        conn.close()
+    cursor.execute("SELECT * FROM models ORDER BY name")
+    return [dict(row) for row in cursor.fetchall()]
 
 
 def get_active_models() -> List[Dict]:
@@ -340,16 +1056,19 @@ def get_active_models() -> List[Dict]:
     conn = get_connection()
     cursor = conn.cursor()
     
-    try:
-        cursor.execute("SELECT * FROM models WHERE is_active = 1 ORDER BY name")
-        return [dict(row) for row in cursor.fetchall()]
-    finally:
-        conn.close()
+    cursor.execute("SELECT * FROM models WHERE is_active = 1 ORDER BY name")
+    return [dict(row) for row in cursor.fetchall()]
 
 
 def update_model(model_id: int, name: str = None, api_url: str = None, 
-                 api_id: str = None, is_active: int = None, model_type: str = None) -> bool:
-    """Обновляет модель."""
+                 api_id: str = None, is_active: int = None, model_type: str = None,
+                 hedge: int = None) -> bool:
+    """
+    Обновляет модель.
+    
+    При изменении названия или типа модели сбрасывается вычисленное имя
+    для маршрутизации (resolved_name), оно будет вычислено заново.
+    """
     conn = get_connection()
     cursor = conn.cursor()
     
@@ -357,6 +1076,8 @@ def update_model(model_id: int, name: str = None, api_url: str = None,
         updates = []
         params = []
         
+        if name is not None or model_type is not None:
+            updates.append("resolved_name = NULL")
         if name is not None:
             updates.append("name = ?")
             params.append(name)
@@ -372,6 +1093,9 @@ def update_model(model_id: int, name: str = None, api_url: str = None,
         if model_type is not None:
             updates.append("model_type = ?")
             params.append(model_type)
+        if hedge is not None:
+            updates.append("hedge = ?")
+            params.append(hedge)
         
         if not updates:
             return False
@@ -383,8 +1107,47 @@ def update_model(model_id: int, name: str = None, api_url: str = None,
     except sqlite3.Error as e:
         conn.rollback()
         raise Exception(f"Ошибка при обновлении модели: {e}")
-    finally:
-        conn.close()
+
+
+def set_models_resolved_names(resolved_names: Dict[int, str]) -> None:
+    """Сохраняет вычисленные имена моделей для маршрутизации ({id модели: имя})."""
+    if not resolved_names:
+        return
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    try:
+        cursor.executemany("UPDATE models SET resolved_name = ? WHERE id = ?",
+                           [(name, model_id) for model_id, name in resolved_names.items()])
+        conn.commit()
+    except sqlite3.Error as e:
+        conn.rollback()
+        raise Exception(f"Ошибка при сохранении имен моделей: {e}")
+
+
+def get_models_response_times(model_ids: List[int], limit: int = 200) -> Dict[int, List[float]]:
+    """
+    Получает время ответа последних сохраненных результатов по каждой модели.
+    
+    Выборка идет по индексу (model_id, saved_at), поэтому не зависит от общего
+    размера таблицы results.
+    
+    Returns:
+        Словарь {id модели: список времен ответа в секундах, от новых к старым}
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    response_times = {}
+    for model_id in model_ids:
+        cursor.execute("""
+            SELECT response_time FROM results
+            WHERE model_id = ? AND response_time IS NOT NULL
+            ORDER BY saved_at DESC
+            LIMIT ?
+        """, (model_id, limit))
+        response_times[model_id] = [row['response_time'] for row in cursor.fetchall()]
+    return response_times
 
 
 def delete_model(model_id: int) -> bool:
@@ -399,8 +1162,6 @@ def delete_model(model_id: int) -> bool:
     except sqlite3.Error as e:
         conn.rollback()
         raise Exception(f"Ошибка при удалении модели: {e}")
-    finally:
-        conn.close()
 
 
 # ==================== Функции для работы с таблицей results ====================
@@ -422,8 +1183,152 @@ def create_result(prompt_id: int, model_id: int, response: str,
     except sqlite3.Error as e:
         conn.rollback()
         raise Exception(f"Ошибка при создании результата: {e}")
-    finally:
-        conn.close()
+
+
+def create_results_bulk(results: List[Dict]) -> Tuple[List[Optional[int]], List[Tuple[int, str]]]:
+    """
+    Сохраняет список результатов одной транзакцией.
+
+    Каждый элемент - словарь с ключами prompt_id, model_id, response и
+    необязательными tokens_used, response_time, saved_at (для импорта
+    исторических данных) и request_id (ключ записи в request_metrics,
+    которая связывается с сохраненным результатом). Строки с ошибками
+    пропускаются, остальные сохраняются одним executemany и одним commit.
+
+    Возвращает кортеж (ids, errors): ids - список ID в порядке входных
+    строк (None для пропущенных), errors - список (индекс строки, описание).
+    """
+    if not results:
+        return [], []
+
+    conn = get_connection()
+    cursor = conn.cursor()
+
+    try:
+        # IMMEDIATE сразу берет блокировку записи: проверка ссылок и вставка
+        # видят одно состояние БД, а ID новых строк идут подряд
+        cursor.execute("BEGIN IMMEDIATE")
+        ids, errors = _insert_results(cursor, results)
+        conn.commit()
+        return ids, errors
+    except sqlite3.Error as e:
+        conn.rollback()
+        raise Exception(f"Ошибка при сохранении результатов: {e}")
+
+
+def _insert_results(cursor: sqlite3.Cursor, results: List[Dict]) -> Tuple[List[Optional[int]], List[Tuple[int, str]]]:
+    """Вставка результатов для create_results_bulk в уже открытой транзакции записи."""
+    ids: List[Optional[int]] = [None] * len(results)
+    errors: List[Tuple[int, str]] = []
+    now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    prompt_ids = {r.get('prompt_id') for r in results}
+    model_ids = {r.get('model_id') for r in results}
+    known_prompts = _existing_ids(cursor, "prompts", prompt_ids)
+    known_models = _existing_ids(cursor, "models", model_ids)
+
+    rows = []
+    indexes = []
+    for index, result in enumerate(results):
+        if result.get('prompt_id') not in known_prompts:
+            errors.append((index, f"Промт с ID {result.get('prompt_id')} не найден"))
+        elif result.get('model_id') not in known_models:
+            errors.append((index, f"Модель с ID {result.get('model_id')} не найдена"))
+        elif not result.get('response'):
+            errors.append((index, "Пустой ответ"))
+        else:
+            rows.append((result['prompt_id'], result['model_id'], result['response'],
+                         result.get('saved_at') or now, result.get('tokens_used'),
+                         result.get('response_time')))
+            indexes.append(index)
+
+    if rows:
+        cursor.executemany("""
+            INSERT INTO results (prompt_id, model_id, response, saved_at, tokens_used, response_time)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, rows)
+        cursor.execute("SELECT last_insert_rowid()")
+        first_id = cursor.fetchone()[0] - len(rows) + 1
+        for offset, index in enumerate(indexes):
+            ids[index] = first_id + offset
+
+        links = [(ids[index], results[index]['request_id'])
+                 for index in indexes if results[index].get('request_id')]
+        if links:
+            cursor.executemany("UPDATE request_metrics SET result_id = ? WHERE request_id = ?", links)
+
+    return ids, errors
+
+
+REQUEST_METRICS_COLUMNS = (
+    'request_id', 'model_id', 'model_name', 'created_at', 'success', 'status', 'error',
+    'cached', 'streamed', 'hedged', 'queue_wait', 'connect', 'ttfb', 'download', 'parse',
+    'total', 'retries', 'bytes_sent', 'bytes_received', 'tokens_used', 'retryable',
+)
+
+
+def create_request_metrics_bulk(rows: List[Dict]) -> None:
+    """
+    Сохраняет метрики запросов к API одной транзакцией.
+    
+    Каждый элемент - словарь с ключами из REQUEST_METRICS_COLUMNS (отсутствующие
+    ключи сохраняются как NULL). Повторный request_id игнорируется.
+    """
+    if not rows:
+        return
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    try:
+        cursor.executemany(f"""
+            INSERT OR IGNORE INTO request_metrics ({', '.join(REQUEST_METRICS_COLUMNS)})
+            VALUES ({', '.join('?' * len(REQUEST_METRICS_COLUMNS))})
+        """, [tuple(row.get(column) for column in REQUEST_METRICS_COLUMNS) for row in rows])
+        conn.commit()
+    except sqlite3.Error as e:
+        conn.rollback()
+        raise Exception(f"Ошибка при сохранении метрик запросов: {e}")
+
+
+def get_recent_request_outcomes(model_ids: List[int], since: str, limit: int = 20) -> Dict[int, List[bool]]:
+    """
+    Получает исходы последних запросов к API по каждой модели (для предохранителя моделей).
+    
+    Учитываются запросы не раньше since ("YYYY-MM-DD HH:MM:SS") без ответов
+    из кэша. Неудачей считается только недоступность модели - временная
+    ошибка, кроме 429 (то же правило, что network.CircuitBreaker.is_outage);
+    прочие ошибки (неверный ключ, формат ответа и т.п.) и ошибки, записанные
+    до появления столбца retryable, пропускаются.
+    
+    Returns:
+        Словарь {id модели: список исходов (True - успех), от новых к старым}
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    outcomes = {}
+    for model_id in model_ids:
+        cursor.execute("""
+            SELECT success FROM request_metrics
+            WHERE model_id = ? AND created_at >= ? AND cached = 0
+                AND (success = 1 OR (retryable = 1 AND (status IS NULL OR status <> 429)))
+            ORDER BY created_at DESC
+            LIMIT ?
+        """, (model_id, since, limit))
+        outcomes[model_id] = [bool(row['success']) for row in cursor.fetchall()]
+    return outcomes
+
+
+def _existing_ids(cursor: sqlite3.Cursor, table: str, ids: set) -> set:
+    """Возвращает подмножество ids, которые есть в таблице table."""
+    ids = [i for i in ids if isinstance(i, int)]
+    found = set()
+    # Ограничение SQLite на число параметров запроса
+    for start in range(0, len(ids), 500):
+        chunk = ids[start:start + 500]
+        placeholders = ", ".join("?" * len(chunk))
+        cursor.execute(f"SELECT id FROM {table} WHERE id IN ({placeholders})", chunk)
+        found.update(row['id'] for row in cursor.fetchall())
+    return found
 
 
 def get_result(result_id: int) -> Optional[Dict]:
@@ -431,12 +1336,25 @@ def get_result(result_id: int) -> Optional[Dict]:
     conn = get_connection()
     cursor = conn.cursor()
     
-    try:
-        cursor.execute("SELECT * FROM results WHERE id = ?", (result_id,))
-        row = cursor.fetchone()
-        return dict(row) if row else None
-    finally:
-        conn.close()
+    cursor.execute("SELECT * FROM results WHERE id = ?", (result_id,))
+    row = cursor.fetchone()
+    return dict(row) if row else None
+
+
+def get_result_details(result_id: int) -> Optional[Dict]:
+    """Получает результат по ID вместе с названием модели и текстом промта."""
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    cursor.execute("""
+        SELECT r.*, m.name as model_name, p.prompt as prompt_text
+        FROM results r
+        JOIN models m ON r.model_id = m.id
+        JOIN prompts p ON r.prompt_id = p.id
+        WHERE r.id = ?
+    """, (result_id,))
+    row = cursor.fetchone()
+    return dict(row) if row else None
 
 
 def get_results_by_prompt(prompt_id: int) -> List[Dict]:
@@ -444,18 +1362,15 @@ def get_results_by_prompt(prompt_id: int) -> List[Dict]:
     conn = get_connection()
     cursor = conn.cursor()
     
-    try:
-        cursor.execute("""
-            SELECT r.*, m.name as model_name, p.prompt as prompt_text
-            FROM results r
-            JOIN models m ON r.model_id = m.id
-            JOIN prompts p ON r.prompt_id = p.id
-            WHERE r.prompt_id = ?
-            ORDER BY r.saved_at DESC
-        """, (prompt_id,))
-        return [dict(row) for row in cursor.fetchall()]
-    finally:
-        conn.close()
+    cursor.execute("""
+        SELECT r.*, m.name as model_name, p.prompt as prompt_text
+        FROM results r
+        JOIN models m ON r.model_id = m.id
+        JOIN prompts p ON r.prompt_id = p.id
+        WHERE r.prompt_id = ?
+        ORDER BY r.saved_at DESC
+    """, (prompt_id,))
+    return [dict(row) for row in cursor.fetchall()]
 
 
 def get_all_results() -> List[Dict]:
@@ -463,17 +1378,60 @@ def get_all_results() -> List[Dict]:
     conn = get_connection()
     cursor = conn.cursor()
     
-    try:
-        cursor.execute("""
-            SELECT r.*, m.name as model_name, p.prompt as prompt_text
-            FROM results r
-            JOIN models m ON r.model_id = m.id
-            JOIN prompts p ON r.prompt_id = p.id
-            ORDER BY r.saved_at DESC
-        """)
-        return [dict(row) for row in cursor.fetchall()]
-    finally:
-        conn.close()
+    cursor.execute("""
+        SELECT r.*, m.name as model_name, p.prompt as prompt_text
+        FROM results r
+        JOIN models m ON r.model_id = m.id
+        JOIN prompts p ON r.prompt_id = p.id
+        ORDER BY r.saved_at DESC
+    """)
+    return [dict(row) for row in cursor.fetchall()]
+
+
+def get_results_page(after_key: Optional[Tuple[str, int]] = None, limit: int = 200,
+                     filters: Optional[Dict] = None) -> List[Dict]:
+    """
+    Возвращает страницу результатов, от новых к старым, без полных текстов.
+    
+    Пагинация по ключу (saved_at, id): after_key - ключ последней строки
+    предыдущей страницы (None - первая страница). Вместо полных текстов
+    возвращаются превью prompt_text и response_preview, поэтому стоимость
+    страницы не зависит от размера истории. filters может содержать
+    model_id и prompt_id.
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    conditions = []
+    params = []
+    
+    if after_key is not None:
+        conditions.append("(r.saved_at, r.id) < (?, ?)")
+        params.extend(after_key)
+    
+    filters = filters or {}
+    if filters.get('model_id') is not None:
+        conditions.append("r.model_id = ?")
+        params.append(filters['model_id'])
+    if filters.get('prompt_id') is not None:
+        conditions.append("r.prompt_id = ?")
+        params.append(filters['prompt_id'])
+    
+    sql = f"""
+        SELECT r.id, r.prompt_id, r.model_id, r.saved_at, r.tokens_used, r.response_time,
+               m.name AS model_name, substr(p.prompt, 1, {PREVIEW_LENGTH}) AS prompt_text,
+               substr(r.response, 1, {PREVIEW_LENGTH}) AS response_preview
+        FROM results r
+        JOIN models m ON r.model_id = m.id
+        JOIN prompts p ON r.prompt_id = p.id
+    """
+    if conditions:
+        sql += " WHERE " + " AND ".join(conditions)
+    sql += " ORDER BY r.saved_at DESC, r.id DESC LIMIT ?"
+    params.append(limit)
+    
+    cursor.execute(sql, params)
+    return [dict(row) for row in cursor.fetchall()]
 
 
 def delete_result(result_id: int) -> bool:
@@ -488,8 +1446,6 @@ def delete_result(result_id: int) -> bool:
     except sqlite3.Error as e:
         conn.rollback()
         raise Exception(f"Ошибка при удалении результата: {e}")
-    finally:
-        conn.close()
 
 
 # ==================== Функции для работы с таблицей settings ====================
@@ -499,12 +1455,9 @@ def get_setting(key: str) -> Optional[str]:
     conn = get_connection()
     cursor = conn.cursor()
     
-    try:
-        cursor.execute("SELECT value FROM settings WHERE key = ?", (key,))
-        row = cursor.fetchone()
-        return row['value'] if row else None
-    finally:
-        conn.close()
+    cursor.execute("SELECT value FROM settings WHERE key = ?", (key,))
+    row = cursor.fetchone()
+    return row['value'] if row else None
 
 
 def set_setting(key: str, value: str, description: str = None) -> None:
@@ -526,8 +1479,6 @@ def set_setting(key: str, value: str, description: str = None) -> None:
     except sqlite3.Error as e:
         conn.rollback()
         raise Exception(f"Ошибка при установке настройки: {e}")
-    finally:
-        conn.close()
 
 
 def get_all_settings() -> List[Dict]:
@@ -535,11 +1486,8 @@ def get_all_settings() -> List[Dict]:
     conn = get_connection()
     cursor = conn.cursor()
     
-    try:
-        cursor.execute("SELECT * FROM settings ORDER BY key")
-        return [dict(row) for row in cursor.fetchall()]
-    finally:
-        conn.close()
+    cursor.execute("SELECT * FROM settings ORDER BY key")
+    return [dict(row) for row in cursor.fetchall()]
 
 
 def delete_setting(key: str) -> bool:
@@ -554,6 +1502,539 @@ def delete_setting(key: str) -> bool:
     except sqlite3.Error as e:
         conn.rollback()
         raise Exception(f"Ошибка при удалении настройки: {e}")
+
+
+# ==================== Функции для работы с кэшем ответов ====================
+
+def get_cached_response(key: str) -> Optional[Dict]:
+    """Получает запись кэша ответов по ключу."""
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    cursor.execute("SELECT * FROM response_cache WHERE key = ?", (key,))
+    row = cursor.fetchone()
+    return dict(row) if row else None
+
+
+def put_cached_response(key: str, model: str, response: str, tokens_used: int = None,
+                        response_time: float = None, now: float = None) -> int:
+    """Сохраняет (или заменяет) запись кэша ответов и возвращает ее размер в байтах."""
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    size = len(response.encode('utf-8')) + len(key) + len(model)
+    now = now if now is not None else datetime.now().timestamp()
+    try:
+        cursor.execute("""
+            INSERT OR REPLACE INTO response_cache
+                (key, model, response, tokens_used, response_time, size, created_at, last_used)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """, (key, model, response, tokens_used, response_time, size, now, now))
+        conn.commit()
+        return size
+    except sqlite3.Error as e:
+        conn.rollback()
+        raise Exception(f"Ошибка при сохранении ответа в кэш: {e}")
+
+
+def touch_cached_response(key: str, now: float) -> None:
+    """Отмечает использование записи кэша (для вытеснения давно неиспользуемых)."""
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute("UPDATE response_cache SET last_used = ? WHERE key = ?", (now, key))
+        conn.commit()
+    except sqlite3.Error as e:
+        conn.rollback()
+        raise Exception(f"Ошибка при обновлении кэша ответов: {e}")
+
+
+def delete_cached_response(key: str) -> None:
+    """Удаляет запись кэша ответов."""
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute("DELETE FROM response_cache WHERE key = ?", (key,))
+        conn.commit()
+    except sqlite3.Error as e:
+        conn.rollback()
+        raise Exception(f"Ошибка при удалении из кэша ответов: {e}")
+
+
+def get_response_cache_size() -> int:
+    """Возвращает суммарный размер записей кэша ответов в байтах."""
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    cursor.execute("SELECT COALESCE(SUM(size), 0) AS total FROM response_cache")
+    return cursor.fetchone()['total']
+
+
+def evict_cached_responses(bytes_to_free: int, expired_before: float = None) -> int:
+    """
+    Удаляет устаревшие записи (created_at < expired_before), затем давно
+    неиспользуемые записи, пока не будет освобождено bytes_to_free байт.
+    
+    Возвращает количество освобожденных байт.
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    try:
+        freed = 0
+        if expired_before is not None:
+            cursor.execute("SELECT COALESCE(SUM(size), 0) AS total FROM response_cache WHERE created_at < ?",
+                           (expired_before,))
+            freed = cursor.fetchone()['total']
+            cursor.execute("DELETE FROM response_cache WHERE created_at < ?", (expired_before,))
+        
+        if freed < bytes_to_free:
+            # Записи по возрастанию last_used, пока не наберется нужный объем
+            cursor.execute("SELECT key, size FROM response_cache ORDER BY last_used")
+            keys = []
+            for row in cursor.fetchall():
+                if freed >= bytes_to_free:
+                    break
+                keys.append((row['key'],))
+                freed += row['size']
+            cursor.executemany("DELETE FROM response_cache WHERE key = ?", keys)
+        
+        conn.commit()
+        return freed
+    except sqlite3.Error as e:
+        conn.rollback()
+        raise Exception(f"Ошибка при очистке кэша ответов: {e}")
+
+
+def clear_response_cache() -> None:
+    """Удаляет все записи кэша ответов."""
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute("DELETE FROM response_cache")
+        conn.commit()
+    except sqlite3.Error as e:
+        conn.rollback()
+        raise Exception(f"Ошибка при очистке кэша ответов: {e}")
+
+
+# ==================== Пакетные запуски ====================
+
+# Статусы заданий пакетного запуска
+BATCH_PENDING = 'pending'
+BATCH_DONE = 'done'
+BATCH_FAILED = 'failed'
+
+
+def create_batch_run(prompt_ids: List[int], model_ids: List[int], name: str = None) -> int:
+    """
+    Создает пакетный запуск: по заданию на каждую пару (промт, модель).
+    
+    Повторяющиеся ID пропускаются. Запуск и все задания создаются одной транзакцией.
+    
+    Returns:
+        ID запуска
+    """
+    prompt_ids = list(dict.fromkeys(prompt_ids))
+    model_ids = list(dict.fromkeys(model_ids))
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    try:
+        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        cursor.execute("BEGIN IMMEDIATE")
+        cursor.execute("INSERT INTO batch_runs (name, created_at, total) VALUES (?, ?, ?)",
+                       (name, now, len(prompt_ids) * len(model_ids)))
+        run_id = cursor.lastrowid
+        cursor.executemany("""
+            INSERT INTO batch_jobs (run_id, prompt_id, model_id, status, updated_at)
+            VALUES (?, ?, ?, ?, ?)
+        """, ((run_id, prompt_id, model_id, BATCH_PENDING, now)
+              for prompt_id in prompt_ids for model_id in model_ids))
+        conn.commit()
+        return run_id
+    except sqlite3.Error as e:
+        conn.rollback()
+        raise Exception(f"Ошибка при создании пакетного запуска: {e}")
+
+
+_BATCH_RUN_SELECT = f"""
+    SELECT r.*,
+           COALESCE(SUM(j.status = '{BATCH_PENDING}'), 0) AS pending,
+           COALESCE(SUM(j.status = '{BATCH_DONE}'), 0) AS done,
+           COALESCE(SUM(j.status = '{BATCH_FAILED}'), 0) AS failed
+    FROM batch_runs r
+    LEFT JOIN batch_jobs j ON j.run_id = r.id
+"""
+
+
+def get_batch_run(run_id: int) -> Optional[Dict]:
+    """Получает пакетный запуск с числом заданий по статусам (pending, done, failed)."""
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute(_BATCH_RUN_SELECT + " WHERE r.id = ? GROUP BY r.id", (run_id,))
+    row = cursor.fetchone()
+    return dict(row) if row else None
+
+
+def get_batch_runs() -> List[Dict]:
+    """Получает все пакетные запуски (новые первыми) с числом заданий по статусам."""
+    conn = get_connection()
+    cursor = conn.cursor()
+    cursor.execute(_BATCH_RUN_SELECT + " GROUP BY r.id ORDER BY r.id DESC")
+    return [dict(row) for row in cursor.fetchall()]
+
+
+def get_pending_batch_jobs(run_id: int, retry_failed: bool = False) -> List[Dict]:
+    """
+    Получает невыполненные задания запуска вместе с текстами промтов.
+    
+    Args:
+        run_id: ID запуска
+        retry_failed: Вернуть задания, завершившиеся ошибкой, в очередь
+        
+    Returns:
+        Список словарей id, prompt_id, model_id, prompt в порядке создания
+        (prompt - None, если промт удален)
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    if retry_failed:
+        try:
+            cursor.execute("""
+                UPDATE batch_jobs SET status = ?, error = NULL WHERE run_id = ? AND status = ?
+            """, (BATCH_PENDING, run_id, BATCH_FAILED))
+            if cursor.rowcount > 0:
+                cursor.execute("UPDATE batch_runs SET finished_at = NULL WHERE id = ?", (run_id,))
+            conn.commit()
+        except sqlite3.Error as e:
+            conn.rollback()
+            raise Exception(f"Ошибка при возврате заданий в очередь: {e}")
+    
+    cursor.execute("""
+        SELECT j.id, j.prompt_id, j.model_id, p.prompt
+        FROM batch_jobs j
+        LEFT JOIN prompts p ON p.id = j.prompt_id
+        WHERE j.run_id = ? AND j.status = ?
+        ORDER BY j.id
+    """, (run_id, BATCH_PENDING))
+    return [dict(row) for row in cursor.fetchall()]
+
+
+def complete_batch_jobs(run_id: int, completed: List[Dict]) -> Tuple[int, int]:
+    """
+    Сохраняет результаты заданий и отмечает задания выполненными одной транзакцией.
+    
+    Каждый элемент - словарь с ключом job_id и либо result (словарь как у
+    create_results_bulk), либо error (текст ошибки). Ответ, который не удалось
+    сохранить, отмечает задание ошибкой. Результат и статус задания пишутся
+    вместе, поэтому после сбоя задание либо выполнено со своим результатом,
+    либо остается в очереди.
+    
+    Returns:
+        Кортеж (выполнено, с ошибкой)
+    """
+    if not completed:
+        return 0, 0
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    try:
+        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        cursor.execute("BEGIN IMMEDIATE")
+        
+        with_results = [item for item in completed if item.get('result') is not None]
+        ids, errors = _insert_results(cursor, [item['result'] for item in with_results])
+        errors = dict(errors)
+        updates = [(BATCH_DONE, result_id, None, now, item['job_id'])
+                   for index, (item, result_id) in enumerate(zip(with_results, ids)) if result_id is not None]
+        failed = [(BATCH_FAILED, None, errors[index], now, item['job_id'])
+                  for index, item in enumerate(with_results) if index in errors]
+        failed.extend((BATCH_FAILED, None, item.get('error') or "Неизвестная ошибка", now, item['job_id'])
+                      for item in completed if item.get('result') is None)
+        cursor.executemany("""
+            UPDATE batch_jobs SET status = ?, result_id = ?, error = ?, updated_at = ? WHERE id = ?
+        """, updates + failed)
+        
+        cursor.execute("""
+            UPDATE batch_runs SET finished_at = ?
+            WHERE id = ? AND NOT EXISTS (SELECT 1 FROM batch_jobs WHERE run_id = ? AND status = ?)
+        """, (now, run_id, run_id, BATCH_PENDING))
+        conn.commit()
+        return len(updates), len(failed)
+    except sqlite3.Error as e:
+        conn.rollback()
+        raise Exception(f"Ошибка при сохранении результатов заданий: {e}")
+
+
+# ==================== Статистика моделей ====================
+#
+# Все запросы статистики читают только агрегаты result_rollups (см. _init_rollups).
+# Перцентили оцениваются по гистограмме: внутри корзины значение интерполируется
+# линейно и ограничивается минимумом и максимумом периода.
+
+# Перцентили сводной статистики
+STATISTICS_PERCENTILES = {'p50': 0.50, 'p95': 0.95, 'p99': 0.99}
+
+
+def _histogram_percentile(histogram: List[int], low: float, high: float, quantile: float) -> Optional[float]:
+    """Оценка перцентиля quantile по гистограмме с корзинами LATENCY_BUCKETS."""
+    count = sum(histogram)
+    if not count:
+        return None
+    rank = max(1, math.ceil(quantile * count))  # ближайший ранг
+    cumulative = 0
+    for index, bucket_count in enumerate(histogram):
+        if bucket_count and cumulative + bucket_count >= rank:
+            lower = LATENCY_BUCKETS[index - 1] if index > 0 else 0.0
+            upper = LATENCY_BUCKETS[index] if index < len(LATENCY_BUCKETS) else high
+            value = lower + (upper - lower) * (rank - cumulative) / bucket_count
+            return min(max(value, low), high)
+        cumulative += bucket_count
+    return high
+
+
+def _rollup_summary(row: sqlite3.Row, percentiles: Dict[str, float]) -> Dict:
+    """Переводит сумму строк result_rollups в count, avg, перцентили и tokens_per_sec."""
+    count = row['count'] or 0
+    summary = {
+        'count': count,
+        'avg': row['time_sum'] / count if count else None,
+        'tokens': row['tokens'],
+        'tokens_per_sec': row['tokens'] / row['tokens_time'] if row['tokens_time'] else None,
+    }
+    histogram = [row[column] for column in ROLLUP_HISTOGRAM]
+    for name, quantile in percentiles.items():
+        summary[name] = _histogram_percentile(histogram, row['time_min'], row['time_max'], quantile)
+    return summary
+
+
+_ROLLUP_SUMS = ", ".join(
+    ["SUM(r.count) AS count", "SUM(r.time_sum) AS time_sum", "MIN(r.time_min) AS time_min",
+     "MAX(r.time_max) AS time_max", "SUM(r.tokens) AS tokens", "SUM(r.tokens_time) AS tokens_time",
+     "SUM(r.requests) AS requests", "SUM(r.errors) AS errors", "SUM(r.cached) AS cached"]
+    + [f"SUM(r.{column}) AS {column}" for column in ROLLUP_HISTOGRAM]
+)
+
+
+def _rollup_range(since: Optional[str]) -> Tuple[str, str]:
+    """
+    Период агрегатов и начальная корзина для выборки начиная с since.
+    
+    С ограничением по времени читаются почасовые агрегаты (точность - до часа),
+    за все время - посуточные, которых меньше.
+    """
+    if since:
+        return 'hour', since[:TREND_PERIODS['hour']]
+    return 'day', ''
+
+
+def get_model_latency_stats(since: Optional[str] = None) -> List[Dict]:
+    """
+    Статистика времени ответа и скорости генерации по моделям.
+    
+    Учитываются сохраненные результаты с известным временем ответа (ответы
+    из кэша сохраняются без него и не учитываются).
+    
+    Args:
+        since: Учитывать результаты не раньше этого момента ("YYYY-MM-DD HH:MM:SS"),
+            с точностью до часа
+        
+    Returns:
+        Список словарей model_id, model_name, count, avg, p50, p95, p99
+        (секунды), tokens, tokens_per_sec, от быстрых моделей к медленным
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    period, start = _rollup_range(since)
+    cursor.execute(f"""
+        SELECT r.model_id, m.name AS model_name, {_ROLLUP_SUMS}
+        FROM result_rollups r
+        LEFT JOIN models m ON m.id = r.model_id
+        WHERE r.period = ? AND r.bucket >= ?
+        GROUP BY r.model_id
+        HAVING SUM(r.count) > 0
+    """, (period, start))
+    stats = [
+        dict(model_id=row['model_id'], model_name=row['model_name'],
+             **_rollup_summary(row, STATISTICS_PERCENTILES))
+        for row in cursor.fetchall()
+    ]
+    stats.sort(key=lambda entry: entry['p50'])
+    return stats
+
+
+def get_model_error_rates(since: Optional[str] = None) -> Dict[int, Dict]:
+    """
+    Доля неудачных запросов по моделям (по записям request_metrics).
+    
+    Args:
+        since: Учитывать запросы не раньше этого момента, с точностью до часа
+        
+    Returns:
+        Словарь {id модели: {'model_id', 'model_name', 'requests', 'errors', 'cached', 'error_rate'}}
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    period, start = _rollup_range(since)
+    cursor.execute("""
+        SELECT r.model_id, m.name AS model_name, SUM(r.requests) AS requests,
+               SUM(r.errors) AS errors, SUM(r.cached) AS cached
+        FROM result_rollups r
+        LEFT JOIN models m ON m.id = r.model_id
+        WHERE r.period = ? AND r.bucket >= ?
+        GROUP BY r.model_id
+        HAVING SUM(r.requests) > 0
+    """, (period, start))
+    return {
+        row['model_id']: dict(row, error_rate=row['errors'] / row['requests'])
+        for row in cursor.fetchall()
+    }
+
+
+def get_model_latency_trend(model_id: int, period: str = 'day', since: Optional[str] = None) -> List[Dict]:
+    """
+    Динамика времени ответа и ошибок модели по часам или дням.
+    
+    Args:
+        model_id: ID модели
+        period: 'hour' или 'day'
+        since: Учитывать данные не раньше этого момента ("YYYY-MM-DD HH:MM:SS"),
+            с точностью до периода
+        
+    Returns:
+        Список словарей period, count, avg, p50, p95, tokens_per_sec, requests,
+        errors, error_rate - от старых периодов к новым
+    """
+    if period not in TREND_PERIODS:
+        raise ValueError(f"Неизвестный период: {period}")
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    cursor.execute("""
+        SELECT * FROM result_rollups
+        WHERE model_id = ? AND period = ? AND bucket >= ?
+        ORDER BY bucket
+    """, (model_id, period, (since or '')[:TREND_PERIODS[period]]))
+    trend = []
+    for row in cursor.fetchall():
+        summary = _rollup_summary(row, {'p50': 0.50, 'p95': 0.95})
+        del summary['tokens']
+        trend.append(dict(
+            period=row['bucket'], **summary, requests=row['requests'], errors=row['errors'],
+            error_rate=row['errors'] / row['requests'] if row['requests'] else None
+        ))
+    return trend
+
+
+def rebuild_rollups() -> int:
+    """
+    Пересчитывает агрегаты result_rollups заново по results и request_metrics.
+    
+    Нужен для баз, где агрегаты разошлись с данными (например, после изменения
+    LATENCY_BUCKETS или правки таблиц в обход триггеров).
+    
+    Returns:
+        Количество строк агрегатов
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+    
+    try:
+        cursor.execute("BEGIN IMMEDIATE")
+        cursor.execute("DELETE FROM result_rollups")
+        _fill_rollups(cursor)
+        cursor.execute("SELECT COUNT(*) FROM result_rollups")
+        rows = cursor.fetchone()[0]
+        conn.commit()
+        return rows
+    except sqlite3.Error as e:
+        conn.rollback()
+        raise Exception(f"Ошибка при пересчете агрегатов статистики: {e}")
+
+
+def check_rollups(tolerance: float = 1e-6) -> List[Dict]:
+    """
+    Сверяет агрегаты result_rollups с полным пересчетом по исходным таблицам.
+    
+    Пересчет выполняется внутри транзакции, которая затем откатывается, так что
+    сохраненные агрегаты не меняются. Вещественные суммы сравниваются с
+    допуском tolerance (порядок сложения при пересчете другой).
+    
+    Returns:
+        Список расхождений: словари model_id, period, bucket, column, stored,
+        expected (None - строки нет); пустой список, если агрегаты верны
+    """
+    conn = get_connection()
+    cursor = conn.cursor()
+    key_columns = ('model_id', 'period', 'bucket')
+    
+    def snapshot() -> Dict[Tuple, sqlite3.Row]:
+        cursor.execute("SELECT * FROM result_rollups")
+        return {tuple(row[column] for column in key_columns): row for row in cursor.fetchall()}
+    
+    try:
+        cursor.execute("BEGIN IMMEDIATE")
+        stored = snapshot()
+        cursor.execute("DELETE FROM result_rollups")
+        _fill_rollups(cursor)
+        expected = snapshot()
+    except sqlite3.Error as e:
+        raise Exception(f"Ошибка при проверке агрегатов статистики: {e}")
     finally:
-        conn.close()
+        conn.rollback()
+    
+    mismatches = []
+    for key in sorted(stored.keys() | expected.keys()):
+        stored_row, expected_row = stored.get(key), expected.get(key)
+        for column in ROLLUP_COLUMNS:
+            stored_value = stored_row[column] if stored_row is not None else None
+            expected_value = expected_row[column] if expected_row is not None else None
+            if stored_value == expected_value:
+                continue
+            if (isinstance(stored_value, (int, float)) and isinstance(expected_value, (int, float))
+                    and abs(stored_value - expected_value) <= tolerance * max(1.0, abs(expected_value))):
+                continue
+            mismatches.append(dict(zip(key_columns, key), column=column,
+                                   stored=stored_value, expected=expected_value))
+    return mismatches
+
+
+def main():
+    """Обслуживание агрегатов статистики из командной строки."""
+    import argparse
+    
+    parser = argparse.ArgumentParser(description="Обслуживание базы данных ChatList")
+    parser.add_argument("--db", help="Путь к файлу БД (по умолчанию - chatlist.db рядом с программой)")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("rebuild-rollups", help="Пересчитать агрегаты статистики по всем результатам")
+    subparsers.add_parser("check-rollups", help="Сверить агрегаты статистики с полным пересчетом")
+    args = parser.parse_args()
+    
+    if args.db:
+        set_db_path(args.db)
+    init_database()
+    
+    if args.command == "rebuild-rollups":
+        print(f"Агрегатов пересчитано: {rebuild_rollups()}")
+        return 0
+    
+    mismatches = check_rollups()
+    for mismatch in mismatches[:50]:
+        print(f"модель {mismatch['model_id']}, {mismatch['period']} {mismatch['bucket']}: "
+              f"{mismatch['column']} = {mismatch['stored']}, ожидалось {mismatch['expected']}")
+    if mismatches:
+        print(f"Расхождений: {len(mismatches)}; исправить: python db.py rebuild-rollups")
+        return 1
+    print("Агрегаты статистики совпадают с полным пересчетом")
+    return 0
+
 
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -6,6 +6,8 @@ import sys
 import os
 import traceback
 import time
+from collections import OrderedDict
+from datetime import datetime
 
 # Определяем путь к лог файлу СРАЗУ, используя несколько вариантов
 log_file = None
@@ -170,10 +172,14 @@ try:
         QApplication, QMainWindow, QWidget, QVBoxLayout, QHBoxLayout,
         QTextEdit, QPushButton, QLabel, QTableWidget, QTableWidgetItem,
         QCheckBox, QComboBox, QSplitter, QMenuBar, QStatusBar, QMessageBox,
-        QHeaderView, QGroupBox, QAction, QFileDialog, QDialog, QTextBrowser
+        QHeaderView, QGroupBox, QAction, QFileDialog, QDialog, QTextBrowser,
+        QTableView, QAbstractItemView, QStyledItemDelegate, QStyle,
+        QStyleOptionButton, QStyleOptionViewItem, QProgressDialog
     )
-    from PyQt5.QtCore import Qt, QThread, pyqtSignal
-    from PyQt5.QtGui import QIcon
+    from PyQt5.QtCore import (
+        Qt, QThread, QTimer, pyqtSignal, QAbstractTableModel, QModelIndex, QPointF, QEvent
+    )
+    from PyQt5.QtGui import QIcon, QTextLayout, QTextOption, QPalette
     PYQT_VERSION = 5
 except ImportError as e:
     log_error(f"Ошибка импорта PyQt5: {e}", exc_info=True)
@@ -185,26 +191,306 @@ import network
 import export
 import markdown
 from version import __version__
-from windows import ManagePromptsWindow, ManageModelsWindow, ViewResultsWindow, PromptImproverDialog, SettingsWindow
+from windows import (ManagePromptsWindow, ManageModelsWindow, ViewResultsWindow, PromptImproverDialog,
+                     SettingsWindow, StatisticsWindow)
 
 
 class RequestThread(QThread):
     """Поток для асинхронной отправки запросов к API."""
     finished = pyqtSignal(list)  # Сигнал с результатами запросов
+    model_started = pyqtSignal(int)  # Сигнал о начале запроса к модели (ID модели)
+    chunk_received = pyqtSignal(int, str)  # Сигнал с фрагментом ответа (ID модели, текст)
+    result_ready = pyqtSignal(dict)  # Сигнал с результатом одной модели
     
     def __init__(self, models_list, prompt):
         super().__init__()
         self.models_list = models_list
         self.prompt = prompt
+        self.cancel_token = network.CancelToken()
     
     def run(self):
         """Выполняет запросы к API в отдельном потоке."""
-        results = network.send_prompt_to_multiple_models(
+        results = []
+        for result in network.iter_prompt_to_multiple_models(
             self.models_list, 
             self.prompt,
-            timeout=30
-        )
+            timeout=30,
+            on_chunk=self.on_chunk,
+            on_start=self.on_start,
+            cancel_token=self.cancel_token
+        ):
+            results.append(result)
+            self.result_ready.emit(result)
         self.finished.emit(results)
+    
+    def cancel(self):
+        """Обрывает активные запросы и снимает ожидающие (можно вызывать из главного потока)."""
+        self.cancel_token.cancel()
+    
+    def on_start(self, model):
+        """Сообщает главному окну, что запрос к модели начался."""
+        self.model_started.emit(model['id'])
+    
+    def on_chunk(self, model, text):
+        """Передает фрагмент потокового ответа в главное окно."""
+        self.chunk_received.emit(model['id'], text)
+
+
+# Геометрия ячейки ответа в таблице сравнения: минимальная и максимальная
+# высота строки, отступ текста от границ ячейки (пиксели)
+RESPONSE_MIN_HEIGHT = 60
+RESPONSE_MAX_HEIGHT = 500
+RESPONSE_PADDING = 4
+
+
+class ComparisonTableModel(QAbstractTableModel):
+    """
+    Модель таблицы сравнения ответов.
+    
+    Строки хранятся в памяти, ячейки рисуют делегаты: на ячейку не создается
+    ни QTextEdit, ни QCheckBox, ни QPushButton.
+    """
+    
+    COLUMN_MODEL, COLUMN_STATUS, COLUMN_RESPONSE, COLUMN_SELECTED, COLUMN_ACTIONS = range(5)
+    HEADERS = ["Модель", "Статус", "Ответ", "Выбрано", "Действия"]
+    
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.rows = []
+    
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+    
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.HEADERS)
+    
+    def headerData(self, section, orientation, role=Qt.ItemDataRole.DisplayRole):
+        if role == Qt.ItemDataRole.DisplayRole and orientation == Qt.Orientation.Horizontal:
+            return self.HEADERS[section]
+        return None
+    
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid():
+            return None
+        row = self.rows[index.row()]
+        column = index.column()
+        if role == Qt.ItemDataRole.DisplayRole:
+            if column == self.COLUMN_MODEL:
+                return row['model_name']
+            if column == self.COLUMN_STATUS:
+                return row['status']
+            if column == self.COLUMN_RESPONSE:
+                return row['text']
+            if column == self.COLUMN_ACTIONS:
+                return "Открыть"
+        elif role == Qt.ItemDataRole.CheckStateRole and column == self.COLUMN_SELECTED:
+            return Qt.CheckState.Checked if row['checked'] else Qt.CheckState.Unchecked
+        return None
+    
+    def flags(self, index):
+        if not index.isValid():
+            return Qt.ItemFlag.NoItemFlags
+        flags = Qt.ItemFlag.ItemIsSelectable
+        finished = self.rows[index.row()]['result'] is not None
+        if index.column() in (self.COLUMN_SELECTED, self.COLUMN_ACTIONS):
+            # Выбор и просмотр доступны только после получения ответа
+            if finished:
+                flags |= Qt.ItemFlag.ItemIsEnabled
+            if index.column() == self.COLUMN_SELECTED:
+                flags |= Qt.ItemFlag.ItemIsUserCheckable
+        else:
+            flags |= Qt.ItemFlag.ItemIsEnabled
+        return flags
+    
+    def setData(self, index, value, role=Qt.ItemDataRole.EditRole):
+        if index.isValid() and index.column() == self.COLUMN_SELECTED and role == Qt.ItemDataRole.CheckStateRole:
+            self.rows[index.row()]['checked'] = value == Qt.CheckState.Checked
+            self.dataChanged.emit(index, index, [role])
+            return True
+        return False
+    
+    def set_models(self, models_list):
+        """Создает строки для моделей до получения ответов."""
+        self.beginResetModel()
+        self.rows = [
+            {
+                'model_id': model['id'],
+                'model_name': model['name'],
+                'status': "В очереди",
+                'text': "",
+                'result': None,
+                'checked': False
+            }
+            for model in models_list
+        ]
+        self.endResetModel()
+    
+    def clear(self):
+        """Удаляет все строки."""
+        self.beginResetModel()
+        self.rows = []
+        self.endResetModel()
+    
+    def _changed(self, row, first_column, last_column=None):
+        self.dataChanged.emit(self.index(row, first_column), self.index(row, last_column or first_column))
+    
+    def set_status(self, row, status):
+        """Обновляет статус строки."""
+        self.rows[row]['status'] = status
+        self._changed(row, self.COLUMN_STATUS)
+    
+    def append_text(self, row, text):
+        """Дописывает фрагмент потокового ответа."""
+        self.rows[row]['text'] += text
+        self._changed(row, self.COLUMN_RESPONSE)
+    
+    def set_result(self, row, result, text, status):
+        """Заполняет строку итоговым результатом модели."""
+        data = self.rows[row]
+        data['result'] = result
+        data['text'] = text
+        data['status'] = status
+        data['checked'] = result['success']  # Автоматически выбираем успешные ответы
+        self._changed(row, self.COLUMN_STATUS, self.COLUMN_ACTIONS)
+    
+    def result(self, row):
+        """Возвращает итоговый результат строки (None, пока ответа нет)."""
+        return self.rows[row]['result']
+    
+    def response_text(self, row):
+        """Возвращает текст, показанный в ячейке ответа."""
+        return self.rows[row]['text']
+    
+    def checked_results(self):
+        """Возвращает успешные результаты, отмеченные для сохранения."""
+        return [row['result'] for row in self.rows
+                if row['checked'] and row['result'] and row['result']['success']]
+
+
+class ResponseDelegate(QStyledItemDelegate):
+    """
+    Рисует ответ модели с переносом по словам без виджета в ячейке.
+    
+    Разбивка текста на строки (QTextLayout) кэшируется по тексту, ширине
+    и шрифту, поэтому перерисовка и расчет высоты строки не повторяют ее.
+    Разбивка останавливается на высоте RESPONSE_MAX_HEIGHT: ниже строки не
+    видны. Текст, не поместившийся в ячейку, обрезается многоточием.
+    """
+    
+    def __init__(self, parent=None, cache_size=256):
+        super().__init__(parent)
+        self.cache_size = cache_size
+        self.layouts = OrderedDict()  # (текст, ширина, шрифт) -> (QTextLayout, высота)
+    
+    def layout_for(self, text, width, font):
+        """Возвращает разбитый на строки текст и его высоту (не больше RESPONSE_MAX_HEIGHT)."""
+        key = (text, width, font.key())
+        cached = self.layouts.get(key)
+        if cached is not None:
+            self.layouts.move_to_end(key)
+            return cached
+        
+        layout = QTextLayout(text, font)
+        option = QTextOption()
+        option.setWrapMode(QTextOption.WrapMode.WrapAtWordBoundaryOrAnywhere)
+        layout.setTextOption(option)
+        height = 0.0
+        layout.beginLayout()
+        while height < RESPONSE_MAX_HEIGHT:
+            line = layout.createLine()
+            if not line.isValid():
+                break
+            line.setLineWidth(width)
+            line.setPosition(QPointF(0, height))
+            height += line.height()
+        layout.endLayout()
+        
+        self.layouts[key] = (layout, height)
+        if len(self.layouts) > self.cache_size:
+            self.layouts.popitem(last=False)
+        return layout, height
+    
+    def row_height(self, text, column_width, font):
+        """Высота строки таблицы, нужная для текста ответа."""
+        if not text:
+            return RESPONSE_MIN_HEIGHT
+        _, height = self.layout_for(text, max(column_width - 2 * RESPONSE_PADDING, 1), font)
+        return int(min(max(height + 2 * RESPONSE_PADDING, RESPONSE_MIN_HEIGHT), RESPONSE_MAX_HEIGHT))
+    
+    def paint(self, painter, option, index):
+        # Фон, выделение и фокус рисует стиль, текст - делегат
+        opt = QStyleOptionViewItem(option)
+        self.initStyleOption(opt, index)
+        opt.text = ""
+        widget = opt.widget
+        style = widget.style() if widget else QApplication.style()
+        style.drawControl(QStyle.ControlElement.CE_ItemViewItem, opt, painter, widget)
+        
+        rect = option.rect.adjusted(RESPONSE_PADDING, RESPONSE_PADDING, -RESPONSE_PADDING, -RESPONSE_PADDING)
+        if rect.width() <= 0 or rect.height() <= 0:
+            return
+        
+        text = index.data(Qt.ItemDataRole.DisplayRole) or ""
+        painter.save()
+        painter.setClipRect(rect)
+        if not text:
+            painter.setPen(option.palette.color(QPalette.ColorGroup.Disabled, QPalette.ColorRole.Text))
+            painter.drawText(rect, int(Qt.AlignmentFlag.AlignLeft | Qt.AlignmentFlag.AlignTop), "Ожидание ответа...")
+            painter.restore()
+            return
+        
+        if option.state & QStyle.StateFlag.State_Selected:
+            painter.setPen(option.palette.color(QPalette.ColorRole.HighlightedText))
+        else:
+            painter.setPen(option.palette.color(QPalette.ColorRole.Text))
+        
+        layout, _ = self.layout_for(text, rect.width(), option.font)
+        origin = QPointF(rect.left(), rect.top())
+        for i in range(layout.lineCount()):
+            line = layout.lineAt(i)
+            end = line.textStart() + line.textLength()
+            last = line.y() + line.height() > rect.height() or i + 1 == layout.lineCount()
+            if last and end < len(text):
+                # Последняя видимая строка: остаток текста с многоточием; больше двух
+                # строк текста в нее не поместится, поэтому длинный остаток не измеряется
+                rest = text[line.textStart():end + line.textLength()].replace("\n", " ")
+                elided = option.fontMetrics.elidedText(rest, Qt.TextElideMode.ElideRight, rect.width())
+                painter.drawText(QPointF(rect.left(), rect.top() + line.y() + line.ascent()), elided)
+                break
+            line.draw(painter, origin)
+        painter.restore()
+
+
+class ButtonDelegate(QStyledItemDelegate):
+    """Рисует кнопку в ячейке и сообщает о нажатии сигналом clicked(строка)."""
+    
+    clicked = pyqtSignal(int)
+    
+    def paint(self, painter, option, index):
+        button = QStyleOptionButton()
+        button.rect = option.rect.adjusted(2, 2, -2, -2)
+        button.text = index.data(Qt.ItemDataRole.DisplayRole) or ""
+        button.state = QStyle.StateFlag.State_Raised
+        if index.flags() & Qt.ItemFlag.ItemIsEnabled:
+            button.state |= QStyle.StateFlag.State_Enabled
+        widget = option.widget
+        style = widget.style() if widget else QApplication.style()
+        style.drawControl(QStyle.ControlElement.CE_PushButton, button, painter, widget)
+    
+    def sizeHint(self, option, index):
+        text = index.data(Qt.ItemDataRole.DisplayRole) or ""
+        size = option.fontMetrics.size(0, text)
+        size.setWidth(size.width() + 24)
+        size.setHeight(size.height() + 12)
+        return size
+    
+    def editorEvent(self, event, model, option, index):
+        if (event.type() == QEvent.Type.MouseButtonRelease
+                and index.flags() & Qt.ItemFlag.ItemIsEnabled
+                and option.rect.contains(event.pos())):
+            self.clicked.emit(index.row())
+            return True
+        return False
 
 
 class MainWindow(QMainWindow):
@@ -212,8 +498,29 @@ class MainWindow(QMainWindow):
     
     def __init__(self):
         super().__init__()
-        self.temp_results = []  # Временная таблица результатов в памяти
         self.current_prompt_id = None  # ID текущего промта (если выбран из сохраненных)
+        self.result_rows = {}  # ID модели -> строка таблицы результатов
+        self.pending_chunks = {}  # ID модели -> еще не показанные фрагменты ответа
+        self.started_at = {}  # ID модели -> время начала запроса (time.monotonic)
+        self.model_ids = []  # ID моделей по строкам таблицы выбора моделей
+        self.request_thread = None
+        self.stopped_threads = []  # Остановленные потоки, которые еще завершают работу
+        
+        # Фрагменты потоковых ответов выводятся пачками, чтобы не перерисовывать таблицу на каждый токен
+        self.chunk_flush_timer = QTimer(self)
+        self.chunk_flush_timer.setInterval(50)
+        self.chunk_flush_timer.timeout.connect(self.flush_chunks)
+        
+        # Таймер обновления времени ожидания в строках, по которым еще нет ответа
+        self.elapsed_timer = QTimer(self)
+        self.elapsed_timer.setInterval(200)
+        self.elapsed_timer.timeout.connect(self.update_elapsed)
+        
+        # Высоты строк результатов пересчитываются отложенно и только для видимых строк
+        self.row_height_timer = QTimer(self)
+        self.row_height_timer.setSingleShot(True)
+        self.row_height_timer.setInterval(0)
+        self.row_height_timer.timeout.connect(self.update_row_heights)
         
         self.init_ui()
         self.init_database()
@@ -301,8 +608,8 @@ class MainWindow(QMainWindow):
         models_group.setLayout(models_layout)
         
         self.models_table = QTableWidget()
-        self.models_table.setColumnCount(3)
-        self.models_table.setHorizontalHeaderLabels(["Выбрать", "Название", "Тип"])
+        self.models_table.setColumnCount(4)
+        self.models_table.setHorizontalHeaderLabels(["Выбрать", "Название", "Тип", "Состояние"])
         if PYQT_VERSION == 5:
             self.models_table.horizontalHeader().setSectionResizeMode(1, QHeaderView.ResizeMode.Stretch)
         else:
@@ -317,20 +624,25 @@ class MainWindow(QMainWindow):
         results_layout = QVBoxLayout()
         results_group.setLayout(results_layout)
         
-        # Таблица результатов
-        self.results_table = QTableWidget()
-        self.results_table.setColumnCount(4)
-        self.results_table.setHorizontalHeaderLabels(["Модель", "Ответ", "Выбрано", "Действия"])
-        if PYQT_VERSION == 5:
-            self.results_table.horizontalHeader().setSectionResizeMode(0, QHeaderView.ResizeMode.ResizeToContents)
-            self.results_table.horizontalHeader().setSectionResizeMode(1, QHeaderView.ResizeMode.Stretch)
-            self.results_table.horizontalHeader().setSectionResizeMode(2, QHeaderView.ResizeMode.ResizeToContents)
-            self.results_table.horizontalHeader().setSectionResizeMode(3, QHeaderView.ResizeMode.ResizeToContents)
-        else:
-            self.results_table.horizontalHeader().setSectionResizeMode(0, QHeaderView.ResizeToContents)
-            self.results_table.horizontalHeader().setSectionResizeMode(1, QHeaderView.Stretch)
-            self.results_table.horizontalHeader().setSectionResizeMode(2, QHeaderView.ResizeToContents)
-            self.results_table.horizontalHeader().setSectionResizeMode(3, QHeaderView.ResizeToContents)
+        # Таблица результатов: модель и делегаты вместо виджетов в ячейках
+        self.results_model = ComparisonTableModel(self)
+        self.results_table = QTableView()
+        self.results_table.setModel(self.results_model)
+        self.response_delegate = ResponseDelegate(self.results_table)
+        self.results_table.setItemDelegateForColumn(ComparisonTableModel.COLUMN_RESPONSE, self.response_delegate)
+        self.open_delegate = ButtonDelegate(self.results_table)
+        self.open_delegate.clicked.connect(self.open_result_row)
+        self.results_table.setItemDelegateForColumn(ComparisonTableModel.COLUMN_ACTIONS, self.open_delegate)
+        self.results_table.setSelectionBehavior(QAbstractItemView.SelectionBehavior.SelectRows)
+        self.results_table.setVerticalScrollMode(QAbstractItemView.ScrollMode.ScrollPerPixel)
+        self.results_table.verticalHeader().setDefaultSectionSize(RESPONSE_MIN_HEIGHT)
+        self.results_table.horizontalHeader().setSectionResizeMode(0, QHeaderView.ResizeMode.ResizeToContents)
+        self.results_table.horizontalHeader().setSectionResizeMode(1, QHeaderView.ResizeMode.ResizeToContents)
+        self.results_table.horizontalHeader().setSectionResizeMode(2, QHeaderView.ResizeMode.Stretch)
+        self.results_table.horizontalHeader().setSectionResizeMode(3, QHeaderView.ResizeMode.ResizeToContents)
+        self.results_table.horizontalHeader().setSectionResizeMode(4, QHeaderView.ResizeMode.ResizeToContents)
+        self.results_table.horizontalHeader().sectionResized.connect(self.schedule_row_heights)
+        self.results_table.verticalScrollBar().valueChanged.connect(self.schedule_row_heights)
         self.results_table.setAlternatingRowColors(True)
         results_layout.addWidget(self.results_table)
         
@@ -347,6 +659,11 @@ class MainWindow(QMainWindow):
         self.send_btn.setStyleSheet("font-weight: bold; padding: 5px;")
         buttons_layout.addWidget(self.send_btn)
         
+        self.stop_btn = QPushButton("Остановить")
+        self.stop_btn.clicked.connect(self.stop_requests)
+        self.stop_btn.setEnabled(False)
+        buttons_layout.addWidget(self.stop_btn)
+        
         self.save_results_btn = QPushButton("Сохранить выбранные")
         self.save_results_btn.clicked.connect(self.save_selected_results)
         self.save_results_btn.setEnabled(False)
@@ -367,6 +684,16 @@ class MainWindow(QMainWindow):
         self.status_bar = QStatusBar()
         self.setStatusBar(self.status_bar)
         self.status_bar.showMessage("Готово")
+        
+        # Адаптивный лимит одновременных запросов к API (см. network.AdaptiveConcurrency)
+        self.concurrency_label = QLabel()
+        self.status_bar.addPermanentWidget(self.concurrency_label)
+        # Лимиты и предохранители моделей меняются в фоне, показ обновляется раз в секунду
+        self.network_state_timer = QTimer(self)
+        self.network_state_timer.setInterval(1000)
+        self.network_state_timer.timeout.connect(self.update_concurrency_status)
+        self.network_state_timer.timeout.connect(self.update_model_states)
+        self.network_state_timer.start()
     
     def create_menu_bar(self):
         """Создает меню приложения."""
@@ -402,6 +729,10 @@ class MainWindow(QMainWindow):
         view_results_action.triggered.connect(self.show_saved_results)
         settings_menu.addAction(view_results_action)
         
+        statistics_action = QAction("Статистика моделей", self)
+        statistics_action.triggered.connect(self.show_statistics)
+        settings_menu.addAction(statistics_action)
+        
         settings_menu.addSeparator()
         
         export_md_action = QAction("Экспорт результатов (Markdown)", self)
@@ -426,10 +757,29 @@ class MainWindow(QMainWindow):
         help_menu.addAction(about_action)
     
     def init_database(self):
-        """Инициализирует базу данных."""
+        """Инициализирует базу данных: при необходимости обновляет схему, показывая прогресс."""
         try:
-            db.init_database()
-            self.status_bar.showMessage("База данных инициализирована", 3000)
+            if db.get_schema_version() >= db.SCHEMA_VERSION:
+                return
+            
+            progress = QProgressDialog("Обновление базы данных...", None, 0, 0, self)
+            progress.setWindowTitle("ChatList")
+            progress.setMinimumDuration(500)
+            if PYQT_VERSION == 6:
+                progress.setWindowModality(Qt.WindowModality.ApplicationModal)
+            else:
+                progress.setWindowModality(Qt.ApplicationModal)
+            
+            def on_progress(description, done, total):
+                # Между порциями заполнения окно успевает перерисоваться
+                progress.setLabelText(f"Обновление базы данных: {description}")
+                progress.setMaximum(total)
+                progress.setValue(done)
+                QApplication.processEvents()
+            
+            db.migrate(on_progress)
+            progress.close()
+            self.status_bar.showMessage("База данных обновлена", 3000)
         except Exception as e:
             QMessageBox.critical(self, "Ошибка", f"Не удалось инициализировать БД: {str(e)}")
     
@@ -452,6 +802,7 @@ class MainWindow(QMainWindow):
         try:
             all_models = models.ModelManager.get_all_models()
             self.models_table.setRowCount(len(all_models))
+            self.model_ids = [model['id'] for model in all_models]
             
             for row, model in enumerate(all_models):
                 # Чекбокс для выбора
@@ -475,7 +826,16 @@ class MainWindow(QMainWindow):
                 else:
                     type_item.setFlags(type_item.flags() & ~Qt.ItemIsEditable)
                 self.models_table.setItem(row, 2, type_item)
+                
+                # Состояние предохранителя модели
+                state_item = QTableWidgetItem()
+                if PYQT_VERSION == 5:
+                    state_item.setFlags(state_item.flags() & ~Qt.ItemFlag.ItemIsEditable)
+                else:
+                    state_item.setFlags(state_item.flags() & ~Qt.ItemIsEditable)
+                self.models_table.setItem(row, 3, state_item)
             
+            self.update_model_states()
             self.models_table.resizeColumnsToContents()
         except Exception as e:
             self.status_bar.showMessage(f"Ошибка загрузки моделей: {str(e)}", 5000)
@@ -586,96 +946,191 @@ class MainWindow(QMainWindow):
         
         # Блокируем кнопку отправки
         self.send_btn.setEnabled(False)
+        self.stop_btn.setEnabled(True)
         self.status_bar.showMessage("Отправка запросов...")
         
+        # Проверяем, что названия всех моделей распознаются (проблемы также пишутся в лог)
+        problems = network.prepare_models(selected_models)
+        if problems:
+            self.status_bar.showMessage(f"Отправка запросов... {problems[0]}")
+        
+        # Создаем строки для всех моделей заранее, чтобы ответы появлялись по мере поступления
+        self.results_model.set_models(selected_models)
+        self.result_rows = {model['id']: row for row, model in enumerate(selected_models)}
+        
         # Создаем поток для асинхронной отправки
         self.request_thread = RequestThread(selected_models, prompt_text)
+        self.request_thread.model_started.connect(self.on_model_started)
+        self.request_thread.chunk_received.connect(self.on_chunk_received)
+        self.request_thread.result_ready.connect(self.on_result_ready)
         self.request_thread.finished.connect(self.on_requests_finished)
         self.request_thread.start()
     
+    def schedule_row_heights(self, *args):
+        """Откладывает пересчет высот строк до возврата в цикл событий."""
+        if not self.row_height_timer.isActive():
+            self.row_height_timer.start()
+    
+    def update_row_heights(self):
+        """Подбирает высоту видимых строк результатов по тексту ответа."""
+        view = self.results_table
+        row_count = self.results_model.rowCount()
+        if row_count == 0:
+            return
+        width = view.columnWidth(ComparisonTableModel.COLUMN_RESPONSE)
+        font = view.font()
+        viewport_height = view.viewport().height()
+        
+        # Строки вне экрана сохраняют прежнюю высоту до прокрутки к ним
+        row = max(view.rowAt(0), 0)
+        top = view.rowViewportPosition(row)
+        while row < row_count and top < viewport_height:
+            height = self.response_delegate.row_height(self.results_model.response_text(row), width, font)
+            if view.rowHeight(row) != height:
+                view.setRowHeight(row, height)
+            top += height
+            row += 1
+    
+    def on_model_started(self, model_id):
+        """Обработчик начала запроса к модели: запускает отсчет времени ожидания."""
+        if model_id not in self.result_rows:
+            return
+        self.started_at[model_id] = time.monotonic()
+        self.update_elapsed()
+        if not self.elapsed_timer.isActive():
+            self.elapsed_timer.start()
+    
+    def update_elapsed(self):
+        """Обновляет время ожидания в строках, по которым еще нет ответа."""
+        now = time.monotonic()
+        waiting = False
+        for model_id, started in self.started_at.items():
+            row = self.result_rows.get(model_id)
+            if row is None or self.results_model.result(row) is not None:
+                continue
+            waiting = True
+            self.results_model.set_status(row, f"Ожидание {now - started:.1f} с")
+        if not waiting:
+            self.elapsed_timer.stop()
+    
+    def update_concurrency_status(self):
+        """Показывает в строке состояния подобранные лимиты одновременных запросов к хостам API."""
+        parts = []
+        tooltip = []
+        for state in network.get_concurrency_state():
+            host = state['host'].split("://", 1)[-1]
+            parts.append(f"{host}: {state['in_flight']}/{state['limit']}")
+            rtt = f"{state['rtt']:.2f} с" if state['rtt'] is not None else "нет данных"
+            tooltip.append(f"{host}: лимит {state['limit']}, в работе {state['in_flight']}, "
+                           f"в очереди {state['waiting']}, время ответа {rtt}, снижений {state['cuts']}")
+        self.concurrency_label.setText(("Параллельность: " + ", ".join(parts)) if parts else "")
+        self.concurrency_label.setToolTip("\n".join(tooltip))
+    
+    def update_model_states(self):
+        """Показывает в таблице моделей состояние их предохранителей (см. network.CircuitBreaker)."""
+        states = network.get_circuit_states()
+        for row, model_id in enumerate(self.model_ids):
+            item = self.models_table.item(row, 3)
+            if item is None:
+                continue
+            state = states.get(model_id)
+            if state is None or state['state'] == network.CircuitBreaker.CLOSED:
+                text = "Доступна"
+            elif state['state'] == network.CircuitBreaker.OPEN:
+                text = f"Недоступна до {datetime.fromtimestamp(state['retry_at']).strftime('%H:%M:%S')}"
+            else:
+                text = "Проверка"
+            tooltip = ""
+            if state is not None and state['error_rate'] is not None:
+                tooltip = (f"Ошибок недоступности среди последних попыток: {state['error_rate']:.0%}, "
+                           f"подряд: {state['failures']}")
+            if item.text() != text:
+                item.setText(text)
+            item.setToolTip(tooltip)
+    
+    def on_chunk_received(self, model_id, text):
+        """Обработчик фрагмента потокового ответа модели."""
+        row = self.result_rows.get(model_id)
+        if row is None or self.results_model.result(row) is not None:
+            return  # Итоговый ответ уже показан
+        self.pending_chunks[model_id] = self.pending_chunks.get(model_id, '') + text
+        if not self.chunk_flush_timer.isActive():
+            self.chunk_flush_timer.start()
+    
+    def flush_chunks(self):
+        """Дописывает накопленные фрагменты ответов в строки таблицы."""
+        self.chunk_flush_timer.stop()
+        pending, self.pending_chunks = self.pending_chunks, {}
+        for model_id, text in pending.items():
+            row = self.result_rows.get(model_id)
+            if row is None:
+                continue
+            self.results_model.append_text(row, text)
+        self.schedule_row_heights()
+    
+    def on_result_ready(self, result):
+        """Обработчик результата одной модели: заполняет ее строку, не дожидаясь остальных."""
+        row = self.result_rows.get(result['model_id'])
+        if row is None:
+            return
+        self.pending_chunks.pop(result['model_id'], None)
+        self.fill_result_row(row, result)
+        self.save_results_btn.setEnabled(True)
+    
+    def stop_requests(self):
+        """Останавливает рассылку: обрывает запросы и сразу освобождает интерфейс."""
+        thread = self.request_thread
+        if thread is None:
+            return
+        thread.cancel()
+        # Поздние сигналы остановленного потока таблицу больше не меняют;
+        # поток держим до завершения, чтобы Qt не уничтожил его на ходу
+        for signal in (thread.model_started, thread.chunk_received, thread.result_ready, thread.finished):
+            signal.disconnect()
+        self.stopped_threads = [t for t in self.stopped_threads if not t.isFinished()] + [thread]
+        self.request_thread = None
+        
+        self.flush_chunks()
+        stopped = 0
+        for row in range(self.results_model.rowCount()):
+            if self.results_model.result(row) is None:
+                self.results_model.set_status(row, "Остановлено")
+                stopped += 1
+        self.elapsed_timer.stop()
+        self.send_btn.setEnabled(True)
+        self.stop_btn.setEnabled(False)
+        self.status_bar.showMessage(f"Запросы остановлены, без ответа: {stopped}", 5000)
+    
     def on_requests_finished(self, results):
         """Обработчик завершения запросов."""
+        self.request_thread = None
         self.send_btn.setEnabled(True)
-        self.temp_results = results
-        
-        # Обновляем таблицу результатов
-        self.results_table.setRowCount(len(results))
-        
-        for row, result in enumerate(results):
-            # Название модели
-            model_item = QTableWidgetItem(result['model_name'])
-            if PYQT_VERSION == 5:
-                model_item.setFlags(model_item.flags() & ~Qt.ItemFlag.ItemIsEditable)
-            else:
-                model_item.setFlags(model_item.flags() & ~Qt.ItemIsEditable)
-            self.results_table.setItem(row, 0, model_item)
-            
-            # Ответ - используем QTextEdit для многострочного отображения
-            if result['success']:
-                response_text = result['response']
-            else:
-                response_text = f"Ошибка: {result.get('error', 'Неизвестная ошибка')}"
-            
-            # Создаем QTextEdit для отображения многострочного текста
-            response_widget = QTextEdit()
-            response_widget.setPlainText(response_text)
-            response_widget.setReadOnly(True)
-            
-            # Убираем рамку вокруг текста для более чистого вида в таблице
-            if PYQT_VERSION == 5:
-                response_widget.setFrameShape(QTextEdit.Shape.NoFrame)
-                response_widget.setVerticalScrollBarPolicy(Qt.ScrollBarPolicy.ScrollBarAsNeeded)
-                response_widget.setHorizontalScrollBarPolicy(Qt.ScrollBarPolicy.ScrollBarAlwaysOff)
+        self.stop_btn.setEnabled(False)
+        self.elapsed_timer.stop()
+        self.results_table.resizeColumnToContents(1)
+        self.status_bar.showMessage(f"Получено ответов: {sum(1 for r in results if r['success'])}/{len(results)}", 5000)
+    
+    def fill_result_row(self, row, result):
+        """Заполняет строку таблицы итоговым результатом модели."""
+        # Статус и ответ
+        if result['success']:
+            response_text = result['response']
+            if result.get('cached'):
+                status_text = "Из кэша"
             else:
-                response_widget.setFrameShape(QTextEdit.NoFrame)
-                response_widget.setVerticalScrollBarPolicy(Qt.ScrollBarAsNeeded)
-                response_widget.setHorizontalScrollBarPolicy(Qt.ScrollBarAlwaysOff)
-            
-            # QTextEdit по умолчанию поддерживает перенос текста по словам
-            # Явно включаем перенос, если нужно
-            try:
-                if PYQT_VERSION == 5:
-                    from PyQt5.QtGui import QTextOption
-                    response_widget.setWordWrapMode(QTextOption.WrapMode.WordWrap)
-                else:
-                    from PyQt5.QtGui import QTextOption
-                    response_widget.setWordWrapMode(QTextOption.WrapAtWordBoundaryOrAnywhere)
-            except:
-                pass  # Используем настройки по умолчанию
-            
-            # Устанавливаем стиль для более чистого вида
-            response_widget.setStyleSheet("background-color: transparent; border: none; padding: 2px;")
-            
-            # Рассчитываем высоту на основе количества строк текста
-            lines = response_text.count('\n') + 1
-            # Оцениваем количество строк с учетом переноса (примерно 80 символов на строку)
-            text_length = len(response_text)
-            estimated_lines = max(lines, (text_length // 80) + 1) if text_length > 0 else 1
-            
-            min_height = 60  # Минимальная высота
-            max_height = 500  # Максимальная высота
-            # Оцениваем высоту: примерно 22-24 пикселя на строку
-            estimated_height = min(max(min_height, estimated_lines * 23), max_height)
-            
-            response_widget.setMinimumHeight(min_height)
-            response_widget.setMaximumHeight(max_height)
-            
-            self.results_table.setCellWidget(row, 1, response_widget)
-            self.results_table.setRowHeight(row, estimated_height)
-            
-            # Чекбокс для выбора
-            checkbox = QCheckBox()
-            checkbox.setChecked(result['success'])  # Автоматически выбираем успешные ответы
-            self.results_table.setCellWidget(row, 2, checkbox)
-            
-            # Кнопка "Открыть" для просмотра ответа в markdown
-            open_btn = QPushButton("Открыть")
-            open_btn.clicked.connect(lambda checked, r=result, rt=response_text: self.open_response_markdown(r, rt))
-            self.results_table.setCellWidget(row, 3, open_btn)
+                status_text = f"Готово за {result.get('response_time') or 0:.1f} с"
+        else:
+            response_text = f"Ошибка: {result.get('error', 'Неизвестная ошибка')}"
+            status_text = "Ошибка"
         
-        self.results_table.resizeColumnsToContents()
-        self.save_results_btn.setEnabled(True)
-        self.status_bar.showMessage(f"Получено ответов: {sum(1 for r in results if r['success'])}/{len(results)}", 5000)
+        self.results_model.set_result(row, result, response_text, status_text)
+        self.schedule_row_heights()
+    
+    def open_result_row(self, row):
+        """Открывает ответ из строки таблицы результатов."""
+        result = self.results_model.result(row)
+        if result is not None:
+            self.open_response_markdown(result, self.results_model.response_text(row))
     
     def save_selected_results(self):
         """Сохраняет выбранные результаты в БД."""
@@ -683,25 +1138,30 @@ class MainWindow(QMainWindow):
             QMessageBox.warning(self, "Предупреждение", "Нет активного промта для сохранения")
             return
         
-        selected_count = 0
-        errors = []
+        selected = self.results_model.checked_results()
+        # Метрики запросов должны быть в базе, чтобы связаться с сохраняемыми результатами
+        network.flush_metrics()
         
-        for row in range(self.results_table.rowCount()):
-            checkbox = self.results_table.cellWidget(row, 2)
-            if checkbox and checkbox.isChecked():
-                result = self.temp_results[row]
-                if result['success']:
-                    try:
-                        db.create_result(
-                            prompt_id=self.current_prompt_id,
-                            model_id=result['model_id'],
-                            response=result['response'],
-                            tokens_used=result.get('tokens_used'),
-                            response_time=result.get('response_time')
-                        )
-                        selected_count += 1
-                    except Exception as e:
-                        errors.append(f"{result['model_name']}: {str(e)}")
+        errors = []
+        selected_count = 0
+        if selected:
+            try:
+                ids, failures = db.create_results_bulk([
+                    {
+                        'prompt_id': self.current_prompt_id,
+                        'model_id': result['model_id'],
+                        'response': result['response'],
+                        'tokens_used': result.get('tokens_used'),
+                        # Время поиска в кэше не должно попадать в статистику времени ответа
+                        'response_time': None if result.get('cached') else result.get('response_time'),
+                        'request_id': result.get('request_id')
+                    }
+                    for result in selected
+                ])
+                selected_count = sum(1 for result_id in ids if result_id is not None)
+                errors = [f"{selected[index]['model_name']}: {message}" for index, message in failures]
+            except Exception as e:
+                errors.append(str(e))
         
         if selected_count > 0:
             self.status_bar.showMessage(f"Сохранено результатов: {selected_count}", 5000)
@@ -710,13 +1170,17 @@ class MainWindow(QMainWindow):
                                   f"Сохранено {selected_count} результатов.\nОшибки:\n" + "\n".join(errors))
             else:
                 QMessageBox.information(self, "Успех", f"Сохранено результатов: {selected_count}")
+        elif errors:
+            QMessageBox.warning(self, "Ошибка", "Не удалось сохранить результаты:\n" + "\n".join(errors))
         else:
             QMessageBox.warning(self, "Предупреждение", "Не выбрано ни одного результата для сохранения")
     
     def clear_results(self):
         """Очищает таблицу результатов."""
-        self.results_table.setRowCount(0)
-        self.temp_results = []
+        self.results_model.clear()
+        self.result_rows = {}
+        self.pending_chunks = {}
+        self.started_at = {}
         self.save_results_btn.setEnabled(False)
         self.status_bar.showMessage("Результаты очищены", 3000)
     
@@ -745,6 +1209,13 @@ class MainWindow(QMainWindow):
         window = ViewResultsWindow(self)
         window.exec()
     
+    def show_statistics(self):
+        """Показывает окно статистики моделей."""
+        # Метрики последних запросов тоже должны попасть в статистику
+        network.flush_metrics()
+        window = StatisticsWindow(self)
+        window.exec()
+    
     def load_settings(self):
         """Загружает настройки из БД и применяет их."""
         try:
@@ -818,16 +1289,16 @@ class MainWindow(QMainWindow):
                 border-right: 5px solid transparent;
                 border-top: 5px solid #ffffff;
             }
-            QTableWidget {
+            QTableView {
                 background-color: #2b2b2b;
                 color: #ffffff;
                 gridline-color: #555555;
             }
-            QTableWidget::item {
+            QTableView::item {
                 background-color: #2b2b2b;
                 color: #ffffff;
             }
-            QTableWidget::item:selected {
+            QTableView::item:selected {
                 background-color: #555555;
             }
             QHeaderView::section {
@@ -1269,7 +1740,10 @@ def main():
         window.raise_()  # Поднимаем окно на передний план
         window.activateWindow()  # Активируем окно
         
-        sys.exit(app.exec())
+        exit_code = app.exec()
+        network.close_sessions()
+        db.close_connections()
+        sys.exit(exit_code)
     except Exception as e:
         error_msg = f"Критическая ошибка при запуске: {str(e)}\n{traceback.format_exc()}"
         logger.error(error_msg)
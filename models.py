@@ -104,7 +104,7 @@ class ModelManager:
     
     @staticmethod
     def create_model(name: str, api_url: str, api_id: str, 
-                    model_type: str = None, is_active: int = 1) -> int:
+                    model_type: str = None, is_active: int = 1, hedge: int = 0) -> int:
         """
         Создает новую модель с валидацией.
         
@@ -125,7 +125,7 @@ class ModelManager:
         if not is_valid:
             raise ValueError(error_message)
         
-        return db.create_model(name, api_url, api_id, model_type, is_active)
+        return db.create_model(name, api_url, api_id, model_type, is_active, hedge)
     
     @staticmethod
     def update_model(model_id: int, **kwargs) -> bool:
@@ -2,11 +2,42 @@
 Модуль для отправки запросов к API нейросетей.
 Обрабатывает различные типы API и ошибки.
 """
+import json
+import uuid
+import queue
+import atexit
+import math
+import random
+import hashlib
 import requests
 import time
 import logging
-from typing import Dict, Optional, List
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import asyncio
+import functools
+import threading
+import weakref
+from collections import deque
+from contextlib import asynccontextmanager, contextmanager
+from datetime import datetime
+from email.utils import parsedate_to_datetime
+from typing import Callable, Dict, Iterator, Optional, List, Tuple
+from urllib.parse import urlsplit
+from concurrent.futures import CancelledError, Future, ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
+
+import db
+
+try:
+    import aiohttp
+except ImportError:
+    # Без aiohttp асинхронный движок выполняет запросы синхронным клиентом в пуле потоков
+    aiohttp = None
+
+try:
+    import orjson
+except ImportError:
+    # Без orjson запросы и ответы кодируются стандартным модулем json
+    orjson = None
 
 # Настройка логирования (без вывода в консоль)
 # Используем NullHandler, чтобы не выводить логи в консоль
@@ -16,9 +47,1653 @@ logger.addHandler(logging.NullHandler())
 logger.setLevel(logging.WARNING)  # Только предупреждения и ошибки
 
 
-class APIError(Exception):
-    """Исключение для ошибок API."""
-    pass
+class APIError(Exception):
+    """
+    Исключение для ошибок API.
+    
+    Attributes:
+        status: HTTP-статус ответа (None, если ответа не было)
+        retryable: Имеет ли смысл повторять запрос (429, 5xx, таймаут, обрыв соединения)
+        retry_after: Пауза в секундах из заголовка Retry-After (None, если его не было)
+        timings: Разбивка времени неудавшегося запроса (очередь, повторы, всего),
+            заполняется после всех попыток
+    """
+    
+    def __init__(self, message: str = "", status: Optional[int] = None, retryable: bool = False,
+                 retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.status = status
+        self.retryable = retryable
+        self.retry_after = retry_after
+        self.timings: Optional[Dict] = None
+
+
+class RequestCancelled(APIError):
+    """Запрос отменен через CancelToken."""
+    
+    def __init__(self, message: str = "Запрос отменен"):
+        super().__init__(message)
+
+
+class CircuitOpenError(APIError):
+    """
+    Запрос не отправлен: предохранитель модели разомкнут после серии ошибок (см. CircuitBreaker).
+    
+    Attributes:
+        retry_at: Время (time.time()), после которого модель будет проверена снова
+    """
+    
+    def __init__(self, message: str, retry_at: float):
+        super().__init__(message)
+        self.retry_at = retry_at
+
+
+class CancelToken:
+    """
+    Токен отмены запросов.
+    
+    cancel() можно вызвать из любого потока (например, по кнопке в интерфейсе):
+    повторы прекращаются, активные HTTP-запросы обрываются вместе с
+    соединением, а запросы, еще ждущие квоты или места в очереди, снимаются,
+    не расходуя ни квоту, ни место в пуле.
+    """
+    
+    def __init__(self):
+        self._cancelled = False
+        self._callbacks: List[Callable[[], None]] = []
+        self._lock = threading.Lock()
+    
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled
+    
+    def cancel(self) -> None:
+        """Отменяет все связанные с токеном запросы (повторный вызов ничего не делает)."""
+        with self._lock:
+            if self._cancelled:
+                return
+            self._cancelled = True
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            try:
+                callback()
+            except Exception as e:
+                logger.error(f"Ошибка в обработчике отмены запроса: {str(e)}")
+    
+    def add_callback(self, callback: Callable[[], None]) -> Callable[[], None]:
+        """
+        Регистрирует callback, вызываемый при отмене (сразу, если токен уже отменен).
+        
+        Returns:
+            Функция, снимающая регистрацию
+        """
+        with self._lock:
+            if not self._cancelled:
+                self._callbacks.append(callback)
+                return functools.partial(self._remove_callback, callback)
+        callback()
+        return lambda: None
+    
+    def _remove_callback(self, callback: Callable[[], None]) -> None:
+        with self._lock:
+            if callback in self._callbacks:
+                self._callbacks.remove(callback)
+    
+    def raise_if_cancelled(self) -> None:
+        """Выбрасывает RequestCancelled, если токен отменен."""
+        if self._cancelled:
+            raise RequestCancelled()
+
+
+# HTTP-статусы, при которых запрос повторяется (кроме них - все 5xx)
+RETRYABLE_STATUSES = {408, 425, 429}
+
+
+def _parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Разбирает заголовок Retry-After (число секунд или HTTP-дата) в секунды ожидания."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def _status_error(status: int, reason: Optional[str], retry_after: Optional[str], model_data: Dict) -> APIError:
+    """Формирует APIError для HTTP-ошибки с классификацией: повторять запрос или нет."""
+    return APIError(
+        f"Ошибка {status} {reason or ''}".rstrip() + f" от API для {model_data.get('name')}",
+        status=status,
+        retryable=status in RETRYABLE_STATUSES or status >= 500,
+        retry_after=_parse_retry_after(retry_after)
+    )
+
+
+class RetryPolicy:
+    """
+    Политика повторов запросов к API.
+    
+    Повторяются только временные ошибки (APIError.retryable). Пауза перед
+    повтором выбирается по схеме full jitter: случайно от 0 до
+    min(max_delay, base_delay * 2^attempt), что разводит по времени повторы
+    множества запросов, получивших 429 одновременно. Если сервер прислал
+    Retry-After, ждем ровно столько; если он дольше max_retry_after, запрос
+    не повторяется.
+    """
+    
+    def __init__(self, base_delay: float = 1.0, max_delay: float = 30.0, max_retry_after: float = 60.0):
+        """
+        Args:
+            base_delay: Базовая пауза в секундах
+            max_delay: Потолок паузы в секундах
+            max_retry_after: Максимальный Retry-After в секундах, который стоит ждать
+        """
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_retry_after = max_retry_after
+    
+    def should_retry(self, error: APIError, attempt: int, max_retries: int) -> bool:
+        """Возвращает True, если после неудачной попытки attempt (с 0) запрос стоит повторить."""
+        if attempt >= max_retries or not error.retryable:
+            return False
+        return error.retry_after is None or error.retry_after <= self.max_retry_after
+    
+    def delay(self, error: APIError, attempt: int) -> float:
+        """Возвращает паузу в секундах перед повтором после попытки attempt (с 0)."""
+        if error.retry_after is not None:
+            return error.retry_after
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+
+# Общая политика повторов для всех запросов к API
+_retry_policy = RetryPolicy()
+
+
+def configure_retry_policy(base_delay: Optional[float] = None, max_delay: Optional[float] = None,
+                           max_retry_after: Optional[float] = None) -> None:
+    """
+    Настраивает политику повторов запросов.
+    
+    Args:
+        base_delay: Базовая пауза в секундах
+        max_delay: Потолок паузы в секундах
+        max_retry_after: Максимальный Retry-After в секундах, который стоит ждать
+    """
+    if base_delay is not None:
+        _retry_policy.base_delay = base_delay
+    if max_delay is not None:
+        _retry_policy.max_delay = max_delay
+    if max_retry_after is not None:
+        _retry_policy.max_retry_after = max_retry_after
+
+
+class SessionPool:
+    """
+    Потокобезопасный пул HTTP-сессий с keep-alive.
+    
+    Для каждого хоста (схема + адрес) создается одна requests.Session со своим
+    пулом соединений, поэтому повторные запросы к одному API не тратят время
+    на новое TCP+TLS рукопожатие. Сессии, которые не использовались дольше
+    idle_timeout секунд, закрываются при следующем обращении к пулу.
+    """
+    
+    def __init__(self, pool_maxsize: int = 20, idle_timeout: float = 90.0):
+        """
+        Args:
+            pool_maxsize: Максимальное количество соединений к одному хосту
+            idle_timeout: Время простоя в секундах, после которого сессия закрывается
+        """
+        self.pool_maxsize = pool_maxsize
+        self.idle_timeout = idle_timeout
+        self._sessions: Dict[str, requests.Session] = {}
+        self._last_used: Dict[str, float] = {}
+        self._active: Dict[str, int] = {}
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def _host_key(url: str) -> str:
+        """Возвращает ключ пула для URL (схема + хост + порт)."""
+        parts = urlsplit(url)
+        return f"{parts.scheme}://{parts.netloc}".lower()
+    
+    def _create_session(self) -> requests.Session:
+        """Создает сессию с пулом соединений нужного размера."""
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_maxsize)
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        return session
+    
+    def _evict_idle(self, now: float) -> None:
+        """Закрывает простаивающие сессии. Вызывается под блокировкой."""
+        for host_key, last_used in list(self._last_used.items()):
+            if self._active.get(host_key, 0) == 0 and now - last_used > self.idle_timeout:
+                session = self._sessions.pop(host_key, None)
+                self._last_used.pop(host_key, None)
+                self._active.pop(host_key, None)
+                if session is not None:
+                    session.close()
+    
+    @contextmanager
+    def session(self, url: str):
+        """
+        Выдает сессию для хоста из URL на время запроса.
+        
+        Пока сессия выдана, она не может быть закрыта как простаивающая.
+        """
+        host_key = self._host_key(url)
+        with self._lock:
+            now = time.monotonic()
+            self._evict_idle(now)
+            session = self._sessions.get(host_key)
+            if session is None:
+                session = self._create_session()
+                self._sessions[host_key] = session
+            self._active[host_key] = self._active.get(host_key, 0) + 1
+            self._last_used[host_key] = now
+        try:
+            yield session
+        finally:
+            with self._lock:
+                self._active[host_key] = self._active.get(host_key, 1) - 1
+                self._last_used[host_key] = time.monotonic()
+    
+    def configure(self, pool_maxsize: Optional[int] = None, idle_timeout: Optional[float] = None) -> None:
+        """
+        Меняет параметры пула. Новый размер пула применяется к сессиям,
+        созданным после вызова, поэтому неиспользуемые сессии закрываются.
+        """
+        with self._lock:
+            if idle_timeout is not None:
+                self.idle_timeout = idle_timeout
+            if pool_maxsize is not None and pool_maxsize != self.pool_maxsize:
+                self.pool_maxsize = pool_maxsize
+                for host_key in list(self._sessions):
+                    if self._active.get(host_key, 0) == 0:
+                        self._sessions.pop(host_key).close()
+                        self._last_used.pop(host_key, None)
+                        self._active.pop(host_key, None)
+    
+    def close_all(self) -> None:
+        """Закрывает все сессии пула."""
+        with self._lock:
+            for session in self._sessions.values():
+                session.close()
+            self._sessions.clear()
+            self._last_used.clear()
+            self._active.clear()
+
+
+# Общий для всего процесса пул сессий, через который идут все запросы к API
+_session_pool = SessionPool()
+
+
+def configure_session_pool(pool_maxsize: Optional[int] = None, idle_timeout: Optional[float] = None) -> None:
+    """
+    Настраивает общий пул HTTP-сессий.
+    
+    Args:
+        pool_maxsize: Максимальное количество соединений к одному хосту
+        idle_timeout: Время простоя сессии в секундах до ее закрытия
+    """
+    _session_pool.configure(pool_maxsize=pool_maxsize, idle_timeout=idle_timeout)
+
+
+def close_sessions() -> None:
+    """Закрывает все открытые HTTP-сессии (например, при выходе из приложения)."""
+    _session_pool.close_all()
+    if aiohttp is not None and _engine.is_started():
+        _engine.run(_close_client_session())
+
+
+def _post(url: str, **kwargs) -> requests.Response:
+    """Отправляет POST-запрос через общий пул сессий."""
+    with _session_pool.session(url) as session:
+        return session.post(url, **kwargs)
+
+
+class ResponseCache:
+    """
+    Кэш ответов моделей в таблице response_cache базы данных.
+    
+    Ключ записи - хэш URL API, имени модели, которое уходит в API, сообщений
+    и температуры, поэтому одинаковые запросы к одной модели из разных мест
+    приложения попадают в одну запись. Записи старше ttl секунд считаются
+    промахом; при превышении max_bytes вытесняются давно неиспользуемые.
+    
+    Кэш выключен по умолчанию и включается настройкой response_cache_enabled.
+    Ошибки работы с базой не срывают запрос: кэш просто считается промахнувшимся.
+    """
+    
+    # Как часто (в секундах) обновлять last_used записи при попаданиях
+    TOUCH_INTERVAL = 60.0
+    # До какой доли max_bytes очищается кэш при переполнении
+    EVICT_TARGET = 0.9
+    
+    def __init__(self, enabled: bool = False, ttl: float = 86400.0, max_bytes: int = 100 * 1024 * 1024):
+        """
+        Args:
+            enabled: Включен ли кэш
+            ttl: Время жизни записи в секундах
+            max_bytes: Максимальный суммарный размер ответов в байтах
+        """
+        self.enabled = enabled
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._size: Optional[int] = None
+        self._loaded = False
+        self._lock = threading.Lock()
+    
+    def load_settings(self) -> None:
+        """Читает параметры кэша из таблицы настроек."""
+        try:
+            enabled = db.get_setting("response_cache_enabled")
+            ttl = db.get_setting("response_cache_ttl")
+            max_mb = db.get_setting("response_cache_max_mb")
+        except Exception as e:
+            logger.warning(f"Не удалось прочитать настройки кэша ответов: {str(e)}")
+            return
+        finally:
+            self._loaded = True
+        if enabled is not None:
+            self.enabled = enabled.strip().lower() in ("1", "true", "yes")
+        try:
+            if ttl:
+                self.ttl = float(ttl)
+            if max_mb:
+                self.max_bytes = int(float(max_mb) * 1024 * 1024)
+        except ValueError:
+            logger.warning(f"Некорректные настройки кэша ответов: ttl={ttl!r}, max_mb={max_mb!r}")
+    
+    def is_enabled(self) -> bool:
+        """Возвращает True, если кэш включен (при первом вызове читает настройки)."""
+        if not self._loaded:
+            self.load_settings()
+        return self.enabled
+    
+    @staticmethod
+    def make_key(model_data: Dict, messages: List[Dict], temperature: float = None) -> str:
+        """Вычисляет ключ кэша для запроса к модели."""
+        request = {
+            "api_url": _build_request_url(model_data),
+            "model": _resolve_model_name(model_data),
+            "messages": messages,
+            "temperature": DEFAULT_TEMPERATURE if temperature is None else temperature,
+        }
+        data = json.dumps(request, sort_keys=True, ensure_ascii=False)
+        return hashlib.sha256(data.encode("utf-8")).hexdigest()
+    
+    def get(self, key: str) -> Optional[Dict]:
+        """
+        Возвращает ответ из кэша или None при промахе.
+        
+        В response_time ответа из кэша записывается время поиска в кэше.
+        """
+        start_time = time.perf_counter()
+        try:
+            row = db.get_cached_response(key)
+            if row is None:
+                return None
+            now = time.time()
+            if now - row['created_at'] > self.ttl:
+                db.delete_cached_response(key)
+                return None
+            if now - row['last_used'] > self.TOUCH_INTERVAL:
+                db.touch_cached_response(key, now)
+        except Exception as e:
+            logger.warning(f"Ошибка чтения кэша ответов: {str(e)}")
+            return None
+        return {
+            'response': row['response'],
+            'tokens_used': row['tokens_used'],
+            'response_time': time.perf_counter() - start_time,
+            'cached': True
+        }
+    
+    def put(self, key: str, model_data: Dict, response_data: Dict) -> None:
+        """Сохраняет ответ модели в кэш и вытесняет старые записи при переполнении."""
+        try:
+            size = db.put_cached_response(
+                key, model_data.get('name', ''), response_data['response'],
+                response_data.get('tokens_used'), response_data.get('response_time')
+            )
+            with self._lock:
+                if self._size is None:
+                    self._size = db.get_response_cache_size()
+                else:
+                    self._size += size
+                if self._size <= self.max_bytes:
+                    return
+                db.evict_cached_responses(
+                    self._size - int(self.max_bytes * self.EVICT_TARGET),
+                    expired_before=time.time() - self.ttl
+                )
+                self._size = db.get_response_cache_size()
+        except Exception as e:
+            logger.warning(f"Ошибка записи в кэш ответов: {str(e)}")
+    
+    def clear(self) -> None:
+        """Удаляет все записи кэша."""
+        db.clear_response_cache()
+        with self._lock:
+            self._size = 0
+
+
+# Общий для всего процесса кэш ответов
+_response_cache = ResponseCache()
+
+
+def configure_response_cache(enabled: Optional[bool] = None, ttl: Optional[float] = None,
+                             max_mb: Optional[float] = None) -> None:
+    """
+    Настраивает кэш ответов моделей.
+    
+    Без аргументов перечитывает параметры из таблицы настроек.
+    
+    Args:
+        enabled: Включить или выключить кэш
+        ttl: Время жизни записи в секундах
+        max_mb: Максимальный размер кэша в МБ
+    """
+    if enabled is None and ttl is None and max_mb is None:
+        _response_cache.load_settings()
+        return
+    if enabled is not None:
+        _response_cache.enabled = enabled
+    if ttl is not None:
+        _response_cache.ttl = ttl
+    if max_mb is not None:
+        _response_cache.max_bytes = int(max_mb * 1024 * 1024)
+    _response_cache._loaded = True
+
+
+def clear_response_cache() -> None:
+    """Удаляет все сохраненные ответы моделей."""
+    _response_cache.clear()
+
+
+class TokenBucket:
+    """
+    Ведро токенов: rate токенов в секунду, не больше capacity про запас.
+    
+    Ведро работает в режиме резервирования: токены списываются сразу (баланс
+    может уйти в минус), а запрос ждет wait_time(), пока списанное не будет
+    покрыто. Поэтому ожидающие запросы встают в очередь в порядке
+    резервирования и не проверяют ведро повторно.
+    Методы вызываются под блокировкой владельца.
+    """
+    
+    def __init__(self, rate: float, capacity: float):
+        """
+        Args:
+            rate: Скорость пополнения, токенов в секунду
+            capacity: Емкость ведра (допустимый всплеск)
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+    
+    def _refill(self, now: float) -> None:
+        """Пополняет ведро за время, прошедшее с прошлого обращения."""
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def wait_time(self, amount: float, now: float) -> float:
+        """Возвращает, сколько секунд ждать до появления amount токенов (без списания)."""
+        self._refill(now)
+        return max(0.0, (amount - self.tokens) / self.rate)
+    
+    def consume(self, amount: float) -> None:
+        """Списывает amount токенов (отрицательное значение возвращает токены в ведро)."""
+        self.tokens = min(self.capacity, self.tokens - amount)
+
+
+class RateLimiter:
+    """
+    Клиентский ограничитель частоты запросов к API.
+    
+    Для каждого API-ключа и для каждой модели (по имени, которое уходит в API)
+    ведутся два ведра токенов: запросов в минуту и токенов в минуту. Перед
+    попыткой запроса резервируется один запрос и оценка токенов (длина
+    сообщений / 4 плюс reserve_tokens на ответ); после ответа оценка
+    заменяется фактическим расходом из usage.
+    
+    Лимиты читаются из таблицы настроек (rate_limit_key_rpm, rate_limit_key_tpm,
+    rate_limit_model_rpm, rate_limit_model_tpm); 0 означает "без ограничения".
+    Ведро допускает всплеск не больше burst_seconds секунд квоты.
+    """
+    
+    SETTINGS = ("rate_limit_key_rpm", "rate_limit_key_tpm", "rate_limit_model_rpm", "rate_limit_model_tpm")
+    
+    def __init__(self, burst_seconds: float = 1.0, reserve_tokens: int = 256):
+        """
+        Args:
+            burst_seconds: Сколько секунд квоты можно израсходовать одним всплеском
+            reserve_tokens: Оценка токенов ответа, резервируемая до его получения
+        """
+        self.burst_seconds = burst_seconds
+        self.reserve_tokens = reserve_tokens
+        self.limits = dict.fromkeys(self.SETTINGS, 0.0)
+        self._buckets: Dict[tuple, TokenBucket] = {}
+        self._loaded = False
+        self._lock = threading.Lock()
+    
+    def load_settings(self) -> None:
+        """Читает лимиты из таблицы настроек."""
+        limits = {}
+        try:
+            for key in self.SETTINGS:
+                value = db.get_setting(key)
+                if value:
+                    limits[key] = float(value)
+        except Exception as e:
+            logger.warning(f"Не удалось прочитать лимиты запросов: {str(e)}")
+        self.configure(**limits)
+    
+    def configure(self, **limits) -> None:
+        """Задает лимиты (ключи как в SETTINGS) и сбрасывает накопленные ведра."""
+        with self._lock:
+            for key, value in limits.items():
+                if key not in self.limits:
+                    raise ValueError(f"Неизвестный лимит: {key}")
+                self.limits[key] = float(value or 0)
+            self._buckets.clear()
+            self._loaded = True
+    
+    def is_enabled(self) -> bool:
+        """Возвращает True, если задан хотя бы один лимит (при первом вызове читает настройки)."""
+        if not self._loaded:
+            self.load_settings()
+        return any(self.limits.values())
+    
+    def estimate_tokens(self, messages: List[Dict]) -> int:
+        """Оценивает расход токенов запроса до его отправки."""
+        chars = sum(len(message.get('content') or '') for message in messages)
+        return chars // 4 + self.reserve_tokens
+    
+    def _bucket(self, scope: tuple, per_minute: float) -> Optional[TokenBucket]:
+        """Возвращает ведро для scope или None, если лимит не задан. Вызывается под блокировкой."""
+        if not per_minute:
+            return None
+        bucket = self._buckets.get(scope)
+        if bucket is None:
+            rate = per_minute / 60.0
+            bucket = self._buckets[scope] = TokenBucket(rate, max(1.0, rate * self.burst_seconds))
+        return bucket
+    
+    def reserve(self, model_data: Dict, messages: List[Dict], no_wait: bool = False) -> tuple:
+        """
+        Резервирует запрос и оценку токенов во всех ведрах модели.
+        
+        При no_wait=True квота не списывается, если ее пришлось бы ждать
+        (резервирование в этом случае None, а пауза больше нуля).
+        
+        Returns:
+            Кортеж (пауза в секундах перед отправкой, резервирование для settle())
+        """
+        if not self.is_enabled():
+            return 0.0, None
+        api_key = model_data.get('api_key') or ''
+        model_name = _resolve_model_name(model_data)
+        tokens = self.estimate_tokens(messages)
+        with self._lock:
+            now = time.monotonic()
+            requests_buckets = [b for b in (self._bucket(('key_rpm', api_key), self.limits['rate_limit_key_rpm']),
+                                            self._bucket(('model_rpm', model_name), self.limits['rate_limit_model_rpm']))
+                                if b is not None]
+            token_buckets = [b for b in (self._bucket(('key_tpm', api_key), self.limits['rate_limit_key_tpm']),
+                                         self._bucket(('model_tpm', model_name), self.limits['rate_limit_model_tpm']))
+                             if b is not None]
+            # Ждем самое "узкое" ведро; списываем из всех сразу, чтобы очередь была общей
+            delay = max([b.wait_time(1, now) for b in requests_buckets] +
+                        [b.wait_time(tokens, now) for b in token_buckets] + [0.0])
+            if no_wait and delay > 0:
+                return delay, None
+            for bucket in requests_buckets:
+                bucket.consume(1)
+            for bucket in token_buckets:
+                bucket.consume(tokens)
+        return delay, (requests_buckets, token_buckets, tokens)
+    
+    def settle(self, reservation: Optional[tuple], tokens_used: Optional[int]) -> None:
+        """Заменяет оценку токенов фактическим расходом из ответа API."""
+        if reservation is None or tokens_used is None:
+            return
+        _, token_buckets, estimated = reservation
+        with self._lock:
+            for bucket in token_buckets:
+                bucket.consume(tokens_used - estimated)
+    
+    def release(self, reservation: Optional[tuple]) -> None:
+        """Возвращает в ведра квоту запроса, который так и не был отправлен."""
+        if reservation is None:
+            return
+        requests_buckets, token_buckets, estimated = reservation
+        with self._lock:
+            for bucket in requests_buckets:
+                bucket.consume(-1)
+            for bucket in token_buckets:
+                bucket.consume(-estimated)
+    
+    async def acquire(self, model_data: Dict, messages: List[Dict]) -> Optional[tuple]:
+        """Резервирует квоту и ждет ее без блокировки потока (при отмене квота возвращается)."""
+        delay, reservation = self.reserve(model_data, messages)
+        if delay > 0:
+            try:
+                await asyncio.sleep(delay)
+            except asyncio.CancelledError:
+                self.release(reservation)
+                raise
+        return reservation
+    
+    def acquire_blocking(self, model_data: Dict, messages: List[Dict]) -> Optional[tuple]:
+        """Резервирует квоту и ждет ее в текущем потоке (для синхронных функций)."""
+        delay, reservation = self.reserve(model_data, messages)
+        if delay > 0:
+            time.sleep(delay)
+        return reservation
+
+
+# Общий для всего процесса ограничитель частоты запросов
+_rate_limiter = RateLimiter()
+
+
+def configure_rate_limits(key_rpm: Optional[float] = None, key_tpm: Optional[float] = None,
+                          model_rpm: Optional[float] = None, model_tpm: Optional[float] = None) -> None:
+    """
+    Настраивает клиентские лимиты запросов (0 - без ограничения).
+    
+    Без аргументов перечитывает лимиты из таблицы настроек.
+    
+    Args:
+        key_rpm: Запросов в минуту на один API-ключ
+        key_tpm: Токенов в минуту на один API-ключ
+        model_rpm: Запросов в минуту к одной модели
+        model_tpm: Токенов в минуту к одной модели
+    """
+    limits = {
+        'rate_limit_key_rpm': key_rpm,
+        'rate_limit_key_tpm': key_tpm,
+        'rate_limit_model_rpm': model_rpm,
+        'rate_limit_model_tpm': model_tpm,
+    }
+    limits = {key: value for key, value in limits.items() if value is not None}
+    if not limits:
+        _rate_limiter.load_settings()
+    else:
+        _rate_limiter.configure(**limits)
+
+
+class HedgePolicy:
+    """
+    Хеджирование медленных запросов.
+    
+    Если модель с включенным флагом hedge не ответила за обычное для нее время
+    (90-й перцентиль response_time последних сохраненных результатов), к ней
+    отправляется дублирующий запрос; берется ответ того, кто успеет первым,
+    второй запрос отменяется. В потоковом режиме первым считается запрос,
+    который раньше выдал текст.
+    
+    Число дублей ограничено бюджетом: каждая попытка запроса к модели
+    с хеджированием добавляет budget_percent / 100 дубля (но не больше
+    MAX_CREDIT про запас), каждый дубль списывает один. Поэтому даже при
+    общей деградации API дублей не больше заданной доли запросов.
+    """
+    
+    PERCENTILE = 0.9
+    # Сколько последних результатов модели учитывается в перцентиле
+    WINDOW = 200
+    # Меньше результатов - статистике не доверяем, запросы не дублируются
+    MIN_SAMPLES = 10
+    # Минимальная задержка перед дублем в секундах
+    MIN_DELAY = 0.5
+    # Как часто (в секундах) перечитывать статистику модели из базы
+    REFRESH_INTERVAL = 300.0
+    MAX_CREDIT = 5.0
+    
+    def __init__(self, budget_percent: float = 10.0):
+        """
+        Args:
+            budget_percent: Допустимая доля дублирующих запросов в процентах
+        """
+        self.budget_percent = budget_percent
+        self._credit = 0.0
+        # id модели -> (задержка перед дублем или None, время загрузки по time.monotonic())
+        self._delays: Dict[int, tuple] = {}
+        self._loaded = False
+        self._lock = threading.Lock()
+    
+    def load_settings(self) -> None:
+        """Читает бюджет дублей из таблицы настроек."""
+        try:
+            budget = db.get_setting("hedge_budget_percent")
+        except Exception as e:
+            logger.warning(f"Не удалось прочитать настройки хеджирования: {str(e)}")
+            budget = None
+        try:
+            budget = float(budget) if budget else None
+        except ValueError:
+            logger.warning(f"Некорректный бюджет хеджирования в настройках: {budget}")
+            budget = None
+        self.configure(budget)
+    
+    def configure(self, budget_percent: Optional[float] = None) -> None:
+        """Задает бюджет дублей и сбрасывает накопленный запас."""
+        with self._lock:
+            if budget_percent is not None:
+                self.budget_percent = max(0.0, float(budget_percent))
+            self._credit = 0.0
+            self._loaded = True
+    
+    @staticmethod
+    def percentile(values: List[float], fraction: float) -> float:
+        """Возвращает перцентиль по методу ближайшего ранга."""
+        ordered = sorted(values)
+        rank = max(1, -(-len(ordered) * fraction // 1))
+        return ordered[int(rank) - 1]
+    
+    def _load_delays(self, model_ids: List[int]) -> None:
+        """Перечитывает из базы задержки перед дублем для моделей (вызывается вне цикла событий)."""
+        try:
+            response_times = db.get_models_response_times(model_ids, self.WINDOW)
+        except Exception as e:
+            logger.warning(f"Не удалось прочитать время ответа моделей: {str(e)}")
+            response_times = {}
+        now = time.monotonic()
+        with self._lock:
+            for model_id in model_ids:
+                values = response_times.get(model_id) or []
+                delay = None
+                if len(values) >= self.MIN_SAMPLES:
+                    delay = max(self.MIN_DELAY, self.percentile(values, self.PERCENTILE))
+                self._delays[model_id] = (delay, now)
+    
+    def _is_stale(self, model_id: int, now: float) -> bool:
+        entry = self._delays.get(model_id)
+        return entry is None or now - entry[1] > self.REFRESH_INTERVAL
+    
+    def prepare(self, models: List[Dict]) -> None:
+        """Загружает статистику моделей с хеджированием одним обращением к базе (до рассылки)."""
+        if not self._loaded:
+            self.load_settings()
+        now = time.monotonic()
+        model_ids = [model['id'] for model in models
+                     if model.get('hedge') and model.get('id') is not None and self._is_stale(model['id'], now)]
+        if model_ids:
+            self._load_delays(model_ids)
+    
+    async def delay_for(self, model_data: Dict) -> Optional[float]:
+        """
+        Возвращает задержку перед дублирующим запросом к модели.
+        
+        None - запросы к модели не дублируются (хеджирование выключено,
+        бюджет нулевой или статистики пока недостаточно).
+        """
+        model_id = model_data.get('id')
+        if not model_data.get('hedge') or model_id is None:
+            return None
+        if not self._loaded:
+            self.load_settings()
+        if self.budget_percent <= 0:
+            return None
+        if self._is_stale(model_id, time.monotonic()):
+            await asyncio.get_running_loop().run_in_executor(None, self._load_delays, [model_id])
+        return self._delays[model_id][0]
+    
+    def set_delays(self, delays: Dict[int, Optional[float]]) -> None:
+        """Задает задержки перед дублем явно ({id модели: секунды}), минуя статистику в базе."""
+        now = time.monotonic()
+        with self._lock:
+            for model_id, delay in delays.items():
+                self._delays[model_id] = (delay, now)
+    
+    def earn(self) -> None:
+        """Пополняет бюджет за очередную попытку запроса к модели с хеджированием."""
+        with self._lock:
+            self._credit = min(self.MAX_CREDIT, self._credit + self.budget_percent / 100.0)
+    
+    def try_spend(self) -> bool:
+        """Списывает один дубль из бюджета; False, если бюджет исчерпан."""
+        with self._lock:
+            if self._credit < 1.0:
+                return False
+            self._credit -= 1.0
+            return True
+    
+    def refund(self) -> None:
+        """Возвращает в бюджет дубль, который так и не был отправлен."""
+        with self._lock:
+            self._credit = min(self.MAX_CREDIT, self._credit + 1.0)
+    
+    def invalidate(self, model_id: Optional[int] = None) -> None:
+        """Сбрасывает статистику модели (или всех моделей), она будет перечитана из базы."""
+        with self._lock:
+            if model_id is None:
+                self._delays.clear()
+            else:
+                self._delays.pop(model_id, None)
+
+
+# Общая для всего процесса политика хеджирования запросов
+_hedge_policy = HedgePolicy()
+
+
+def configure_hedging(budget_percent: Optional[float] = None) -> None:
+    """
+    Настраивает хеджирование медленных запросов.
+    
+    Без аргументов перечитывает бюджет из таблицы настроек.
+    
+    Args:
+        budget_percent: Допустимая доля дублирующих запросов в процентах (0 - не дублировать)
+    """
+    if budget_percent is None:
+        _hedge_policy.load_settings()
+    else:
+        _hedge_policy.configure(budget_percent)
+    _hedge_policy.invalidate()
+
+
+class CircuitBreaker:
+    """
+    Предохранитель для каждой модели: не отправляет запросы к недоступной модели.
+    
+    В замкнутом состоянии (closed) запросы идут как обычно. Предохранитель
+    размыкается (open), если подряд не удались FAILURE_THRESHOLD попыток
+    или доля неудач среди последних WINDOW попыток (не меньше MIN_CALLS)
+    достигла ERROR_RATE. Неудачей считается только недоступность модели:
+    5xx, 408, 425, таймаут, обрыв соединения; 429 и ошибки запроса не
+    считаются. Разомкнутый предохранитель сразу отвечает CircuitOpenError,
+    без таймаутов и повторов. Через OPEN_SECONDS он становится полуоткрытым
+    (half_open): первый запрос проходит как проверка, остальные отклоняются
+    до ее исхода. Успешная проверка замыкает предохранитель, неудачная
+    размыкает его снова на вдвое больший срок (но не больше MAX_OPEN_SECONDS).
+    
+    Разомкнутые предохранители сохраняются в таблице настроек и переживают
+    перезапуск, а перед рассылкой окно последних попыток заполняется по
+    истории запросов из request_metrics за HISTORY_SECONDS. Предохранитель
+    включен по умолчанию (в том числе в базах без этой настройки) и
+    выключается настройкой circuit_breaker_enabled = 0.
+    """
+    
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+    
+    FAILURE_THRESHOLD = 3
+    WINDOW = 20
+    MIN_CALLS = 10
+    ERROR_RATE = 0.5
+    OPEN_SECONDS = 60.0
+    MAX_OPEN_SECONDS = 900.0
+    HISTORY_SECONDS = 3600
+    # Ключ таблицы настроек с разомкнутыми предохранителями (JSON)
+    SETTING_KEY = "circuit_breakers"
+    
+    def __init__(self, enabled: bool = True):
+        """
+        Args:
+            enabled: Включен ли предохранитель
+        """
+        self.enabled = enabled
+        # Ключ модели (id, а без него - название) -> состояние предохранителя
+        self._circuits: Dict = {}
+        self._seeded: set = set()
+        self._loaded = False
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def _key(model_data: Dict):
+        model_id = model_data.get('id')
+        return model_id if model_id is not None else model_data.get('name')
+    
+    def _new_circuit(self) -> Dict:
+        return {
+            'state': self.CLOSED,
+            'failures': 0,
+            'outcomes': deque(maxlen=self.WINDOW),
+            'open_until': 0.0,
+            'open_seconds': self.OPEN_SECONDS,
+            'probing': False,
+        }
+    
+    def load_settings(self) -> None:
+        """Читает из таблицы настроек, включен ли предохранитель, и сохраненные разомкнутые предохранители."""
+        try:
+            enabled = db.get_setting("circuit_breaker_enabled")
+            saved = db.get_setting(self.SETTING_KEY)
+        except Exception as e:
+            logger.warning(f"Не удалось прочитать состояние предохранителей моделей: {str(e)}")
+            return
+        finally:
+            self._loaded = True
+        if enabled is not None:
+            self.enabled = enabled.strip().lower() in ("1", "true", "yes")
+        try:
+            saved = json.loads(saved) if saved else {}
+        except ValueError:
+            saved = {}
+        with self._lock:
+            for model_id, entry in saved.items():
+                circuit = self._circuits.setdefault(int(model_id), self._new_circuit())
+                if circuit['state'] != self.CLOSED:
+                    continue
+                circuit.update(state=self.OPEN, failures=int(entry.get('failures', 0)),
+                               open_until=float(entry.get('open_until', 0.0)),
+                               open_seconds=float(entry.get('open_seconds', self.OPEN_SECONDS)))
+    
+    def is_enabled(self) -> bool:
+        """Возвращает True, если предохранитель включен (при первом вызове читает настройки)."""
+        if not self._loaded:
+            self.load_settings()
+        return self.enabled
+    
+    @staticmethod
+    def is_outage(error: APIError) -> bool:
+        """
+        Говорит ли ошибка о недоступности модели (а не о квоте или неверном запросе).
+        
+        То же правило применяет к истории запросов db.get_recent_request_outcomes.
+        """
+        return error.retryable and error.status != 429 and not isinstance(error, RequestCancelled)
+    
+    def acquire(self, model_data: Dict) -> bool:
+        """
+        Проверяет предохранитель перед попыткой запроса.
+        
+        Returns:
+            True, если попытка - проверка полуоткрытого предохранителя
+            (ее исход нужно передать в record или release)
+        
+        Raises:
+            CircuitOpenError: Если предохранитель разомкнут или проверка уже идет
+        """
+        if not self.is_enabled():
+            return False
+        now = time.time()
+        with self._lock:
+            circuit = self._circuits.get(self._key(model_data))
+            if circuit is None or circuit['state'] == self.CLOSED:
+                return False
+            if circuit['state'] == self.OPEN and now >= circuit['open_until']:
+                circuit['state'] = self.HALF_OPEN
+            if circuit['state'] == self.HALF_OPEN and not circuit['probing']:
+                circuit['probing'] = True
+                return True
+            retry_at = circuit['open_until']
+        if retry_at > now:
+            wait = f"повторная проверка через {max(1, round(retry_at - now))} с"
+        else:
+            wait = "идет проверка доступности"
+        raise CircuitOpenError(f"Модель {model_data.get('name')} временно недоступна после серии ошибок, {wait}",
+                               retry_at)
+    
+    def release(self, model_data: Dict, probe: bool) -> None:
+        """Снимает проверку без исхода (например, запрос отменен)."""
+        if not probe:
+            return
+        with self._lock:
+            circuit = self._circuits.get(self._key(model_data))
+            if circuit is not None:
+                circuit['probing'] = False
+    
+    def record(self, model_data: Dict, probe: bool, error: Optional[APIError] = None) -> None:
+        """Учитывает исход попытки запроса: успех (error=None) или ошибку."""
+        if not self.is_enabled():
+            return
+        if error is not None and not self.is_outage(error):
+            self.release(model_data, probe)
+            return
+        key = self._key(model_data)
+        success = error is None
+        changed = None
+        with self._lock:
+            circuit = self._circuits.setdefault(key, self._new_circuit())
+            if probe:
+                circuit['probing'] = False
+            circuit['outcomes'].append(success)
+            if success:
+                circuit['failures'] = 0
+                if circuit['state'] != self.CLOSED:
+                    circuit.update(state=self.CLOSED, open_until=0.0, open_seconds=self.OPEN_SECONDS)
+                    circuit['outcomes'].clear()
+                    changed = self.CLOSED
+            else:
+                circuit['failures'] += 1
+                if circuit['state'] == self.HALF_OPEN and probe:
+                    # Неудачная проверка: следующая - через вдвое больший срок
+                    open_seconds = min(self.MAX_OPEN_SECONDS, circuit['open_seconds'] * 2)
+                elif circuit['state'] == self.CLOSED and self._should_trip(circuit):
+                    open_seconds = self.OPEN_SECONDS
+                else:
+                    open_seconds = None
+                if open_seconds is not None:
+                    circuit.update(state=self.OPEN, open_until=time.time() + open_seconds,
+                                   open_seconds=open_seconds)
+                    changed = self.OPEN
+        if changed == self.OPEN:
+            logger.warning(f"Предохранитель модели {model_data.get('name')} разомкнут на "
+                           f"{open_seconds:.0f} с: {str(error)}")
+        elif changed == self.CLOSED:
+            logger.info(f"Модель {model_data.get('name')} снова доступна, предохранитель замкнут")
+        if changed is not None:
+            self._schedule_save()
+    
+    def _should_trip(self, circuit: Dict) -> bool:
+        if circuit['failures'] >= self.FAILURE_THRESHOLD:
+            return True
+        outcomes = circuit['outcomes']
+        return len(outcomes) >= self.MIN_CALLS and outcomes.count(False) / len(outcomes) >= self.ERROR_RATE
+    
+    def _schedule_save(self) -> None:
+        """Сохраняет состояние в базу: из цикла событий - в фоновом потоке."""
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.save()
+            return
+        loop.run_in_executor(None, self.save)
+    
+    def save(self) -> None:
+        """Записывает разомкнутые предохранители в таблицу настроек."""
+        with self._lock:
+            saved = {
+                str(key): {'failures': circuit['failures'], 'open_until': circuit['open_until'],
+                           'open_seconds': circuit['open_seconds']}
+                for key, circuit in self._circuits.items()
+                if isinstance(key, int) and circuit['state'] != self.CLOSED
+            }
+        try:
+            db.set_setting(self.SETTING_KEY, json.dumps(saved),
+                           "Разомкнутые предохранители моделей (заполняется автоматически)")
+        except Exception as e:
+            logger.warning(f"Не удалось сохранить состояние предохранителей моделей: {str(e)}")
+    
+    def prepare(self, models: List[Dict]) -> None:
+        """Заполняет окно попыток моделей по истории запросов одним обращением к базе (до рассылки)."""
+        if not self.is_enabled():
+            return
+        with self._lock:
+            model_ids = [model['id'] for model in models
+                         if isinstance(model.get('id'), int) and model['id'] not in self._seeded]
+            self._seeded.update(model_ids)
+        if not model_ids:
+            return
+        since = datetime.fromtimestamp(time.time() - self.HISTORY_SECONDS).strftime("%Y-%m-%d %H:%M:%S")
+        try:
+            history = db.get_recent_request_outcomes(model_ids, since, self.WINDOW)
+        except Exception as e:
+            logger.warning(f"Не удалось прочитать историю запросов моделей: {str(e)}")
+            return
+        with self._lock:
+            for model_id, outcomes in history.items():
+                if not outcomes:
+                    continue
+                circuit = self._circuits.setdefault(model_id, self._new_circuit())
+                # Попытки этого запуска программы новее истории
+                recent = list(circuit['outcomes'])
+                circuit['outcomes'].clear()
+                circuit['outcomes'].extend(list(reversed(outcomes)) + recent)
+                if not recent:
+                    circuit['failures'] = next((i for i, success in enumerate(outcomes) if success), len(outcomes))
+    
+    def states(self) -> Dict:
+        """
+        Состояние предохранителей моделей, по которым есть данные.
+        
+        Returns:
+            Словарь {id модели: {'state', 'retry_at' (time.time() или None),
+            'failures' (неудач подряд), 'error_rate' (доля неудач в окне или None)}}
+        """
+        if not self.is_enabled():
+            return {}
+        now = time.time()
+        result = {}
+        with self._lock:
+            for key, circuit in self._circuits.items():
+                state = circuit['state']
+                if state == self.OPEN and now >= circuit['open_until']:
+                    state = self.HALF_OPEN
+                outcomes = circuit['outcomes']
+                result[key] = {
+                    'state': state,
+                    'retry_at': circuit['open_until'] if state == self.OPEN else None,
+                    'failures': circuit['failures'],
+                    'error_rate': outcomes.count(False) / len(outcomes) if outcomes else None,
+                }
+        return result
+    
+    def reset(self, model_id: Optional[int] = None) -> None:
+        """Замыкает предохранитель модели (или все) и забывает ее историю."""
+        with self._lock:
+            if model_id is None:
+                self._circuits.clear()
+            else:
+                self._circuits.pop(model_id, None)
+        self._schedule_save()
+
+
+# Общие для всего процесса предохранители моделей
+_circuit_breaker = CircuitBreaker()
+
+
+def configure_circuit_breaker(enabled: Optional[bool] = None) -> None:
+    """
+    Включает или выключает предохранитель моделей.
+    
+    Без аргументов перечитывает настройку и сохраненное состояние из таблицы настроек.
+    """
+    if enabled is None:
+        _circuit_breaker.load_settings()
+    else:
+        _circuit_breaker.enabled = enabled
+        _circuit_breaker._loaded = True
+
+
+def get_circuit_states() -> Dict:
+    """Состояние предохранителей моделей (см. CircuitBreaker.states)."""
+    return _circuit_breaker.states()
+
+
+def reset_circuit_breaker(model_id: Optional[int] = None) -> None:
+    """Замыкает предохранитель модели (без model_id - всех моделей)."""
+    _circuit_breaker.reset(model_id)
+
+
+class MetricsRecorder:
+    """
+    Запись разбивки времени запросов в таблицу request_metrics.
+    
+    Строки копятся в памяти и пишутся в базу одной транзакцией: когда
+    накопится FLUSH_SIZE строк, старейшей исполнится FLUSH_INTERVAL секунд,
+    по окончании рассылки или при выходе из программы. Запись включается
+    настройкой request_metrics_enabled; ошибки базы только пишутся в лог.
+    """
+    
+    FLUSH_SIZE = 100
+    FLUSH_INTERVAL = 5.0
+    # Длина сохраняемого текста ошибки
+    MAX_ERROR_LENGTH = 500
+    
+    def __init__(self, enabled: bool = True):
+        """
+        Args:
+            enabled: Записывать ли метрики
+        """
+        self.enabled = enabled
+        self._rows: List[Dict] = []
+        self._first_at: Optional[float] = None
+        self._loaded = False
+        self._lock = threading.Lock()
+    
+    def load_settings(self) -> None:
+        """Читает из таблицы настроек, включена ли запись метрик."""
+        try:
+            enabled = db.get_setting("request_metrics_enabled")
+        except Exception as e:
+            logger.warning(f"Не удалось прочитать настройки метрик запросов: {str(e)}")
+            enabled = None
+        finally:
+            self._loaded = True
+        if enabled is not None:
+            self.enabled = enabled.strip().lower() in ("1", "true", "yes")
+    
+    def is_enabled(self) -> bool:
+        """Возвращает True, если запись метрик включена (при первом вызове читает настройки)."""
+        if not self._loaded:
+            self.load_settings()
+        return self.enabled
+    
+    def record(self, model_data: Dict, request_id: str, streamed: bool,
+               response_data: Optional[Dict] = None, error: Optional[APIError] = None) -> bool:
+        """
+        Добавляет метрики запроса в буфер.
+        
+        Returns:
+            True, если буфер пора записать в базу (вызовом flush() вне цикла событий)
+        """
+        if not self.is_enabled():
+            return False
+        timings = (response_data.get('timings') if response_data is not None else error.timings) or {}
+        row = {
+            'request_id': request_id,
+            'model_id': model_data.get('id'),
+            'model_name': model_data.get('name'),
+            'created_at': datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            'success': response_data is not None,
+            'status': error.status if error is not None else None,
+            'error': str(error)[:self.MAX_ERROR_LENGTH] if error is not None else None,
+            # Ответ, полученный чужим запросом (SingleFlight), как и ответ из кэша, квоту не тратит
+            'cached': bool(response_data and (response_data.get('cached') or response_data.get('shared'))),
+            'streamed': streamed,
+            'hedged': bool(response_data and response_data.get('hedged')),
+            'tokens_used': response_data.get('tokens_used') if response_data is not None else None,
+            'retryable': error.retryable if error is not None else None,
+        }
+        for key in ('queue_wait', 'connect', 'ttfb', 'download', 'parse', 'total',
+                    'retries', 'bytes_sent', 'bytes_received'):
+            row[key] = timings.get(key)
+        now = time.monotonic()
+        with self._lock:
+            if not self._rows:
+                self._first_at = now
+            self._rows.append(row)
+            return len(self._rows) >= self.FLUSH_SIZE or now - self._first_at >= self.FLUSH_INTERVAL
+    
+    def flush(self) -> int:
+        """Записывает накопленные метрики в базу и возвращает число записанных строк."""
+        with self._lock:
+            rows, self._rows = self._rows, []
+        if not rows:
+            return 0
+        try:
+            db.create_request_metrics_bulk(rows)
+        except Exception as e:
+            logger.warning(f"Не удалось сохранить метрики запросов: {str(e)}")
+            return 0
+        return len(rows)
+
+
+# Общий для всего процесса буфер метрик запросов
+_metrics_recorder = MetricsRecorder()
+atexit.register(_metrics_recorder.flush)
+
+
+def configure_metrics(enabled: Optional[bool] = None) -> None:
+    """
+    Включает или выключает запись метрик запросов.
+    
+    Без аргументов перечитывает настройку из таблицы настроек.
+    """
+    if enabled is None:
+        _metrics_recorder.load_settings()
+    else:
+        _metrics_recorder.enabled = enabled
+        _metrics_recorder._loaded = True
+
+
+def flush_metrics() -> int:
+    """Записывает в базу накопленные метрики запросов (например, перед сохранением результатов)."""
+    return _metrics_recorder.flush()
+
+
+def _record_metrics(model_data: Dict, request_id: str, streamed: bool,
+                    response_data: Optional[Dict] = None, error: Optional[APIError] = None) -> None:
+    """Записывает метрики запроса; при заполнении буфера сбрасывает его в базу вне цикла событий."""
+    if _metrics_recorder.record(model_data, request_id, streamed, response_data, error):
+        asyncio.get_running_loop().run_in_executor(None, _metrics_recorder.flush)
+
+
+class _Flight:
+    """Выполняющийся запрос, ответ которого ждут все его одинаковые копии."""
+    
+    def __init__(self, streamed: bool):
+        self.streamed = streamed
+        self.task: Optional[asyncio.Task] = None
+        self.waiters = 0
+        self._text: List[str] = []
+        self._listeners: List[Callable[[str], None]] = []
+        # Фрагменты могут приходить из потока executor (без aiohttp)
+        self._lock = threading.Lock()
+    
+    def emit(self, delta: str) -> None:
+        """Передает фрагмент потокового ответа всем ожидающим."""
+        with self._lock:
+            self._text.append(delta)
+            listeners = list(self._listeners)
+        for listener in listeners:
+            _notify(listener, delta)
+    
+    def listen(self, on_chunk: Callable[[str], None]) -> None:
+        """Подписывает ожидающего на фрагменты; уже полученный текст передается одним фрагментом."""
+        with self._lock:
+            received = "".join(self._text)
+            if received:
+                _notify(on_chunk, received)
+            self._listeners.append(on_chunk)
+    
+    def unlisten(self, on_chunk: Callable[[str], None]) -> None:
+        with self._lock:
+            if on_chunk in self._listeners:
+                self._listeners.remove(on_chunk)
+
+
+class SingleFlight:
+    """
+    Объединение одинаковых запросов, выполняющихся одновременно.
+    
+    Если модели уже отправлены те же сообщения (ключ - как у ResponseCache:
+    URL API, имя модели в API, сообщения и температура) и ответ еще не
+    получен, новый запрос не уходит в API, а ждет ответа первого. Так две
+    вкладки, окно и пакетный запуск или повторяющиеся промты в одном
+    пакетном запуске тратят квоту один раз.
+    
+    Общий запрос выполняется отдельной задачей: отмена одного из ожидающих
+    его не прерывает, задача отменяется, только когда не осталось ни одного.
+    Ожидающий с потоковым выводом получает уже пришедший текст одним
+    фрагментом, а дальше - фрагменты по мере получения; если общий запрос
+    не потоковый, ответ передается целиком одним фрагментом, как из кэша.
+    """
+    
+    def __init__(self, enabled: bool = True):
+        """
+        Args:
+            enabled: Объединять ли одинаковые запросы
+        """
+        self.enabled = enabled
+        # Запросы в полете для каждого цикла событий: {ключ: _Flight}
+        self._flights: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+    
+    async def run(self, key: str, make_request: Callable[[Optional[Callable[[str], None]]], "asyncio.Future"],
+                  on_chunk: Optional[Callable[[str], None]] = None) -> tuple:
+        """
+        Выполняет запрос или присоединяется к такому же выполняющемуся.
+        
+        Args:
+            key: Ключ запроса (ResponseCache.make_key)
+            make_request: Создает корутину запроса; аргумент - обработчик фрагментов
+                (None для непотокового запроса)
+            on_chunk: Обработчик фрагментов потокового ответа ожидающего
+        
+        Returns:
+            Кортеж (данные ответа, shared): shared=True, если ответ получен чужим запросом.
+            Данные ответа у каждого ожидающего свои (копия)
+        """
+        if not self.enabled:
+            return await make_request(on_chunk), False
+        flights = self._flights.setdefault(asyncio.get_running_loop(), {})
+        flight = flights.get(key)
+        shared = flight is not None
+        if not shared:
+            flight = _Flight(streamed=on_chunk is not None)
+            flight.task = asyncio.ensure_future(make_request(flight.emit if flight.streamed else None))
+            flights[key] = flight
+            flight.task.add_done_callback(functools.partial(self._finish, flights, key, flight))
+        
+        streamed = on_chunk is not None and flight.streamed
+        if streamed:
+            flight.listen(on_chunk)
+        flight.waiters += 1
+        try:
+            response_data = await asyncio.shield(flight.task)
+        except asyncio.CancelledError:
+            if flight.waiters == 1 and not flight.task.done():
+                # Ответ больше никому не нужен
+                if flights.get(key) is flight:
+                    del flights[key]
+                flight.task.cancel()
+            raise
+        finally:
+            flight.waiters -= 1
+            if streamed:
+                flight.unlisten(on_chunk)
+        
+        response_data = dict(response_data)
+        response_data['timings'] = dict(response_data.get('timings') or {})
+        if on_chunk is not None and not flight.streamed:
+            on_chunk(response_data['response'])
+        return response_data, shared
+    
+    @staticmethod
+    def _finish(flights: Dict, key: str, flight: _Flight, task: asyncio.Task) -> None:
+        if flights.get(key) is flight:
+            del flights[key]
+        if not task.cancelled():
+            # Ошибка передана ожидающим; если их не осталось, она не должна попасть в лог asyncio
+            task.exception()
+    
+    def in_flight(self) -> int:
+        """Число выполняющихся общих запросов во всех циклах событий."""
+        return sum(len(flights) for flights in list(self._flights.values()))
+
+
+# Общий для всего процесса реестр выполняющихся запросов
+_single_flight = SingleFlight()
+
+
+def configure_single_flight(enabled: bool) -> None:
+    """Включает или выключает объединение одинаковых одновременных запросов."""
+    _single_flight.enabled = enabled
+
+
+class _NameRules:
+    """
+    Скомпилированные правила сопоставления названия модели из БД с именем модели в API.
+    
+    Порядок проверки: точный псевдоним, затем (для названий вида provider/model)
+    правила для таких названий, затем правила по подстрокам, затем значение
+    по умолчанию. Правило - кортеж (обязательные подстроки, запрещенные
+    подстроки, имя в API); срабатывает первое подходящее.
+    """
+    
+    def __init__(self, default: str, rules: tuple = (), aliases: Optional[Dict[str, str]] = None,
+                 slash_rules: Optional[tuple] = None, default_is_match: bool = False):
+        """
+        Args:
+            default: Имя модели, если ни одно правило не сработало
+            rules: Правила по подстрокам названия
+            aliases: Точные псевдонимы (название в нижнем регистре -> имя в API)
+            slash_rules: Правила для названий вида provider/model; если задано,
+                такие названия без подходящего правила передаются в API как есть
+            default_is_match: Считать ли значение по умолчанию распознанным
+                (для провайдеров с единственной моделью)
+        """
+        self.default = default
+        self.rules = rules
+        self.aliases = aliases or {}
+        self.slash_rules = slash_rules
+        self.default_is_match = default_is_match
+    
+    def match(self, name: str) -> tuple:
+        """
+        Возвращает кортеж (имя в API, распознано ли название).
+        
+        Нераспознанное название получает имя по умолчанию.
+        """
+        name_lower = name.lower().strip()
+        if name_lower in self.aliases:
+            return self.aliases[name_lower], True
+        if self.slash_rules is not None and '/' in name:
+            for required, excluded, target in self.slash_rules:
+                if all(part in name_lower for part in required) and not any(part in name_lower for part in excluded):
+                    return target, True
+            return name, True
+        for required, excluded, target in self.rules:
+            if all(part in name_lower for part in required) and not any(part in name_lower for part in excluded):
+                return target, True
+        return self.default, self.default_is_match
+
+
+_LLAMA = 'meta-llama/llama-3.3-70b-instruct'
+
+# Правила для каждого типа модели. Актуальные названия моделей OpenRouter:
+# https://openrouter.ai/models. OpenRouter не поддерживает модели Groq напрямую,
+# вместо них используется Meta Llama 3.3.
+_MODEL_NAME_RULES = {
+    'openrouter': _NameRules(
+        default='openai/gpt-4',
+        aliases={
+            'gpt-4': 'openai/gpt-4',
+            'gpt4': 'openai/gpt-4',
+            'gpt-3.5': 'openai/gpt-3.5-turbo',
+            'gpt-3.5-turbo': 'openai/gpt-3.5-turbo',
+            'deepseek chat': 'deepseek/deepseek-chat-v3.1',
+            'deepseek': 'deepseek/deepseek-chat-v3.1',
+            'groq llama 3': _LLAMA,
+            'groq llama': _LLAMA,
+            'groq': _LLAMA,
+            'llama 3': _LLAMA,
+            'claude': 'anthropic/claude-3-opus',
+            'gemini': 'google/gemini-pro',
+            'mistral devstral': 'mistralai/devstral-2512',
+            'devstral': 'mistralai/devstral-2512',
+            'qwen coder': 'qwen/qwen3-coder',
+            'qwen3 coder': 'qwen/qwen3-coder',
+            'deepseek/deepseek-chat': 'deepseek/deepseek-chat-v3.1',
+        },
+        # Устаревшие названия в формате provider/model
+        slash_rules=(
+            (('groq/',), (), _LLAMA),
+            (('meta-llama/llama-3',), ('3.3',), _LLAMA),
+        ),
+        rules=(
+            (('deepseek',), (), 'deepseek/deepseek-chat-v3.1'),
+            (('groq',), (), _LLAMA),
+            (('llama',), (), _LLAMA),
+            (('claude',), (), 'anthropic/claude-3-opus'),
+            (('anthropic',), (), 'anthropic/claude-3-opus'),
+            (('gemini',), (), 'google/gemini-pro'),
+            (('google',), (), 'google/gemini-pro'),
+            (('mistral',), (), 'mistralai/devstral-2512'),
+            (('devstral',), (), 'mistralai/devstral-2512'),
+            (('qwen',), (), 'qwen/qwen3-coder'),
+            (('gpt', '3.5'), (), 'openai/gpt-3.5-turbo'),
+            (('gpt', 'turbo'), (), 'openai/gpt-3.5-turbo'),
+            (('openai', '3.5'), (), 'openai/gpt-3.5-turbo'),
+            (('openai', 'turbo'), (), 'openai/gpt-3.5-turbo'),
+            (('gpt',), (), 'openai/gpt-4'),
+            (('openai',), (), 'openai/gpt-4'),
+        ),
+    ),
+    'openai': _NameRules(
+        default='gpt-4',
+        rules=(
+            (('gpt-4',), (), 'gpt-4'),
+            (('gpt-3.5',), (), 'gpt-3.5-turbo'),
+        ),
+    ),
+    'groq': _NameRules(
+        default='llama-3-8b-8192',
+        rules=((('mixtral',), (), 'mixtral-8x7b-32768'),),
+    ),
+    'deepseek': _NameRules(default='deepseek-chat', default_is_match=True),
+}
+
+
+class ModelNameResolver:
+    """
+    Определяет имя модели, которое передается в API, по названию модели в БД.
+    
+    Правила компилируются один раз (_MODEL_NAME_RULES). Для моделей OpenRouter
+    результат запоминается по models.id и сохраняется в столбец
+    models.resolved_name, поэтому правила проверяются один раз на модель.
+    Запомненное имя сверяется с названием модели: если db.update_model
+    изменил название, имя вычисляется заново (update_model также сбрасывает
+    resolved_name в БД).
+    """
+    
+    def __init__(self):
+        self._resolved: Dict[int, tuple] = {}
+        self._lock = threading.Lock()
+    
+    @staticmethod
+    def _rules(model_type: Optional[str]) -> _NameRules:
+        """Возвращает правила для типа модели (неизвестный тип - OpenAI-совместимый)."""
+        return _MODEL_NAME_RULES.get((model_type or 'openai').lower(), _MODEL_NAME_RULES['openai'])
+    
+    def resolve(self, model_data: Dict, model_type: Optional[str] = None) -> str:
+        """
+        Возвращает имя модели в API.
+        
+        Args:
+            model_data: Словарь с данными модели (name, model_type, id, resolved_name)
+            model_type: Тип модели, если он отличается от model_data['model_type']
+        """
+        model_type = (model_type or model_data.get('model_type') or 'openai').lower()
+        rules = self._rules(model_type)
+        model_id = model_data.get('id')
+        if model_type != 'openrouter' or model_id is None:
+            return rules.match(model_data.get('name') or rules.default)[0]
+        
+        name = model_data.get('name') or rules.default
+        entry = self._resolved.get(model_id)
+        if entry is not None and entry[0] == name:
+            return entry[1]
+        resolved = model_data.get('resolved_name') or rules.match(name)[0]
+        with self._lock:
+            self._resolved[model_id] = (name, resolved)
+        return resolved
+    
+    def prepare(self, models: List[Dict]) -> List[str]:
+        """
+        Проверяет, что названия всех моделей распознаются, и сохраняет
+        вычисленные имена моделей OpenRouter в БД.
+        
+        Вызывается перед рассылкой. Нераспознанная модель не блокирует
+        рассылку (ей достается имя по умолчанию), но попадает в список проблем.
+        
+        Returns:
+            Список описаний проблем (пустой, если все названия распознаны)
+        """
+        problems = []
+        to_persist = {}
+        for model in models:
+            model_type = (model.get('model_type') or 'openai').lower()
+            rules = self._rules(model_type)
+            name = model.get('name') or ''
+            if not name.strip():
+                problems.append(f"Модель с ID {model.get('id')}: пустое название, "
+                                f"будет использована {rules.default}")
+                continue
+            if model_type not in _MODEL_NAME_RULES:
+                problems.append(f"{name}: неизвестный тип модели '{model_type}', "
+                                f"используется OpenAI-совместимый формат")
+            resolved, matched = rules.match(name)
+            if not matched:
+                problems.append(f"{name}: название не распознано, будет использована {resolved}")
+            if model_type == 'openrouter' and model.get('id') is not None:
+                if model.get('resolved_name') != resolved:
+                    to_persist[model['id']] = resolved
+                    model['resolved_name'] = resolved
+                with self._lock:
+                    self._resolved[model['id']] = (name, resolved)
+        
+        if to_persist:
+            try:
+                db.set_models_resolved_names(to_persist)
+            except Exception as e:
+                logger.warning(f"Не удалось сохранить имена моделей: {str(e)}")
+        return problems
+    
+    def invalidate(self, model_id: Optional[int] = None) -> None:
+        """Забывает вычисленное имя модели (или всех моделей, если model_id не задан)."""
+        with self._lock:
+            if model_id is None:
+                self._resolved.clear()
+            else:
+                self._resolved.pop(model_id, None)
+
+
+# Общий для всего процесса определитель имен моделей
+_model_resolver = ModelNameResolver()
+
+
+def prepare_models(models: List[Dict]) -> List[str]:
+    """
+    Проверяет названия моделей перед рассылкой и запоминает их имена в API.
+    
+    Returns:
+        Список описаний проблем (пустой, если все названия распознаны)
+    """
+    return _model_resolver.prepare(models)
+
+
+def _send_request_sync(model_data: Dict, model_type: str, prompt: str, timeout: int) -> Dict:
+    """
+    Общая реализация send_request_to_*: одна попытка запроса к провайдеру
+    model_type синхронным клиентом с учетом лимитов запросов.
+    """
+    model_data = dict(model_data, model_type=model_type)
+    messages = [{"role": "user", "content": prompt}]
+    reservation = _rate_limiter.acquire_blocking(model_data, messages)
+    result = _request_sync(model_data, messages, timeout)
+    _rate_limiter.settle(reservation, result.get('tokens_used'))
+    return result
 
 
 def send_request_to_openai(model_data: Dict, prompt: str, timeout: int = 30) -> Dict:
@@ -36,578 +1711,1517 @@ def send_request_to_openai(model_data: Dict, prompt: str, timeout: int = 30) ->
     Raises:
         APIError: При ошибке запроса
     """
-    api_key = model_data.get('api_key')
-    api_url = model_data.get('api_url')
+    return _send_request_sync(model_data, 'openai', prompt, timeout)
+
+
+def send_request_to_deepseek(model_data: Dict, prompt: str, timeout: int = 30) -> Dict:
+    """Отправляет запрос к DeepSeek API (параметры и результат как у send_request_to_openai)."""
+    return _send_request_sync(model_data, 'deepseek', prompt, timeout)
+
+
+def send_request_to_groq(model_data: Dict, prompt: str, timeout: int = 30) -> Dict:
+    """Отправляет запрос к Groq API (параметры и результат как у send_request_to_openai)."""
+    return _send_request_sync(model_data, 'groq', prompt, timeout)
+
+
+def send_request_to_openrouter(model_data: Dict, prompt: str, timeout: int = 30) -> Dict:
+    """Отправляет запрос к OpenRouter API (параметры и результат как у send_request_to_openai)."""
+    return _send_request_sync(model_data, 'openrouter', prompt, timeout)
+
+
+def send_prompt_with_system_to_model(model_data: Dict, system_prompt: str, user_prompt: str, 
+                                      timeout: int = 30, max_retries: int = 2,
+                                      use_cache: bool = True,
+                                      cancel_token: Optional[CancelToken] = None) -> Dict:
+    """
+    Отправляет промт с системным сообщением в конкретную модель.
+    
+    Args:
+        model_data: Словарь с данными модели (должен содержать model_type, api_key, api_url, name)
+        system_prompt: Системный промт (инструкции для AI)
+        user_prompt: Пользовательский промт (основной запрос)
+        timeout: Таймаут запроса в секундах
+        max_retries: Максимальное количество повторов при временной ошибке
+        use_cache: Если False, кэш ответов не читается (свежий ответ все равно сохраняется)
+        cancel_token: Токен, через который запрос можно отменить из другого потока
+        
+    Returns:
+        Словарь с ответом: {'response': str, 'tokens_used': int, 'response_time': float},
+        для ответа из кэша дополнительно 'cached': True
+        
+    Raises:
+        APIError: При ошибке запроса после всех попыток
+        RequestCancelled: Если запрос отменен через cancel_token
+    """
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_prompt}
+    ]
+    return _engine.run(_async_send_messages(model_data, messages, timeout, max_retries, use_cache=use_cache,
+                                            cancel_token=cancel_token),
+                       cancel_token)
+
+
+def send_prompt_to_model(model_data: Dict, prompt: str, timeout: int = 30, max_retries: int = 2,
+                         use_cache: bool = True, cancel_token: Optional[CancelToken] = None) -> Dict:
+    """
+    Отправляет промт в конкретную модель с обработкой ошибок и retry-логикой.
+    
+    Запрос выполняется в фоновом цикле событий: паузы между повторами не
+    занимают поток, вызывающий поток только ждет итогового результата.
+    
+    Args:
+        model_data: Словарь с данными модели (должен содержать model_type, api_key, api_url, name)
+        prompt: Текст промта
+        timeout: Таймаут запроса в секундах
+        max_retries: Максимальное количество повторов при временной ошибке
+        use_cache: Если False, кэш ответов не читается (свежий ответ все равно сохраняется)
+        cancel_token: Токен, через который запрос можно отменить из другого потока
+        
+    Returns:
+        Словарь с ответом: {'response': str, 'tokens_used': int, 'response_time': float},
+        для ответа из кэша дополнительно 'cached': True
+        
+    Raises:
+        APIError: При ошибке запроса после всех попыток
+        RequestCancelled: Если запрос отменен через cancel_token
+        CircuitOpenError: Если модель недавно была недоступна и запрос не отправлялся
+    """
+    return _engine.run(_async_send_prompt_to_model(model_data, prompt, timeout, max_retries,
+                                                   use_cache=use_cache, cancel_token=cancel_token),
+                       cancel_token)
+
+
+# ==================== Асинхронный движок рассылки ====================
+
+# Потолок одновременных запросов в одной рассылке и лимит соединений к одному хосту
+DEFAULT_MAX_CONCURRENCY = 64
+DEFAULT_PER_HOST_LIMIT = 64
+
+# Температура генерации во всех запросах
+DEFAULT_TEMPERATURE = 0.7
+
+
+class _HostConcurrency:
+    """Адаптивный лимит одновременных запросов к одному хосту API в одном цикле событий."""
+    
+    def __init__(self, limit: float):
+        self.limit = limit
+        self.in_flight = 0
+        self.waiters: deque = deque()
+        # Задержка без нагрузки (долгое среднее) и текущая (среднее за окно), секунды
+        self.long_rtt: Optional[float] = None
+        self.short_rtt: Optional[float] = None
+        self.windows = 0
+        # Текущее окно: начало, сумма и число задержек, наибольшее число запросов в работе
+        self.window_start = time.monotonic()
+        self.window_sum = 0.0
+        self.window_count = 0
+        self.window_in_flight = 0
+        self.last_cut = 0.0
+        self.cuts = 0
+    
+    def wake(self) -> None:
+        while self.waiters and self.in_flight < max(1, int(self.limit)):
+            waiter = self.waiters.popleft()
+            if not waiter.done():
+                self.in_flight += 1
+                waiter.set_result(None)
+
+
+class AdaptiveConcurrency:
+    """
+    Адаптивный лимит одновременных запросов к каждому хосту API (AIMD с градиентом задержки).
+    
+    Лимит не задается заранее, а подбирается по ответам хоста, как у
+    Vegas/Gradient2. Успешные ответы собираются в окна длиной в среднее время
+    ответа (но не короче MIN_WINDOW), лимит пересчитывается раз за окно.
+    Пока средняя задержка окна близка к долгому среднему, лимит растет на
+    sqrt(limit) (со сглаживанием SMOOTHING). Если задержка растет (запросы
+    встают в очередь на стороне API), градиент долгое/текущее среднее с
+    допуском RTT_TOLERANCE уменьшает лимит пропорционально. На
+    429, 5xx, таймаут и обрыв соединения лимит умножается на BACKOFF, но не
+    чаще раза за текущее среднее время ответа, чтобы пачка одновременных
+    отказов считалась одной перегрузкой.
+    
+    Лимит меняется, только если в окне была занята хотя бы половина его:
+    иначе ответы ничего не говорят о пределе API. Лимит общий для всех рассылок процесса
+    к одному хосту и действует внутри потолка max_concurrency рассылки.
+    Подбор включен по умолчанию и выключается настройкой adaptive_concurrency_enabled = 0.
+    """
+    
+    RTT_TOLERANCE = 1.5
+    SMOOTHING = 0.2
+    BACKOFF = 0.7
+    # Минимальная длина окна в секундах и число окон в долгом среднем задержки
+    MIN_WINDOW = 0.05
+    LONG_WINDOW = 30
+    
+    def __init__(self, enabled: bool = True, initial_limit: int = 8, min_limit: int = 1,
+                 max_limit: int = DEFAULT_MAX_CONCURRENCY):
+        """
+        Args:
+            enabled: Подбирать ли лимит (иначе действуют только лимиты рассылки)
+            initial_limit: Начальный лимит для нового хоста
+            min_limit: Нижняя граница лимита
+            max_limit: Верхняя граница лимита
+        """
+        self.enabled = enabled
+        self.initial_limit = initial_limit
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        # Состояние хостов для каждого цикла событий: {ключ хоста: _HostConcurrency}
+        self._hosts: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+        self._loaded = False
+    
+    def load_settings(self) -> None:
+        """Читает параметры из таблицы настроек."""
+        try:
+            enabled = db.get_setting("adaptive_concurrency_enabled")
+            initial = db.get_setting("adaptive_concurrency_initial")
+        except Exception as e:
+            logger.warning(f"Не удалось прочитать настройки адаптивного лимита: {str(e)}")
+            return
+        finally:
+            self._loaded = True
+        if enabled is not None:
+            self.enabled = enabled.strip().lower() in ("1", "true", "yes")
+        if initial:
+            try:
+                self.initial_limit = max(self.min_limit, int(float(initial)))
+            except ValueError:
+                logger.warning(f"Некорректный начальный лимит параллельности в настройках: {initial}")
+    
+    def is_enabled(self) -> bool:
+        """Возвращает True, если лимит подбирается (при первом вызове читает настройки)."""
+        if not self._loaded:
+            self.load_settings()
+        return self.enabled
+    
+    def _host(self, host_key: str) -> _HostConcurrency:
+        hosts = self._hosts.setdefault(asyncio.get_running_loop(), {})
+        host = hosts.get(host_key)
+        if host is None:
+            host = hosts[host_key] = _HostConcurrency(float(self.initial_limit))
+        return host
+    
+    @asynccontextmanager
+    async def slot(self, host_key: str):
+        """Место в лимите хоста на время одной попытки; исход попытки корректирует лимит."""
+        if not self.is_enabled():
+            yield
+            return
+        host = self._host(host_key)
+        if host.in_flight < max(1, int(host.limit)) and not host.waiters:
+            host.in_flight += 1
+        else:
+            waiter = asyncio.get_running_loop().create_future()
+            host.waiters.append(waiter)
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                if waiter.done() and not waiter.cancelled():
+                    # Место уже выдано - передаем его следующему
+                    host.in_flight -= 1
+                    host.wake()
+                else:
+                    host.waiters.remove(waiter)
+                raise
+        
+        in_flight = host.in_flight
+        start_time = time.perf_counter()
+        try:
+            yield
+        except RequestCancelled:
+            raise
+        except APIError as e:
+            if e.retryable:
+                self._on_overload(host)
+            raise
+        else:
+            self._on_success(host, time.perf_counter() - start_time, in_flight)
+        finally:
+            host.in_flight -= 1
+            host.wake()
+    
+    def _on_success(self, host: _HostConcurrency, rtt: float, in_flight: int) -> None:
+        host.window_sum += rtt
+        host.window_count += 1
+        host.window_in_flight = max(host.window_in_flight, in_flight)
+        now = time.monotonic()
+        if now - host.window_start < max(self.MIN_WINDOW, host.short_rtt or 0.0):
+            return
+        host.short_rtt = host.window_sum / host.window_count
+        window_in_flight = host.window_in_flight
+        host.window_start = now
+        host.window_sum = 0.0
+        host.window_count = 0
+        host.window_in_flight = 0
+        
+        # Долгое среднее: первые LONG_WINDOW окон - простое, дальше - экспоненциальное
+        host.windows += 1
+        if host.long_rtt is None:
+            host.long_rtt = host.short_rtt
+        else:
+            host.long_rtt += (host.short_rtt - host.long_rtt) / min(host.windows, self.LONG_WINDOW)
+        # Долгое среднее, оставшееся от прошлой перегрузки, постепенно возвращается к текущему
+        if host.long_rtt > 2 * host.short_rtt:
+            host.long_rtt *= 0.95
+        if window_in_flight < host.limit / 2:
+            return
+        gradient = max(0.5, min(1.0, self.RTT_TOLERANCE * host.long_rtt / host.short_rtt))
+        target = host.limit * gradient + math.sqrt(host.limit)
+        limit = host.limit * (1 - self.SMOOTHING) + target * self.SMOOTHING
+        host.limit = max(float(self.min_limit), min(float(self.max_limit), limit))
+    
+    def _on_overload(self, host: _HostConcurrency) -> None:
+        now = time.monotonic()
+        if now - host.last_cut < (host.short_rtt or 1.0):
+            return
+        host.last_cut = now
+        host.cuts += 1
+        host.limit = max(float(self.min_limit), host.limit * self.BACKOFF)
+        logger.info(f"Перегрузка API: лимит одновременных запросов снижен до {int(host.limit)}")
+    
+    def state(self) -> List[Dict]:
+        """
+        Текущее состояние лимитов (для строки состояния и бенчмарков).
+        
+        Returns:
+            Список словарей: host, limit, in_flight, waiting, rtt (текущее среднее, с), cuts
+        """
+        result = []
+        for hosts in list(self._hosts.values()):
+            for host_key, host in list(hosts.items()):
+                result.append({
+                    'host': host_key,
+                    'limit': max(1, int(host.limit)),
+                    'in_flight': host.in_flight,
+                    'waiting': len(host.waiters),
+                    'rtt': host.short_rtt,
+                    'cuts': host.cuts,
+                })
+        return result
+    
+    def reset(self) -> None:
+        """Забывает подобранные лимиты (следующие запросы начнут с initial_limit)."""
+        self._hosts = weakref.WeakKeyDictionary()
+
+
+# Общие для всего процесса адаптивные лимиты хостов
+_adaptive_concurrency = AdaptiveConcurrency()
+
+
+def configure_adaptive_concurrency(enabled: Optional[bool] = None, initial_limit: Optional[int] = None,
+                                   max_limit: Optional[int] = None) -> None:
+    """
+    Настраивает адаптивный лимит одновременных запросов к хостам API.
+    
+    Без аргументов перечитывает параметры из таблицы настроек. Подобранные
+    лимиты при этом сбрасываются.
+    
+    Args:
+        enabled: Подбирать ли лимит
+        initial_limit: Начальный лимит для хоста
+        max_limit: Верхняя граница лимита
+    """
+    if enabled is None and initial_limit is None and max_limit is None:
+        _adaptive_concurrency.load_settings()
+    else:
+        if enabled is not None:
+            _adaptive_concurrency.enabled = enabled
+        if initial_limit is not None:
+            _adaptive_concurrency.initial_limit = max(_adaptive_concurrency.min_limit, initial_limit)
+        if max_limit is not None:
+            _adaptive_concurrency.max_limit = max(_adaptive_concurrency.min_limit, max_limit)
+        _adaptive_concurrency._loaded = True
+    _adaptive_concurrency.reset()
+
+
+def get_concurrency_state() -> List[Dict]:
+    """Текущие адаптивные лимиты хостов (см. AdaptiveConcurrency.state); пустой список, если выключены."""
+    if not _adaptive_concurrency.enabled:
+        return []
+    return _adaptive_concurrency.state()
+
+
+class JSONCodec:
+    """Кодек тел запросов и ответов на стандартном модуле json."""
+    
+    name = "json"
+    
+    @staticmethod
+    def dumps(data) -> bytes:
+        """Кодирует объект в JSON (UTF-8)."""
+        return json.dumps(data, ensure_ascii=False).encode('utf-8')
+    
+    @staticmethod
+    def loads(data):
+        """Разбирает JSON из bytes или str; при ошибке выбрасывает ValueError."""
+        return json.loads(data)
+
+
+class OrjsonCodec(JSONCodec):
+    """Кодек на orjson: кодирует сразу в bytes и разбирает в несколько раз быстрее json."""
+    
+    name = "orjson"
+    
+    @staticmethod
+    def dumps(data) -> bytes:
+        return orjson.dumps(data)
+    
+    @staticmethod
+    def loads(data):
+        return orjson.loads(data)
+
+
+# Кодек, которым кодируются запросы и разбираются ответы API
+_codec: JSONCodec = OrjsonCodec() if orjson is not None else JSONCodec()
+
+
+def set_json_codec(codec: JSONCodec) -> None:
+    """Заменяет кодек JSON для запросов и ответов API (объект с методами dumps и loads)."""
+    global _codec
+    _codec = codec
+
+
+class ProviderAdapter:
+    """
+    Адаптер OpenAI-совместимого провайдера chat/completions.
+    
+    Знает адрес API по умолчанию и дополнительные заголовки провайдера.
+    Заголовки для каждого API-ключа собираются один раз и переиспользуются
+    всеми запросами (клиенты HTTP их не изменяют). Провайдер с другим
+    форматом запроса или ответа переопределяет payload и parse_completion.
+    """
+    
+    def __init__(self, name: str, default_url: str, extra_headers: Optional[Dict[str, str]] = None):
+        """
+        Args:
+            name: Тип модели (models.model_type), которому соответствует адаптер
+            default_url: URL chat/completions, если у модели не задан api_url
+            extra_headers: Дополнительные заголовки каждого запроса
+        """
+        self.name = name
+        self.default_url = default_url
+        self.extra_headers = extra_headers or {}
+        self._headers: Dict[str, Dict[str, str]] = {}
+    
+    def url(self, model_data: Dict) -> str:
+        """Возвращает URL API модели."""
+        return model_data.get('api_url') or self.default_url
+    
+    def headers(self, api_key: str) -> Dict[str, str]:
+        """Возвращает заголовки запроса для API-ключа."""
+        headers = self._headers.get(api_key)
+        if headers is None:
+            headers = {
+                "Authorization": f"Bearer {api_key}",
+                "Content-Type": "application/json",
+                **self.extra_headers
+            }
+            self._headers[api_key] = headers
+        return headers
+    
+    def model_name(self, model_data: Dict) -> str:
+        """Возвращает имя модели в API."""
+        return _model_resolver.resolve(model_data, self.name)
+    
+    def payload(self, model_name: str, messages: List[Dict], stream: bool = False) -> Dict:
+        """Формирует тело запроса chat/completions."""
+        payload = {
+            "model": model_name,
+            "messages": messages,
+            "temperature": DEFAULT_TEMPERATURE
+        }
+        if stream:
+            payload["stream"] = True
+        return payload
+    
+    def parse_completion(self, data: Dict) -> tuple:
+        """Извлекает (текст ответа, количество токенов) из ответа API."""
+        return _parse_completion(data)
+
+
+# Адаптеры провайдеров по типу модели; неизвестные типы обслуживает 'generic'
+_providers: Dict[str, ProviderAdapter] = {}
+
+
+def register_provider(adapter: ProviderAdapter) -> None:
+    """Регистрирует (или заменяет) адаптер провайдера для типа модели adapter.name."""
+    _providers[adapter.name.lower()] = adapter
+
+
+def get_provider(model_type: Optional[str]) -> ProviderAdapter:
+    """Возвращает адаптер для типа модели (OpenAI-совместимый generic для неизвестных типов)."""
+    return _providers.get((model_type or 'openai').lower()) or _providers['generic']
+
+
+register_provider(ProviderAdapter('openai', 'https://api.openai.com/v1/chat/completions'))
+register_provider(ProviderAdapter('deepseek', 'https://api.deepseek.com/v1/chat/completions'))
+register_provider(ProviderAdapter('groq', 'https://api.groq.com/openai/v1/chat/completions'))
+register_provider(ProviderAdapter('openrouter', 'https://openrouter.ai/api/v1/chat/completions',
+                                  {"HTTP-Referer": "https://github.com/chatlist", "X-Title": "ChatList"}))
+register_provider(ProviderAdapter('generic', 'https://openrouter.ai/api/v1/chat/completions'))
+
+
+def _build_request_url(model_data: Dict) -> str:
+    """Возвращает URL API модели (с учетом адреса по умолчанию для ее типа)."""
+    return get_provider(model_data.get('model_type')).url(model_data)
+
+
+def _resolve_model_name(model_data: Dict) -> str:
+    """Возвращает имя модели, которое передается в API для ее типа."""
+    return get_provider(model_data.get('model_type')).model_name(model_data)
+
+
+def _build_request(model_data: Dict, messages: List[Dict], stream: bool = False) -> tuple:
+    """
+    Формирует URL, заголовки и закодированное тело запроса chat/completions.
     
+    Returns:
+        Кортеж (api_url, headers, body, model_name)
+        
+    Raises:
+        APIError: Если не найден API-ключ
+    """
+    api_key = model_data.get('api_key')
     if not api_key:
         api_id = model_data.get('api_id', 'N/A')
         raise APIError(f"API-ключ не найден. Проверьте переменную окружения '{api_id}' в файле .env")
     
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json"
+    provider = get_provider(model_data.get('model_type'))
+    model_name = provider.model_name(model_data)
+    body = _codec.dumps(provider.payload(model_name, messages, stream))
+    return provider.url(model_data), provider.headers(api_key), body, model_name
+
+
+def _parse_completion(data: Dict) -> tuple:
+    """
+    Извлекает текст ответа и количество токенов из ответа chat/completions.
+    
+    Returns:
+        Кортеж (response_text, tokens_used)
+    """
+    try:
+        response_text = data['choices'][0]['message']['content']
+        usage = data.get('usage')
+        tokens_used = usage.get('total_tokens') if usage is not None else None
+    except (KeyError, IndexError, TypeError, AttributeError):
+        raise APIError("Неожиданный формат ответа от API")
+    return response_text, tokens_used
+
+
+class _AsyncEngine:
+    """
+    Фоновый цикл событий asyncio для синхронных оберток над асинхронным API.
+    
+    Цикл работает в отдельном daemon-потоке и живет все время работы процесса,
+    поэтому все рассылки используют одну и ту же aiohttp-сессию и ее пул соединений.
+    """
+    
+    def __init__(self):
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._lock = threading.Lock()
+    
+    def _ensure_started(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(
+                    target=self._loop.run_forever, name="network-async-engine", daemon=True
+                )
+                self._thread.start()
+            return self._loop
+    
+    def submit(self, coro) -> Future:
+        """Запускает корутину в фоновом цикле и возвращает concurrent.futures.Future."""
+        loop = self._ensure_started()
+        if threading.current_thread() is self._thread:
+            coro.close()
+            raise RuntimeError("Синхронную обертку нельзя вызывать из цикла движка; используйте await")
+        return asyncio.run_coroutine_threadsafe(coro, loop)
+    
+    def run(self, coro, cancel_token: Optional[CancelToken] = None):
+        """
+        Выполняет корутину в фоновом цикле и ждет результата.
+        
+        cancel_token.cancel() отменяет корутину в цикле, а ожидающий
+        поток получает RequestCancelled.
+        """
+        future = self.submit(coro)
+        if cancel_token is None:
+            return future.result()
+        remove_callback = cancel_token.add_callback(future.cancel)
+        try:
+            return future.result()
+        except CancelledError:
+            raise RequestCancelled()
+        finally:
+            remove_callback()
+    
+    def call_soon(self, callback: Callable[[], None]) -> None:
+        """Вызывает callback в потоке цикла (например, чтобы отменить задачу)."""
+        self._ensure_started().call_soon_threadsafe(callback)
+    
+    def is_started(self) -> bool:
+        return self._loop is not None
+
+
+_engine = _AsyncEngine()
+
+# aiohttp-сессии (с общим коннектором) для каждого цикла событий
+_client_sessions: "weakref.WeakKeyDictionary" = weakref.WeakKeyDictionary()
+
+
+def _get_client_session():
+    """Возвращает общую aiohttp-сессию текущего цикла событий, создавая ее при первом обращении."""
+    loop = asyncio.get_running_loop()
+    session = _client_sessions.get(loop)
+    if session is None or session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=0,  # Общий потолок задается семафором рассылки
+            limit_per_host=DEFAULT_PER_HOST_LIMIT,
+            keepalive_timeout=_session_pool.idle_timeout,
+        )
+        session = aiohttp.ClientSession(connector=connector, trace_configs=[_make_trace_config()])
+        _client_sessions[loop] = session
+    return session
+
+
+def _make_trace_config():
+    """
+    Трассировка aiohttp для разбивки времени запроса: длительность установки
+    нового соединения (DNS, TCP, TLS) записывается в trace_request_ctx['connect'].
+    """
+    trace_config = aiohttp.TraceConfig()
+    
+    async def on_connection_create_start(session, context, params):
+        context.connect_start = time.perf_counter()
+    
+    async def on_connection_create_end(session, context, params):
+        if context.trace_request_ctx is not None:
+            context.trace_request_ctx['connect'] = time.perf_counter() - context.connect_start
+    
+    trace_config.on_connection_create_start.append(on_connection_create_start)
+    trace_config.on_connection_create_end.append(on_connection_create_end)
+    return trace_config
+
+
+def _attempt_timings(start_time: float, headers_time: float, body_time: float, end_time: float,
+                     connect: Optional[float], bytes_sent: int, bytes_received: int) -> Dict:
+    """
+    Разбивка времени одной попытки по этапам (в секундах, по time.perf_counter).
+    
+    ttfb - от отправки до заголовков ответа (включая connect), download - чтение
+    тела, parse - разбор JSON. connect равен 0, если соединение взято из пула,
+    и None, если клиент его не измеряет.
+    """
+    return {
+        'connect': connect,
+        'ttfb': headers_time - start_time,
+        'download': body_time - headers_time,
+        'parse': end_time - body_time,
+        'bytes_sent': bytes_sent,
+        'bytes_received': bytes_received,
     }
+
+
+async def _close_client_session() -> None:
+    """Закрывает aiohttp-сессию текущего цикла событий."""
+    session = _client_sessions.pop(asyncio.get_running_loop(), None)
+    if session is not None and not session.closed:
+        await session.close()
+
+
+async def _async_raise_for_status(response, model_data: Dict, model_name: str) -> None:
+    """Асинхронный аналог _raise_for_status для ответа aiohttp."""
+    if response.status == 400:
+        try:
+            error_data = await response.json(content_type=None)
+            error_message = error_data.get('error', {}).get('message', 'Bad Request')
+        except (ValueError, KeyError, TypeError, AttributeError):
+            error_text = (await response.text())[:200] or 'Unknown error'
+            raise APIError(f"Ошибка 400 Bad Request. Используемая модель: {model_name}. "
+                           f"Оригинальное название: {model_data.get('name')}. Ответ сервера: {error_text}",
+                           status=400)
+        raise APIError(f"Ошибка 400: {error_message}. Используемая модель: {model_name}. "
+                       f"Оригинальное название: {model_data.get('name')}", status=400)
+    if response.status >= 400:
+        raise _status_error(response.status, response.reason, response.headers.get('Retry-After'), model_data)
+
+
+def _decode_response(raw: bytes, status: int, model_data: Dict) -> Dict:
+    """
+    Разбирает JSON тела успешного ответа.
     
-    # Определяем имя модели из URL или используем по умолчанию
-    model_name = model_data.get('name', 'gpt-4')
-    if 'gpt-4' in model_name.lower():
-        model_name = 'gpt-4'
-    elif 'gpt-3.5' in model_name.lower():
-        model_name = 'gpt-3.5-turbo'
-    else:
-        model_name = 'gpt-4'  # По умолчанию
-    
-    payload = {
-        "model": model_name,
-        "messages": [
-            {"role": "user", "content": prompt}
-        ],
-        "temperature": 0.7
+    Битое тело - не сбой сети: повтор получит тот же ответ, поэтому ошибка
+    не повторяемая и не считается ни недоступностью модели, ни перегрузкой.
+    """
+    try:
+        return _codec.loads(raw)
+    except ValueError as e:
+        raise APIError(f"Некорректный JSON в ответе {model_data.get('name')}: {str(e)}", status=status)
+
+
+async def _async_request(model_data: Dict, messages: List[Dict], timeout: int) -> Dict:
+    """
+    Выполняет одну попытку запроса к модели через aiohttp.
+    
+    Returns:
+        Словарь с ответом: {'response': str, 'tokens_used': int, 'response_time': float,
+        'timings': разбивка времени по этапам (см. _attempt_timings)}
+        
+    Raises:
+        APIError: При ошибке запроса
+    """
+    api_url, headers, body, model_name = _build_request(model_data, messages)
+    session = _get_client_session()
+    trace = {'connect': 0.0}
+    start_time = time.perf_counter()
+    
+    try:
+        async with session.post(api_url, data=body, headers=headers, trace_request_ctx=trace,
+                                timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+            headers_time = time.perf_counter()
+            await _async_raise_for_status(response, model_data, model_name)
+            raw = await response.read()
+        body_time = time.perf_counter()
+    except APIError:
+        raise
+    except asyncio.TimeoutError:
+        raise APIError(f"Таймаут запроса к {model_data.get('name')}", retryable=True)
+    except aiohttp.ClientError as e:
+        raise APIError(f"Ошибка запроса к {model_data.get('name')}: {str(e)}", retryable=True)
+    data = _decode_response(raw, response.status, model_data)
+    
+    response_text, tokens_used = get_provider(model_data.get('model_type')).parse_completion(data)
+    end_time = time.perf_counter()
+    response_time = end_time - start_time
+    
+    logger.info(f"Запрос к {model_data.get('name')} (модель: {model_name}) выполнен за {response_time:.2f}с")
+    
+    return {
+        'response': response_text,
+        'tokens_used': tokens_used,
+        'response_time': response_time,
+        'timings': _attempt_timings(start_time, headers_time, body_time, end_time,
+                                    trace['connect'], len(body), len(raw))
+    }
+
+
+def _request_sync(model_data: Dict, messages: List[Dict], timeout: int) -> Dict:
+    """Синхронный аналог _async_request: одна попытка через пул сессий requests."""
+    api_url, headers, body, model_name = _build_request(model_data, messages)
+    start_time = time.perf_counter()
+    
+    try:
+        response = _post(api_url, data=body, headers=headers, timeout=timeout)
+        body_time = time.perf_counter()
+        _raise_for_status(response, model_data, model_name)
+    except requests.exceptions.Timeout:
+        raise APIError(f"Таймаут запроса к {model_data.get('name')}", retryable=True)
+    except requests.exceptions.RequestException as e:
+        raise APIError(f"Ошибка запроса к {model_data.get('name')}: {str(e)}", retryable=True)
+    data = _decode_response(response.content, response.status_code, model_data)
+    
+    response_text, tokens_used = get_provider(model_data.get('model_type')).parse_completion(data)
+    end_time = time.perf_counter()
+    response_time = end_time - start_time
+    # requests отмеряет elapsed до разбора заголовков, установку соединения не измеряет
+    headers_time = min(start_time + response.elapsed.total_seconds(), body_time)
+    
+    logger.info(f"Запрос к {model_data.get('name')} (модель: {model_name}) выполнен за {response_time:.2f}с")
+    
+    return {
+        'response': response_text,
+        'tokens_used': tokens_used,
+        'response_time': response_time,
+        'timings': _attempt_timings(start_time, headers_time, body_time, end_time,
+                                    None, len(body), len(response.content))
     }
+
+
+# ==================== Потоковая выдача ответа (SSE) ====================
+
+# Маркер конца SSE-потока ("data: [DONE]")
+_SSE_DONE = object()
+
+
+def _parse_sse_line(line: str):
+    """
+    Разбирает одну строку SSE-потока chat/completions.
+    
+    Returns:
+        Словарь с фрагментом ответа, _SSE_DONE для конца потока или None
+        для пустых строк, комментариев (": OPENROUTER PROCESSING") и мусора
+    """
+    line = line.strip()
+    if not line.startswith('data:'):
+        return None
+    data = line[5:].strip()
+    if data == '[DONE]':
+        return _SSE_DONE
+    try:
+        return _codec.loads(data)
+    except ValueError:
+        return None
+
+
+def _stream_delta(chunk: Dict, model_data: Dict) -> str:
+    """Возвращает текст из фрагмента потока; ошибка внутри потока превращается в APIError."""
+    if 'error' in chunk:
+        error_message = chunk['error'].get('message', 'Unknown error') if isinstance(chunk['error'], dict) else chunk['error']
+        # Ошибка до первого фрагмента (например, лимит провайдера) обычно временная
+        raise APIError(f"Ошибка в потоке ответа {model_data.get('name')}: {error_message}", retryable=True)
+    choices = chunk.get('choices') or []
+    if not choices:
+        return ''
+    return (choices[0].get('delta') or {}).get('content') or ''
+
+
+def _raise_for_status(response: requests.Response, model_data: Dict, model_name: str) -> None:
+    """
+    Проверяет HTTP-статус ответа, для 400 добавляет подробности об ошибке.
+    
+    Ошибки 429 и 5xx помечаются как повторяемые, Retry-After передается в APIError.
+    """
+    if response.status_code == 400:
+        try:
+            error_data = response.json()
+            error_message = error_data.get('error', {}).get('message', 'Bad Request')
+        except (ValueError, KeyError, TypeError, AttributeError):
+            error_text = response.text[:200] if response.text else 'Unknown error'
+            raise APIError(f"Ошибка 400 Bad Request. Используемая модель: {model_name}. "
+                           f"Оригинальное название: {model_data.get('name')}. Ответ сервера: {error_text}",
+                           status=400)
+        raise APIError(f"Ошибка 400: {error_message}. Используемая модель: {model_name}. "
+                       f"Оригинальное название: {model_data.get('name')}", status=400)
+    if response.status_code >= 400:
+        raise _status_error(response.status_code, response.reason, response.headers.get('Retry-After'),
+                            model_data)
+
+
+def _iter_stream(model_data: Dict, messages: List[Dict], timeout: int,
+                 state: Optional[Dict] = None) -> Iterator[Dict]:
+    """
+    Отправляет запрос с stream=true через пул сессий и выдает разобранные фрагменты SSE.
     
-    start_time = time.time()
+    Таймаут ограничивает подключение и паузу между фрагментами, а не весь ответ,
+    поэтому длинные ответы не обрываются. Если передан state (см. _stream_state),
+    в него записываются время получения заголовков, объем и время разбора потока.
+    """
+    api_url, headers, body, model_name = _build_request(model_data, messages, stream=True)
+    if state is None:
+        state = _stream_state()
+    state['bytes_sent'] = len(body)
     
     try:
-        response = requests.post(api_url, json=payload, headers=headers, timeout=timeout)
-        response.raise_for_status()
-        
-        response_time = time.time() - start_time
-        data = response.json()
-        
-        # Извлекаем ответ
-        if 'choices' in data and len(data['choices']) > 0:
-            response_text = data['choices'][0]['message']['content']
-        else:
-            raise APIError("Неожиданный формат ответа от API")
-        
-        # Извлекаем информацию о токенах
-        tokens_used = None
-        if 'usage' in data:
-            tokens_used = data['usage'].get('total_tokens')
-        
-        logger.info(f"Запрос к {model_data.get('name')} выполнен за {response_time:.2f}с")
-        
-        return {
-            'response': response_text,
-            'tokens_used': tokens_used,
-            'response_time': response_time
-        }
-        
+        with _session_pool.session(api_url) as session:
+            with session.post(api_url, data=body, headers=headers,
+                              timeout=(timeout, timeout), stream=True) as response:
+                state['headers_time'] = time.perf_counter()
+                _raise_for_status(response, model_data, model_name)
+                # text/event-stream часто приходит без charset, requests тогда считает его latin-1
+                response.encoding = 'utf-8'
+                for line in response.iter_lines(decode_unicode=True):
+                    parse_start = time.perf_counter()
+                    line = line or ''
+                    state['bytes_received'] += len(line.encode('utf-8')) + 1
+                    chunk = _parse_sse_line(line)
+                    state['parse'] += time.perf_counter() - parse_start
+                    if chunk is _SSE_DONE:
+                        return
+                    if chunk is not None:
+                        yield chunk
     except requests.exceptions.Timeout:
-        raise APIError(f"Таймаут запроса к {model_data.get('name')}")
+        raise APIError(f"Таймаут запроса к {model_data.get('name')}", retryable=True)
     except requests.exceptions.RequestException as e:
-        raise APIError(f"Ошибка запроса к {model_data.get('name')}: {str(e)}")
+        raise APIError(f"Ошибка запроса к {model_data.get('name')}: {str(e)}", retryable=True)
 
 
-def send_request_to_deepseek(model_data: Dict, prompt: str, timeout: int = 30) -> Dict:
+def stream_prompt_to_model(model_data: Dict, prompt: str, timeout: int = 30) -> Iterator[str]:
     """
-    Отправляет запрос к DeepSeek API.
+    Отправляет промт в модель в потоковом режиме (stream=true).
+    
+    Генератор выдает фрагменты текста ответа по мере их поступления от API.
     
     Args:
-        model_data: Словарь с данными модели
+        model_data: Словарь с данными модели (model_type, api_key, api_url, name)
         prompt: Текст промта
-        timeout: Таймаут запроса в секундах
-        
-    Returns:
-        Словарь с ответом: {'response': str, 'tokens_used': int, 'response_time': float}
+        timeout: Таймаут подключения и ожидания очередного фрагмента в секундах
         
     Raises:
         APIError: При ошибке запроса
     """
-    api_key = model_data.get('api_key')
-    api_url = model_data.get('api_url')
-    
-    if not api_key:
-        api_id = model_data.get('api_id', 'N/A')
-        raise APIError(f"API-ключ не найден. Проверьте переменную окружения '{api_id}' в файле .env")
-    
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json"
-    }
+    messages = [{"role": "user", "content": prompt}]
+    reservation = _rate_limiter.acquire_blocking(model_data, messages)
+    tokens_used = None
+    for chunk in _iter_stream(model_data, messages, timeout):
+        if chunk.get('usage'):
+            tokens_used = chunk['usage'].get('total_tokens')
+        delta = _stream_delta(chunk, model_data)
+        if delta:
+            yield delta
+    _rate_limiter.settle(reservation, tokens_used)
+
+
+def _collect_stream(chunks, model_data: Dict, on_chunk: Callable[[str], None], start_time: float,
+                    state: Dict) -> None:
+    """Обрабатывает очередной фрагмент потока: передает текст в on_chunk и копит ответ в state."""
+    for chunk in chunks:
+        delta = _stream_delta(chunk, model_data)
+        if chunk.get('usage'):
+            state['tokens_used'] = chunk['usage'].get('total_tokens')
+        if delta:
+            if state['first_token_time'] is None:
+                state['first_token_time'] = time.perf_counter() - start_time
+            state['parts'].append(delta)
+            on_chunk(delta)
+
+
+def _stream_state(connect: Optional[float] = None) -> Dict:
+    """Создает состояние потокового запроса: накопленный ответ и данные для разбивки времени."""
+    return {'parts': [], 'tokens_used': None, 'first_token_time': None, 'headers_time': None,
+            'connect': connect, 'parse': 0.0, 'bytes_sent': 0, 'bytes_received': 0}
+
+
+def _stream_result(state: Dict, start_time: float) -> Dict:
+    """
+    Формирует итоговый словарь ответа из накопленного потока.
     
-    payload = {
-        "model": "deepseek-chat",
-        "messages": [
-            {"role": "user", "content": prompt}
-        ],
-        "temperature": 0.7
+    В разбивке времени download - чтение потока без учета времени разбора SSE.
+    """
+    end_time = time.perf_counter()
+    headers_time = state['headers_time'] or end_time
+    return {
+        'response': ''.join(state['parts']),
+        'tokens_used': state['tokens_used'],
+        'response_time': end_time - start_time,
+        'first_token_time': state['first_token_time'],
+        'timings': _attempt_timings(start_time, headers_time, end_time - state['parse'], end_time,
+                                    state['connect'], state['bytes_sent'], state['bytes_received'])
     }
+
+
+def _stream_request_sync(model_data: Dict, messages: List[Dict], timeout: int,
+                         on_chunk: Callable[[str], None]) -> Dict:
+    """Выполняет потоковый запрос синхронным клиентом, передавая фрагменты в on_chunk."""
+    start_time = time.perf_counter()
+    state = _stream_state()
+    _collect_stream(_iter_stream(model_data, messages, timeout, state), model_data, on_chunk, start_time, state)
+    return _stream_result(state, start_time)
+
+
+async def _async_stream_request(model_data: Dict, messages: List[Dict], timeout: int,
+                                on_chunk: Callable[[str], None]) -> Dict:
+    """
+    Выполняет одну попытку потокового запроса через aiohttp.
     
-    start_time = time.time()
+    Returns:
+        Словарь с ответом, как у _async_request, плюс 'first_token_time'
+        (в разбивке времени download не включает время разбора SSE)
+    """
+    api_url, headers, body, model_name = _build_request(model_data, messages, stream=True)
+    session = _get_client_session()
+    start_time = time.perf_counter()
+    state = _stream_state(connect=0.0)
+    state['bytes_sent'] = len(body)
     
     try:
-        response = requests.post(api_url, json=payload, headers=headers, timeout=timeout)
-        response.raise_for_status()
-        
-        response_time = time.time() - start_time
-        data = response.json()
-        
-        if 'choices' in data and len(data['choices']) > 0:
-            response_text = data['choices'][0]['message']['content']
-        else:
-            raise APIError("Неожиданный формат ответа от API")
-        
-        tokens_used = None
-        if 'usage' in data:
-            tokens_used = data['usage'].get('total_tokens')
-        
-        logger.info(f"Запрос к {model_data.get('name')} выполнен за {response_time:.2f}с")
-        
-        return {
-            'response': response_text,
-            'tokens_used': tokens_used,
-            'response_time': response_time
-        }
-        
-    except requests.exceptions.Timeout:
-        raise APIError(f"Таймаут запроса к {model_data.get('name')}")
-    except requests.exceptions.RequestException as e:
-        raise APIError(f"Ошибка запроса к {model_data.get('name')}: {str(e)}")
+        async with session.post(api_url, data=body, headers=headers, trace_request_ctx=state,
+                                timeout=aiohttp.ClientTimeout(total=None, sock_connect=timeout,
+                                                              sock_read=timeout)) as response:
+            state['headers_time'] = time.perf_counter()
+            await _async_raise_for_status(response, model_data, model_name)
+            async for raw_line in response.content:
+                parse_start = time.perf_counter()
+                state['bytes_received'] += len(raw_line)
+                chunk = _parse_sse_line(raw_line.decode('utf-8', errors='replace'))
+                state['parse'] += time.perf_counter() - parse_start
+                if chunk is _SSE_DONE:
+                    break
+                if chunk is not None:
+                    _collect_stream((chunk,), model_data, on_chunk, start_time, state)
+    except APIError:
+        raise
+    except asyncio.TimeoutError:
+        raise APIError(f"Таймаут запроса к {model_data.get('name')}", retryable=True)
+    except aiohttp.ClientError as e:
+        raise APIError(f"Ошибка запроса к {model_data.get('name')}: {str(e)}", retryable=True)
+    
+    result = _stream_result(state, start_time)
+    logger.info(f"Потоковый запрос к {model_data.get('name')} (модель: {model_name}) "
+                f"выполнен за {result['response_time']:.2f}с")
+    return result
 
 
-def send_request_to_groq(model_data: Dict, prompt: str, timeout: int = 30) -> Dict:
+async def _async_send_prompt_to_model(model_data: Dict, prompt: str, timeout: int = 30,
+                                      max_retries: int = 2,
+                                      executor: Optional[ThreadPoolExecutor] = None,
+                                      on_chunk: Optional[Callable[[str], None]] = None,
+                                      use_cache: bool = True,
+                                      slot: Optional[Callable] = None,
+                                      cancel_token: Optional[CancelToken] = None) -> Dict:
     """
-    Отправляет запрос к Groq API.
+    Асинхронный аналог send_prompt_to_model с той же retry-логикой.
     
-    Args:
-        model_data: Словарь с данными модели
-        prompt: Текст промта
-        timeout: Таймаут запроса в секундах
-        
-    Returns:
-        Словарь с ответом: {'response': str, 'tokens_used': int, 'response_time': float}
-        
-    Raises:
-        APIError: При ошибке запроса
-    """
-    api_key = model_data.get('api_key')
-    api_url = model_data.get('api_url')
+    Если передан on_chunk, ответ запрашивается в потоковом режиме и каждый
+    фрагмент текста передается в on_chunk сразу по получении. Попытка, которая
+    уже выдала часть ответа, не повторяется, чтобы текст не задвоился.
     
-    if not api_key:
-        api_id = model_data.get('api_id', 'N/A')
-        raise APIError(f"API-ключ не найден. Проверьте переменную окружения '{api_id}' в файле .env")
+    Если aiohttp не установлен, каждая попытка выполняется синхронным клиентом
+    в executor, а ожидание между попытками не занимает поток.
     
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json"
-    }
+    Ответ из кэша (если кэш включен и use_cache=True) возвращается без запроса,
+    а в on_chunk передается целиком одним фрагментом.
     
-    # Определяем модель из названия
-    model_name = "llama-3-8b-8192"  # По умолчанию
-    if 'llama-3' in model_data.get('name', '').lower():
-        model_name = "llama-3-8b-8192"
-    elif 'mixtral' in model_data.get('name', '').lower():
-        model_name = "mixtral-8x7b-32768"
-    
-    payload = {
-        "model": model_name,
-        "messages": [
-            {"role": "user", "content": prompt}
-        ],
-        "temperature": 0.7
-    }
+    slot - фабрика асинхронного контекстного менеджера, который занимается на
+    время каждой попытки (например, место в общем лимите параллельных запросов).
+    
+    cancel_token проверяется перед каждой попыткой; активную попытку прерывает
+    отмена самой задачи asyncio.
+    """
+    messages = [{"role": "user", "content": prompt}]
+    return await _async_send_messages(model_data, messages, timeout, max_retries, executor,
+                                      on_chunk, use_cache, slot, cancel_token)
+
+
+async def _async_send_messages(model_data: Dict, messages: List[Dict], timeout: int = 30,
+                               max_retries: int = 2,
+                               executor: Optional[ThreadPoolExecutor] = None,
+                               on_chunk: Optional[Callable[[str], None]] = None,
+                               use_cache: bool = True,
+                               slot: Optional[Callable] = None,
+                               cancel_token: Optional[CancelToken] = None) -> Dict:
+    """
+    То же, что _async_send_prompt_to_model, для готового списка сообщений.
+    
+    Каждый запрос (в том числе ответ из кэша и неудачный) записывается
+    в _metrics_recorder; 'request_id' ответа связывает его с записью метрик.
     
-    start_time = time.time()
+    Одинаковые запросы, выполняющиеся одновременно, объединяет _single_flight:
+    в API уходит только первый, остальные получают копию его ответа с
+    'shared': True (или его ошибку) и слот не занимают.
+    """
+    request_id = uuid.uuid4().hex
+    streamed = on_chunk is not None
+    key = ResponseCache.make_key(model_data, messages)
+    if not _response_cache._loaded:
+        await asyncio.get_running_loop().run_in_executor(None, _response_cache.load_settings)
+    cache_enabled = _response_cache.is_enabled()
+    if cache_enabled:
+        cached = None
+        if use_cache:
+            # Чтение (и обновление last_used) в базе выполняется вне цикла событий
+            cached = await asyncio.get_running_loop().run_in_executor(None, _response_cache.get, key)
+        if cached is not None:
+            if on_chunk is not None:
+                on_chunk(cached['response'])
+            cached['request_id'] = request_id
+            cached['timings'] = {'total': cached['response_time'], 'retries': 0}
+            _record_metrics(model_data, request_id, streamed, response_data=cached)
+            return cached
+    
+    async def request(emit: Optional[Callable[[str], None]]) -> Dict:
+        # Общий запрос отменяется вместе с последним ожидающим его, поэтому
+        # cancel_token первого из них в попытки не передается
+        response_data = await _async_send_attempts(model_data, messages, timeout, max_retries,
+                                                   executor, emit, slot)
+        if cache_enabled:
+            # Запись в базу выполняется вне цикла событий
+            await asyncio.get_running_loop().run_in_executor(
+                None, _response_cache.put, key, model_data, response_data
+            )
+        return response_data
     
+    remove_callback = None
+    if cancel_token is not None:
+        cancel_token.raise_if_cancelled()
+        # Токен отменяет ожидание ответа, а общий запрос - только если его больше никто не ждет
+        loop = asyncio.get_running_loop()
+        task = asyncio.current_task()
+        remove_callback = cancel_token.add_callback(lambda: loop.call_soon_threadsafe(task.cancel))
+    start_time = time.perf_counter()
     try:
-        response = requests.post(api_url, json=payload, headers=headers, timeout=timeout)
-        response.raise_for_status()
-        
-        response_time = time.time() - start_time
-        data = response.json()
-        
-        if 'choices' in data and len(data['choices']) > 0:
-            response_text = data['choices'][0]['message']['content']
-        else:
-            raise APIError("Неожиданный формат ответа от API")
-        
-        tokens_used = None
-        if 'usage' in data:
-            tokens_used = data['usage'].get('total_tokens')
-        
-        logger.info(f"Запрос к {model_data.get('name')} выполнен за {response_time:.2f}с")
-        
-        return {
-            'response': response_text,
-            'tokens_used': tokens_used,
-            'response_time': response_time
-        }
-        
-    except requests.exceptions.Timeout:
-        raise APIError(f"Таймаут запроса к {model_data.get('name')}")
-    except requests.exceptions.RequestException as e:
-        raise APIError(f"Ошибка запроса к {model_data.get('name')}: {str(e)}")
+        response_data, shared = await _single_flight.run(key, request, on_chunk)
+    except (RequestCancelled, CircuitOpenError):
+        # Запрос в API не отправлялся
+        raise
+    except APIError as e:
+        _record_metrics(model_data, request_id, streamed, error=e)
+        raise
+    finally:
+        if remove_callback is not None:
+            remove_callback()
+    if shared:
+        # Время ответа - сколько ждал этот запрос, а не общий
+        waited = time.perf_counter() - start_time
+        response_data.update(shared=True, response_time=waited, first_token_time=None,
+                             timings={'total': waited, 'retries': 0})
+        logger.info(f"Запрос к {model_data.get('name')} объединен с таким же выполняющимся")
+    response_data['request_id'] = request_id
+    _record_metrics(model_data, request_id, streamed, response_data=response_data)
+    return response_data
 
 
-def send_request_to_openrouter(model_data: Dict, prompt: str, timeout: int = 30) -> Dict:
+@asynccontextmanager
+async def _no_slot():
+    """Пустой слот для запросов вне рассылки: попытка выполняется без ограничений."""
+    yield
+
+
+async def _async_send_attempts(model_data: Dict, messages: List[Dict], timeout: int,
+                               max_retries: int, executor: Optional[ThreadPoolExecutor],
+                               on_chunk: Optional[Callable[[str], None]],
+                               slot: Optional[Callable] = None,
+                               cancel_token: Optional[CancelToken] = None) -> Dict:
     """
-    Отправляет запрос к OpenRouter API.
+    Выполняет попытки запроса к модели (без обращения к кэшу).
     
-    Args:
-        model_data: Словарь с данными модели (должен содержать api_key, api_url, name)
-        prompt: Текст промта
-        timeout: Таймаут запроса в секундах
-        
-    Returns:
-        Словарь с ответом: {'response': str, 'tokens_used': int, 'response_time': float}
-        
-    Raises:
-        APIError: При ошибке запроса
+    Перед каждой попыткой резервируется квота в _rate_limiter.
+    Повторяются только временные ошибки, пауза выбирается _retry_policy.
+    Слот занимается только на время самой попытки: во время паузы перед
+    повтором запрос возвращается в очередь, и его место занимают запросы
+    к другим моделям. Для моделей с хеджированием попытка может быть
+    продублирована (см. HedgePolicy), дубль выполняется в том же слоте.
+    
+    Перед каждой попыткой проверяется cancel_token и предохранитель модели
+    (_circuit_breaker): к недоступной модели попытка не отправляется, а
+    исход каждой попытки учитывается предохранителем. Если задачу отменили,
+    пока запрос ждал слота, зарезервированная квота возвращается.
+    
+    В ответ добавляется разбивка времени 'timings': этапы успешной попытки
+    (см. _attempt_timings) плюс queue_wait - суммарное ожидание квоты, слота
+    и потока executor по всем попыткам, retries - число повторов и total -
+    время от первой попытки до ответа.
     """
-    api_key = model_data.get('api_key')
-    api_url = model_data.get('api_url', 'https://openrouter.ai/api/v1/chat/completions')
+    slot = slot or _no_slot
+    last_error = None
+    delivered = False
+    hedge_delay = await _hedge_policy.delay_for(model_data)
+    if hedge_delay is not None and hedge_delay >= timeout:
+        hedge_delay = None
+    start_time = time.perf_counter()
+    queue_wait = 0.0
     
-    if not api_key:
-        raise APIError("API-ключ не найден. Проверьте переменную окружения 'OPENROUTER_API_KEY' в файле .env")
+    def emit(delta: str) -> None:
+        nonlocal delivered
+        delivered = True
+        on_chunk(delta)
     
-    headers = {
-        "Authorization": f"Bearer {api_key}",
-        "Content-Type": "application/json",
-        "HTTP-Referer": "https://github.com/chatlist",
-        "X-Title": "ChatList"
-    }
+    for attempt in range(max_retries + 1):
+        try:
+            if cancel_token is not None:
+                cancel_token.raise_if_cancelled()
+            probe = _circuit_breaker.acquire(model_data)
+            # Квота резервируется до занятия слота, чтобы ожидание квоты не держало слот
+            wait_start = time.perf_counter()
+            reservation = None
+            sent = False
+            try:
+                reservation = await _rate_limiter.acquire(model_data, messages)
+                async with slot():
+                    sent = True
+                    queue_wait += time.perf_counter() - wait_start
+                    if hedge_delay is not None:
+                        _hedge_policy.earn()
+                        response_data = await _async_hedged_attempt(model_data, messages, timeout, executor,
+                                                                    emit if on_chunk is not None else None,
+                                                                    hedge_delay)
+                    else:
+                        response_data = await _async_attempt(model_data, messages, timeout, executor,
+                                                             emit if on_chunk is not None else None)
+            except APIError as e:
+                _circuit_breaker.record(model_data, probe, e)
+                probe = False
+                raise
+            else:
+                _circuit_breaker.record(model_data, probe)
+                probe = False
+                _rate_limiter.settle(reservation, response_data.get('tokens_used'))
+            finally:
+                # Отмена или непредвиденное исключение: проверка предохранителя снимается без исхода,
+                # а квота неотправленного запроса возвращается
+                _circuit_breaker.release(model_data, probe)
+                if not sent:
+                    _rate_limiter.release(reservation)
+            timings = dict(response_data.get('timings') or {})
+            timings['queue_wait'] = queue_wait + timings.get('queue_wait', 0.0)
+            timings['retries'] = attempt
+            timings['total'] = time.perf_counter() - start_time
+            response_data['timings'] = timings
+            return response_data
+        except RequestCancelled:
+            raise
+        except CircuitOpenError:
+            # Предохранитель разомкнулся во время повторов: возвращаем настоящую ошибку модели
+            if last_error is None:
+                raise
+            logger.error(f"Запрос к {model_data.get('name')} прекращен, модель недоступна: {str(last_error)}")
+            break
+        except APIError as e:
+            last_error = e
+            if delivered or not _retry_policy.should_retry(e, attempt, max_retries):
+                logger.error(f"Запрос к {model_data.get('name')} завершился ошибкой: {str(e)}")
+                break
+            wait_time = _retry_policy.delay(e, attempt)
+            logger.warning(f"Попытка {attempt + 1} не удалась, повтор через {wait_time:.1f}с: {str(e)}")
+            await asyncio.sleep(wait_time)
     
-    # Определяем модель из названия
-    # Название модели должно быть в формате provider/model (например, openai/gpt-4)
-    model_name = model_data.get('name', 'openai/gpt-4')
-    
-    # Маппинг старых названий на правильные имена моделей OpenRouter
-    # Актуальные названия моделей можно проверить на https://openrouter.ai/models
-    # Примечание: OpenRouter не поддерживает модели Groq напрямую, используем Meta Llama
-    model_name_mapping = {
-        'gpt-4': 'openai/gpt-4',
-        'gpt4': 'openai/gpt-4',
-        'gpt-3.5': 'openai/gpt-3.5-turbo',
-        'gpt-3.5-turbo': 'openai/gpt-3.5-turbo',
-        'deepseek chat': 'deepseek/deepseek-chat-v3.1',
-        'deepseek': 'deepseek/deepseek-chat-v3.1',
-        'groq llama 3': 'meta-llama/llama-3.3-70b-instruct',
-        'groq llama': 'meta-llama/llama-3.3-70b-instruct',
-        'groq': 'meta-llama/llama-3.3-70b-instruct',
-        'llama 3': 'meta-llama/llama-3.3-70b-instruct',
-        'claude': 'anthropic/claude-3-opus',
-        'gemini': 'google/gemini-pro',
-        'mistral devstral': 'mistralai/devstral-2512',
-        'devstral': 'mistralai/devstral-2512',
-        'qwen coder': 'qwen/qwen3-coder',
-        'qwen3 coder': 'qwen/qwen3-coder',
-        'openai/gpt-4': 'openai/gpt-4',
-        'anthropic/claude-3-opus': 'anthropic/claude-3-opus',
-        'google/gemini-pro': 'google/gemini-pro',
-        'meta-llama/llama-3-70b-instruct': 'meta-llama/llama-3.3-70b-instruct',
-        'meta-llama/llama-3.1-70b-instruct': 'meta-llama/llama-3.3-70b-instruct',
-        'groq/llama-3-70b-versatile': 'meta-llama/llama-3.3-70b-instruct',
-        'groq/llama-3.1-70b-versatile': 'meta-llama/llama-3.3-70b-instruct',
-        'groq/llama-3.3-70b-versatile': 'meta-llama/llama-3.3-70b-instruct',
-        'deepseek/deepseek-chat': 'deepseek/deepseek-chat-v3.1',
-        'mistralai/devstral-2512': 'mistralai/devstral-2512',
-        'qwen/qwen3-coder': 'qwen/qwen3-coder',
-    }
+    last_error.timings = {'queue_wait': queue_wait, 'retries': attempt,
+                          'total': time.perf_counter() - start_time}
+    raise last_error
+
+
+async def _async_attempt(model_data: Dict, messages: List[Dict], timeout: int,
+                         executor: Optional[ThreadPoolExecutor],
+                         on_chunk: Optional[Callable[[str], None]]) -> Dict:
+    """
+    Выполняет одну попытку запроса через aiohttp или синхронным клиентом в executor.
     
-    # Нормализуем название модели
-    model_name_lower = model_name.lower().strip()
-    
-    # Сначала проверяем точное совпадение
-    if model_name_lower in model_name_mapping:
-        model_name = model_name_mapping[model_name_lower]
-    # Если в названии уже есть формат provider/model, проверяем, не является ли оно устаревшим
-    elif '/' in model_name:
-        # Проверяем устаревшие названия моделей
-        if model_name_lower.startswith('groq/'):
-            # OpenRouter не поддерживает Groq напрямую, используем Meta Llama
-            model_name = 'meta-llama/llama-3.3-70b-instruct'
-        elif 'meta-llama/llama-3' in model_name_lower and '3.3' not in model_name_lower:
-            # Обновляем старые версии Llama 3 на актуальную 3.3
-            model_name = 'meta-llama/llama-3.3-70b-instruct'
-        elif model_name_lower == 'deepseek/deepseek-chat':
-            # Обновляем старое название DeepSeek на актуальное
-            model_name = 'deepseek/deepseek-chat-v3.1'
-    # Если название не в формате provider/model, пробуем определить по содержимому
+    При отмене задачи запрос aiohttp обрывается вместе с соединением. Потоковый
+    запрос синхронным клиентом обрывается на следующем фрагменте (поток
+    executor освобождается), обычный дочитывается, но его ответ отбрасывается.
+    """
+    if aiohttp is not None:
+        if on_chunk is not None:
+            return await _async_stream_request(model_data, messages, timeout, on_chunk)
+        return await _async_request(model_data, messages, timeout)
+    loop = asyncio.get_running_loop()
+    aborted = threading.Event()
+    if on_chunk is not None:
+        def emit(delta: str) -> None:
+            # Исключение закрывает ответ и соединение в _iter_stream
+            if aborted.is_set():
+                raise RequestCancelled()
+            on_chunk(delta)
+        call = functools.partial(_stream_request_sync, model_data, messages, timeout, emit)
     else:
-        # Автоматическое определение провайдера по названию
-        if 'deepseek' in model_name_lower:
-            # Правильное название для DeepSeek в OpenRouter
-            model_name = 'deepseek/deepseek-chat-v3.1'
-        elif 'groq' in model_name_lower or ('llama' in model_name_lower and 'groq' in model_name_lower):
-            # OpenRouter не поддерживает Groq напрямую, используем Meta Llama 3.3
-            model_name = 'meta-llama/llama-3.3-70b-instruct'
-        elif 'llama' in model_name_lower:
-            model_name = 'meta-llama/llama-3.3-70b-instruct'
-        elif 'claude' in model_name_lower or 'anthropic' in model_name_lower:
-            model_name = 'anthropic/claude-3-opus'
-        elif 'gemini' in model_name_lower or 'google' in model_name_lower:
-            model_name = 'google/gemini-pro'
-        elif 'mistral' in model_name_lower or 'devstral' in model_name_lower:
-            model_name = 'mistralai/devstral-2512'
-        elif 'qwen' in model_name_lower and 'coder' in model_name_lower:
-            model_name = 'qwen/qwen3-coder'
-        elif 'qwen' in model_name_lower:
-            model_name = 'qwen/qwen3-coder'
-        elif 'gpt' in model_name_lower or 'openai' in model_name_lower:
-            if '3.5' in model_name_lower or 'turbo' in model_name_lower:
-                model_name = 'openai/gpt-3.5-turbo'
-            else:
-                model_name = 'openai/gpt-4'
-        else:
-            # По умолчанию используем GPT-4
-            model_name = 'openai/gpt-4'
-    
-    payload = {
-        "model": model_name,
-        "messages": [
-            {"role": "user", "content": prompt}
-        ],
-        "temperature": 0.7
-    }
+        call = functools.partial(_request_sync, model_data, messages, timeout)
+    submitted = time.perf_counter()
     
-    start_time = time.time()
+    def run_in_thread() -> Dict:
+        # Ожидание свободного потока executor учитывается как время в очереди
+        executor_wait = time.perf_counter() - submitted
+        response_data = call()
+        response_data['timings']['queue_wait'] = executor_wait
+        return response_data
     
     try:
-        response = requests.post(api_url, json=payload, headers=headers, timeout=timeout)
-        
-        # Обрабатываем ошибки более подробно для OpenRouter
-        if response.status_code == 400:
-            try:
-                error_data = response.json()
-                error_message = error_data.get('error', {}).get('message', 'Bad Request')
-                # Показываем более подробную информацию об ошибке
-                detailed_error = f"Ошибка 400: {error_message}. Используемая модель: {model_name}. Оригинальное название: {model_data.get('name')}"
-                logger.error(f"Ошибка запроса к {model_data.get('name')}: {detailed_error}")
-                raise APIError(detailed_error)
-            except (ValueError, KeyError, TypeError):
-                # Если не удалось распарсить JSON с ошибкой
-                error_text = response.text[:200] if hasattr(response, 'text') and response.text else 'Unknown error'
-                raise APIError(f"Ошибка 400 Bad Request. Используемая модель: {model_name}. Оригинальное название: {model_data.get('name')}. Ответ сервера: {error_text}")
-        
-        response.raise_for_status()
-        
-        response_time = time.time() - start_time
-        data = response.json()
-        
-        if 'choices' in data and len(data['choices']) > 0:
-            response_text = data['choices'][0]['message']['content']
-        else:
-            raise APIError("Неожиданный формат ответа от API")
-        
-        tokens_used = None
-        if 'usage' in data:
-            tokens_used = data['usage'].get('total_tokens')
-        
-        logger.info(f"Запрос к {model_data.get('name')} (модель OpenRouter: {model_name}) выполнен за {response_time:.2f}с")
-        
-        return {
-            'response': response_text,
-            'tokens_used': tokens_used,
-            'response_time': response_time
-        }
-        
-    except APIError:
+        return await loop.run_in_executor(executor, run_in_thread)
+    except asyncio.CancelledError:
+        aborted.set()
         raise
-    except requests.exceptions.Timeout:
-        raise APIError(f"Таймаут запроса к {model_data.get('name')}")
-    except requests.exceptions.RequestException as e:
-        raise APIError(f"Ошибка запроса к {model_data.get('name')}: {str(e)}")
 
 
-def send_prompt_with_system_to_model(model_data: Dict, system_prompt: str, user_prompt: str, 
-                                      timeout: int = 30, max_retries: int = 2) -> Dict:
+async def _async_hedged_attempt(model_data: Dict, messages: List[Dict], timeout: int,
+                                executor: Optional[ThreadPoolExecutor],
+                                on_chunk: Optional[Callable[[str], None]],
+                                hedge_delay: float) -> Dict:
     """
-    Отправляет промт с системным сообщением в конкретную модель.
+    Выполняет попытку запроса с хеджированием.
     
-    Args:
-        model_data: Словарь с данными модели (должен содержать model_type, api_key, api_url, name)
-        system_prompt: Системный промт (инструкции для AI)
-        user_prompt: Пользовательский промт (основной запрос)
-        timeout: Таймаут запроса в секундах
-        max_retries: Максимальное количество попыток при ошибке
-        
-    Returns:
-        Словарь с ответом: {'response': str, 'tokens_used': int, 'response_time': float}
-        
-    Raises:
-        APIError: При ошибке запроса после всех попыток
+    Если основной запрос не завершился (потоковый - не выдал текста) за
+    hedge_delay секунд, а бюджет и квота _rate_limiter позволяют, отправляется
+    дублирующий запрос. Возвращается первый успешный ответ, второй запрос
+    отменяется; ошибка возвращается, только если не удались оба. Время ответа
+    дубля отсчитывается от начала основного запроса.
     """
-    model_type = model_data.get('model_type', 'openai').lower()
-    api_key = model_data.get('api_key')
-    api_url = model_data.get('api_url', 'https://openrouter.ai/api/v1/chat/completions')
+    loop = asyncio.get_running_loop()
+    start_time = loop.time()
+    tasks = []
+    offsets = []
+    owner = None
     
-    if not api_key:
-        raise APIError(f"API-ключ не найден для модели {model_data.get('name')}")
-    
-    # Для OpenRouter и других OpenAI-совместимых API
-    if model_type == 'openrouter' or 'openrouter' in api_url.lower():
-        headers = {
-            "Authorization": f"Bearer {api_key}",
-            "Content-Type": "application/json",
-            "HTTP-Referer": "https://github.com/chatlist",
-            "X-Title": "ChatList"
-        }
-        
-        # Определяем модель из названия
-        model_name = model_data.get('name', 'openai/gpt-4')
-        model_name_mapping = {
-            'gpt-4': 'openai/gpt-4',
-            'gpt4': 'openai/gpt-4',
-            'gpt-3.5': 'openai/gpt-3.5-turbo',
-            'gpt-3.5-turbo': 'openai/gpt-3.5-turbo',
-            'deepseek chat': 'deepseek/deepseek-chat-v3.1',
-            'deepseek': 'deepseek/deepseek-chat-v3.1',
-            'groq llama 3': 'meta-llama/llama-3.3-70b-instruct',
-            'groq llama': 'meta-llama/llama-3.3-70b-instruct',
-            'groq': 'meta-llama/llama-3.3-70b-instruct',
-            'llama 3': 'meta-llama/llama-3.3-70b-instruct',
-            'claude': 'anthropic/claude-3-opus',
-            'gemini': 'google/gemini-pro',
-        }
-        
-        model_name_lower = model_name.lower().strip()
-        if model_name_lower in model_name_mapping:
-            model_name = model_name_mapping[model_name_lower]
-        elif '/' not in model_name:
-            # Автоматическое определение провайдера
-            if 'deepseek' in model_name_lower:
-                model_name = 'deepseek/deepseek-chat-v3.1'
-            elif 'llama' in model_name_lower:
-                model_name = 'meta-llama/llama-3.3-70b-instruct'
-            elif 'claude' in model_name_lower or 'anthropic' in model_name_lower:
-                model_name = 'anthropic/claude-3-opus'
-            elif 'gemini' in model_name_lower or 'google' in model_name_lower:
-                model_name = 'google/gemini-pro'
-            elif 'gpt' in model_name_lower:
-                model_name = 'openai/gpt-4'
+    def make_emit(index: int) -> Callable[[str], None]:
+        def emit(delta: str) -> None:
+            # Текст передается только от запроса, который выдал его первым
+            nonlocal owner
+            if owner is None:
+                owner = index
+                for other, task in enumerate(tasks):
+                    if other != index:
+                        task.cancel()
+            if owner == index:
+                on_chunk(delta)
+        return emit
+    
+    def start_attempt() -> None:
+        offsets.append(loop.time() - start_time)
+        tasks.append(asyncio.ensure_future(_async_attempt(
+            model_data, messages, timeout, executor,
+            make_emit(len(tasks)) if on_chunk is not None else None
+        )))
+    
+    hedge_reservation = None
+    try:
+        start_attempt()
+        done, _ = await asyncio.wait(tasks, timeout=hedge_delay)
+        if not done and owner is None and _hedge_policy.try_spend():
+            # Дубль не ждет квоту: если ее нет, ждем основной запрос
+            wait_time, hedge_reservation = _rate_limiter.reserve(model_data, messages, no_wait=True)
+            if wait_time > 0:
+                _hedge_policy.refund()
             else:
-                model_name = 'openai/gpt-4'
+                logger.info(f"{model_data.get('name')} не ответила за {hedge_delay:.2f}с, "
+                            f"отправлен дублирующий запрос")
+                start_attempt()
         
-        payload = {
-            "model": model_name,
-            "messages": [
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt}
-            ],
-            "temperature": 0.7
+        pending = set(tasks)
+        first_error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.cancelled():
+                    continue
+                if task.exception() is not None:
+                    first_error = first_error or task.exception()
+                    continue
+                response_data = task.result()
+                index = tasks.index(task)
+                if index == 0:
+                    return response_data
+                _rate_limiter.settle(hedge_reservation, response_data.get('tokens_used'))
+                hedge_reservation = None
+                response_data = dict(response_data, hedged=True)
+                response_data['response_time'] += offsets[index]
+                if response_data.get('first_token_time') is not None:
+                    response_data['first_token_time'] += offsets[index]
+                return response_data
+        raise first_error
+    finally:
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+        if hedge_reservation is not None:
+            # Дубль отправлен, но его ответ не взят: запрос остается списанным,
+            # а оценка токенов заменяется фактическим расходом (ноль, если ответа нет)
+            duplicate = tasks[1]
+            tokens_used = 0
+            if duplicate.done() and not duplicate.cancelled() and duplicate.exception() is None:
+                tokens_used = duplicate.result().get('tokens_used') or 0
+            _rate_limiter.settle(hedge_reservation, tokens_used)
+
+
+def _make_result(model: Dict, response_data: Optional[Dict] = None, error: Optional[str] = None,
+                 cancelled: bool = False) -> Dict:
+    """Формирует элемент результата рассылки для одной модели."""
+    if response_data is not None:
+        return {
+            'model_id': model.get('id'),
+            'model_name': model.get('name', 'Unknown'),
+            'success': True,
+            'response': response_data['response'],
+            'tokens_used': response_data.get('tokens_used'),
+            'response_time': response_data.get('response_time', 0),
+            'first_token_time': response_data.get('first_token_time'),
+            'cached': response_data.get('cached', False),
+            'request_id': response_data.get('request_id'),
+            'timings': response_data.get('timings')
         }
-        
-        last_error = None
-        for attempt in range(max_retries + 1):
-            try:
-                start_time = time.time()
-                response = requests.post(api_url, json=payload, headers=headers, timeout=timeout)
-                
-                if response.status_code == 400:
-                    try:
-                        error_data = response.json()
-                        error_message = error_data.get('error', {}).get('message', 'Bad Request')
-                        raise APIError(f"Ошибка 400: {error_message}. Используемая модель: {model_name}")
-                    except (ValueError, KeyError, TypeError):
-                        error_text = response.text[:200] if hasattr(response, 'text') and response.text else 'Unknown error'
-                        raise APIError(f"Ошибка 400 Bad Request. Модель: {model_name}. Ответ: {error_text}")
-                
-                response.raise_for_status()
-                response_time = time.time() - start_time
-                data = response.json()
-                
-                if 'choices' in data and len(data['choices']) > 0:
-                    response_text = data['choices'][0]['message']['content']
-                else:
-                    raise APIError("Неожиданный формат ответа от API")
-                
-                tokens_used = data.get('usage', {}).get('total_tokens') if 'usage' in data else None
-                
-                logger.info(f"Запрос к {model_data.get('name')} (модель: {model_name}) выполнен за {response_time:.2f}с")
-                
-                return {
-                    'response': response_text,
-                    'tokens_used': tokens_used,
-                    'response_time': response_time
-                }
-                
-            except APIError as e:
-                last_error = e
-                if attempt < max_retries:
-                    wait_time = (attempt + 1) * 2
-                    logger.warning(f"Попытка {attempt + 1} не удалась, повтор через {wait_time}с: {str(e)}")
-                    time.sleep(wait_time)
-                else:
-                    logger.error(f"Все попытки исчерпаны для {model_data.get('name')}: {str(e)}")
-            except requests.exceptions.Timeout:
-                last_error = APIError(f"Таймаут запроса к {model_data.get('name')}")
-                if attempt < max_retries:
-                    time.sleep((attempt + 1) * 2)
-            except requests.exceptions.RequestException as e:
-                last_error = APIError(f"Ошибка запроса к {model_data.get('name')}: {str(e)}")
-                if attempt < max_retries:
-                    time.sleep((attempt + 1) * 2)
-        
-        if last_error:
-            raise last_error
-        else:
-            raise APIError(f"Не удалось отправить запрос к {model_data.get('name')}")
-    
-    else:
-        # Для других типов моделей используем стандартный метод (без системного промта)
-        # Объединяем системный и пользовательский промты
-        combined_prompt = f"{system_prompt}\n\n---\n\n{user_prompt}"
-        return send_prompt_to_model(model_data, combined_prompt, timeout, max_retries)
+    return {
+        'model_id': model.get('id'),
+        'model_name': model.get('name', 'Unknown'),
+        'success': False,
+        'error': error,
+        'tokens_used': None,
+        'response_time': None,
+        'cancelled': cancelled
+    }
+
+
+def _notify(callback: Optional[Callable], *args) -> None:
+    """Вызывает пользовательский обработчик события рассылки, не давая его ошибке сорвать рассылку."""
+    if callback is None:
+        return
+    try:
+        callback(*args)
+    except Exception as e:
+        logger.error(f"Ошибка в обработчике события рассылки: {str(e)}")
 
 
-def send_prompt_to_model(model_data: Dict, prompt: str, timeout: int = 30, max_retries: int = 2) -> Dict:
+async def async_send_prompt_to_multiple_models(models: List[Dict], prompt: str, timeout: int = 30,
+                                               max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+                                               per_host_limit: int = DEFAULT_PER_HOST_LIMIT,
+                                               on_chunk: Optional[Callable[[Dict, str], None]] = None,
+                                               on_start: Optional[Callable[[Dict], None]] = None,
+                                               on_result: Optional[Callable[[Dict], None]] = None,
+                                               use_cache: bool = True,
+                                               cancel_token: Optional[CancelToken] = None) -> List[Dict]:
     """
-    Отправляет промт в конкретную модель с обработкой ошибок и retry-логикой.
+    Асинхронно отправляет промт в несколько моделей одновременно.
+    
+    Все запросы выполняются в текущем цикле событий через одну aiohttp-сессию,
+    без отдельного потока на запрос. Запросы стартуют сразу, пока не достигнут
+    общий потолок max_concurrency или лимит per_host_limit для одного хоста;
+    внутри них число запросов к хосту подбирает _adaptive_concurrency.
+    Запрос, ожидающий повтора после временной ошибки (например, 429),
+    освобождает свое место, и его занимают запросы к другим моделям.
     
     Args:
-        model_data: Словарь с данными модели (должен содержать model_type, api_key, api_url, name)
+        models: Список словарей с данными моделей
         prompt: Текст промта
         timeout: Таймаут запроса в секундах
-        max_retries: Максимальное количество попыток при ошибке
+        max_concurrency: Максимальное количество одновременных запросов
+        per_host_limit: Максимальное количество одновременных запросов к одному хосту
+        on_chunk: Если задан, ответы запрашиваются потоково и каждый фрагмент текста
+            передается в on_chunk(model, text) по мере поступления
+        on_start: Вызывается как on_start(model), когда запрос к модели вышел из очереди
+        on_result: Вызывается как on_result(result) сразу после завершения запроса к модели
+        use_cache: Если False, кэш ответов не читается (свежие ответы все равно сохраняются)
+        cancel_token: При его отмене незавершенные запросы обрываются, а модели
+            получают результат с ошибкой и 'cancelled': True
         
     Returns:
-        Словарь с ответом: {'response': str, 'tokens_used': int, 'response_time': float}
-        
-    Raises:
-        APIError: При ошибке запроса после всех попыток
+        Список результатов в порядке завершения (формат как у send_prompt_to_multiple_models)
+    """
+    results = await async_send_prompt_jobs(
+        [(model, prompt) for model in models], timeout, max_concurrency=max_concurrency,
+        per_host_limit=per_host_limit, on_chunk=on_chunk, on_start=on_start,
+        on_result=(lambda index, result: on_result(result)) if on_result is not None else None,
+        use_cache=use_cache, cancel_token=cancel_token
+    )
+    return [result for _, result in results]
+
+
+async def async_send_prompt_jobs(jobs: List[Tuple[Dict, str]], timeout: int = 30,
+                                 max_concurrency: int = DEFAULT_MAX_CONCURRENCY,
+                                 per_host_limit: int = DEFAULT_PER_HOST_LIMIT,
+                                 on_chunk: Optional[Callable[[Dict, str], None]] = None,
+                                 on_start: Optional[Callable[[Dict], None]] = None,
+                                 on_result: Optional[Callable[[int, Dict], None]] = None,
+                                 use_cache: bool = True,
+                                 cancel_token: Optional[CancelToken] = None) -> List[Tuple[int, Dict]]:
     """
-    model_type = model_data.get('model_type', 'openai').lower()
+    Асинхронно выполняет набор запросов "модель + промт" с общими лимитами.
     
-    last_error = None
+    Общая часть async_send_prompt_to_multiple_models и пакетных запусков
+    (матрица промтов и моделей): лимиты, отмена и формат результатов те же.
     
-    for attempt in range(max_retries + 1):
+    Args:
+        jobs: Список пар (данные модели, текст промта)
+        on_result: Вызывается как on_result(index, result), где index - номер пары в jobs
+        Остальные параметры - как у async_send_prompt_to_multiple_models
+    
+    Returns:
+        Список пар (index, result) в порядке завершения
+    """
+    results = []
+    if not jobs:
+        return results
+    
+    # Названия моделей проверяются и сопоставляются с именами в API до начала рассылки;
+    # каждая модель - один раз, сколько бы промтов к ней ни шло
+    models = list({model.get('id', id(model)): model for model, _ in jobs}.values())
+    loop = asyncio.get_running_loop()
+    for problem in await loop.run_in_executor(None, _model_resolver.prepare, models):
+        logger.warning(problem)
+    # Статистика времени ответа для хеджирования и история запросов для предохранителя
+    # тоже читаются заранее, одним запросом
+    await loop.run_in_executor(None, _hedge_policy.prepare, models)
+    await loop.run_in_executor(None, _circuit_breaker.prepare, models)
+    
+    concurrency = asyncio.Semaphore(max(1, max_concurrency))
+    host_limits: Dict[str, asyncio.Semaphore] = {}
+    # Без aiohttp попытки выполняются синхронным клиентом в ограниченном пуле потоков
+    executor = None
+    if aiohttp is None:
+        executor = ThreadPoolExecutor(max_workers=max(1, min(max_concurrency, len(jobs))))
+    
+    async def send_job(index, model, prompt):
+        """Отправляет один запрос с учетом лимитов."""
+        model_name = model.get('name', 'Unknown')
+        host_key = SessionPool._host_key(_build_request_url(model))
+        host_limit = host_limits.setdefault(host_key, asyncio.Semaphore(max(1, per_host_limit)))
+        started = False
+        
+        @asynccontextmanager
+        async def slot():
+            """Место в общих лимитах на время одной попытки (пауза перед повтором его не держит)."""
+            nonlocal started
+            async with concurrency, host_limit, _adaptive_concurrency.slot(host_key):
+                if not started:
+                    started = True
+                    _notify(on_start, model)
+                yield
+        
         try:
-            if model_type == 'openai':
-                return send_request_to_openai(model_data, prompt, timeout)
-            elif model_type == 'deepseek':
-                return send_request_to_deepseek(model_data, prompt, timeout)
-            elif model_type == 'groq':
-                return send_request_to_groq(model_data, prompt, timeout)
-            elif model_type == 'openrouter':
-                return send_request_to_openrouter(model_data, prompt, timeout)
-            else:
-                # Пробуем OpenAI-совместимый формат
-                logger.warning(f"Неизвестный тип модели {model_type}, пробуем OpenAI-совместимый формат")
-                return send_request_to_openai(model_data, prompt, timeout)
-                
+            response_data = await _async_send_prompt_to_model(
+                model, prompt, timeout, executor=executor,
+                on_chunk=functools.partial(on_chunk, model) if on_chunk is not None else None,
+                use_cache=use_cache, slot=slot, cancel_token=cancel_token
+            )
+            result = _make_result(model, response_data=response_data)
+        except RequestCancelled as e:
+            result = _make_result(model, error=str(e), cancelled=True)
+        except asyncio.CancelledError:
+            # Отмена по токену завершает запрос к модели обычным результатом
+            if cancel_token is None or not cancel_token.cancelled:
+                raise
+            result = _make_result(model, error=str(RequestCancelled()), cancelled=True)
         except APIError as e:
-            last_error = e
-            if attempt < max_retries:
-                wait_time = (attempt + 1) * 2  # Экспоненциальная задержка
-                logger.warning(f"Попытка {attempt + 1} не удалась, повтор через {wait_time}с: {str(e)}")
-                time.sleep(wait_time)
-            else:
-                logger.error(f"Все попытки исчерпаны для {model_data.get('name')}: {str(e)}")
+            logger.error(f"Ошибка при запросе к {model_name}: {str(e)}")
+            result = _make_result(model, error=str(e))
+        except Exception as e:
+            logger.error(f"Неожиданная ошибка при запросе к {model_name}: {str(e)}")
+            result = _make_result(model, error=f"Неожиданная ошибка: {str(e)}")
+        _notify(on_result, index, result)
+        return index, result
     
-    raise last_error
+    # Задачи создаются по порядку, чтобы запросы выходили из очереди в порядке списка
+    tasks = [asyncio.ensure_future(send_job(index, model, prompt)) for index, (model, prompt) in enumerate(jobs)]
+    
+    def cancel_tasks():
+        for task in tasks:
+            if not task.done():
+                task.cancel()
+    
+    remove_callback = None
+    if cancel_token is not None:
+        remove_callback = cancel_token.add_callback(lambda: loop.call_soon_threadsafe(cancel_tasks))
+    try:
+        for next_done in asyncio.as_completed(tasks):
+            results.append(await next_done)
+    finally:
+        if remove_callback is not None:
+            remove_callback()
+        # При отмене рассылки отменяем и отдельные запросы и ждем их завершения,
+        # чтобы отмененные запросы вернули места в лимитах и квоту
+        cancel_tasks()
+        pending = [task for task in tasks if not task.done()]
+        if pending:
+            await asyncio.wait(pending)
+        # Метрики рассылки пишутся в базу сразу, не дожидаясь заполнения буфера
+        loop.run_in_executor(None, _metrics_recorder.flush)
+        if executor is not None:
+            # Попытки, еще ждущие свободного потока, снимаются
+            executor.shutdown(wait=False, cancel_futures=True)
+    
+    return results
 
 
 def send_prompt_to_multiple_models(models: List[Dict], prompt: str, 
-                                   timeout: int = 30, max_workers: int = 5) -> List[Dict]:
+                                   timeout: int = 30, max_workers: int = DEFAULT_MAX_CONCURRENCY,
+                                   on_chunk: Optional[Callable[[Dict, str], None]] = None,
+                                   use_cache: bool = True,
+                                   cancel_token: Optional[CancelToken] = None) -> List[Dict]:
     """
-    Асинхронно отправляет промт в несколько моделей одновременно.
+    Отправляет промт в несколько моделей одновременно.
+    
+    Синхронная обертка над async_send_prompt_to_multiple_models: рассылка
+    выполняется в фоновом цикле событий, вызывающий поток ждет результата.
     
     Args:
         models: Список словарей с данными моделей
         prompt: Текст промта
         timeout: Таймаут запроса в секундах
         max_workers: Максимальное количество одновременных запросов
+        on_chunk: Если задан, ответы запрашиваются потоково, и on_chunk(model, text)
+            вызывается из фонового потока для каждого фрагмента
+        use_cache: Если False, кэш ответов не читается (свежие ответы все равно сохраняются)
+        cancel_token: Токен, через который рассылку можно остановить из другого потока
         
     Returns:
         Список словарей с результатами:
@@ -619,57 +3233,99 @@ def send_prompt_to_multiple_models(models: List[Dict], prompt: str,
                 'response': str (если success=True),
                 'error': str (если success=False),
                 'tokens_used': int,
-                'response_time': float
+                'response_time': float,
+                'cached': bool (True, если ответ взят из кэша),
+                'request_id': str (ключ записи в request_metrics, если success=True),
+                'timings': dict (разбивка времени запроса, если success=True),
+                'cancelled': bool (True, если запрос отменен через cancel_token)
             },
             ...
         ]
     """
-    results = []
-    
-    def send_to_model(model):
-        """Вспомогательная функция для отправки запроса к модели."""
-        model_id = model.get('id')
-        model_name = model.get('name', 'Unknown')
-        
-        try:
-            response_data = send_prompt_to_model(model, prompt, timeout)
-            
-            return {
-                'model_id': model_id,
-                'model_name': model_name,
-                'success': True,
-                'response': response_data['response'],
-                'tokens_used': response_data.get('tokens_used'),
-                'response_time': response_data.get('response_time', 0)
-            }
-        except APIError as e:
-            logger.error(f"Ошибка при запросе к {model_name}: {str(e)}")
-            return {
-                'model_id': model_id,
-                'model_name': model_name,
-                'success': False,
-                'error': str(e),
-                'tokens_used': None,
-                'response_time': None
-            }
-        except Exception as e:
-            logger.error(f"Неожиданная ошибка при запросе к {model_name}: {str(e)}")
-            return {
-                'model_id': model_id,
-                'model_name': model_name,
-                'success': False,
-                'error': f"Неожиданная ошибка: {str(e)}",
-                'tokens_used': None,
-                'response_time': None
-            }
+    return _engine.run(async_send_prompt_to_multiple_models(
+        models, prompt, timeout, max_concurrency=max_workers, on_chunk=on_chunk,
+        use_cache=use_cache, cancel_token=cancel_token
+    ))
+
+
+def iter_prompt_to_multiple_models(models: List[Dict], prompt: str, timeout: int = 30,
+                                   max_workers: int = DEFAULT_MAX_CONCURRENCY,
+                                   on_chunk: Optional[Callable[[Dict, str], None]] = None,
+                                   on_start: Optional[Callable[[Dict], None]] = None,
+                                   use_cache: bool = True,
+                                   cancel_token: Optional[CancelToken] = None) -> Iterator[Dict]:
+    """
+    Отправляет промт в несколько моделей и выдает результат каждой модели
+    сразу после завершения ее запроса, не дожидаясь остальных.
     
-    # Используем ThreadPoolExecutor для параллельных запросов
-    with ThreadPoolExecutor(max_workers=max_workers) as executor:
-        future_to_model = {executor.submit(send_to_model, model): model for model in models}
-        
-        for future in as_completed(future_to_model):
-            result = future.result()
-            results.append(result)
+    Параметры и формат результатов как у send_prompt_to_multiple_models.
+    Если перебор прерван раньше времени, незавершенные запросы отменяются.
+    После отмены cancel_token перебор быстро выдает оставшиеся модели
+    с результатом 'cancelled': True и завершается.
+    """
+    return _iter_engine_results(lambda on_result: async_send_prompt_to_multiple_models(
+        models, prompt, timeout, max_concurrency=max_workers,
+        on_chunk=on_chunk, on_start=on_start, on_result=on_result,
+        use_cache=use_cache, cancel_token=cancel_token
+    ))
+
+
+def iter_prompt_jobs(jobs: List[Tuple[Dict, str]], timeout: int = 30,
+                     max_workers: int = DEFAULT_MAX_CONCURRENCY,
+                     use_cache: bool = True,
+                     cancel_token: Optional[CancelToken] = None) -> Iterator[Tuple[int, Dict]]:
+    """
+    Выполняет набор запросов "модель + промт" и выдает пары (index, result)
+    по мере завершения запросов (index - номер пары в jobs).
     
-    return results
+    Поведение при отмене и прерывании перебора - как у iter_prompt_to_multiple_models.
+    """
+    return _iter_engine_results(lambda on_result: async_send_prompt_jobs(
+        jobs, timeout, max_concurrency=max_workers,
+        on_result=lambda index, result: on_result((index, result)),
+        use_cache=use_cache, cancel_token=cancel_token
+    ))
 
+
+def _iter_engine_results(make_coroutine: Callable) -> Iterator:
+    """
+    Запускает рассылку в фоновом цикле событий и выдает ее результаты по мере готовности.
+    
+    make_coroutine(on_result) создает корутину рассылки, которая вызывает
+    on_result для каждого готового результата.
+    """
+    results_queue = queue.Queue()
+    done_marker = object()
+    # Задача рассылки в цикле движка; состояние меняется только в потоке цикла
+    state = {'task': None, 'stopped': False}
+    
+    async def run():
+        if state['stopped']:
+            return None
+        state['task'] = asyncio.current_task()
+        return await make_coroutine(results_queue.put)
+    
+    def stop():
+        state['stopped'] = True
+        if state['task'] is not None:
+            state['task'].cancel()
+    
+    future = _engine.submit(run())
+    future.add_done_callback(lambda _: results_queue.put(done_marker))
+    
+    try:
+        while True:
+            item = results_queue.get()
+            if item is done_marker:
+                break
+            yield item
+        future.result()  # Пробрасываем ошибку движка, если она была
+    finally:
+        if not future.done():
+            # Перебор прерван: ждем, пока отмена дойдет до всех запросов в цикле движка,
+            # иначе запросы из очереди еще успеют уйти, а места и квота будут заняты
+            _engine.call_soon(stop)
+            try:
+                future.result()
+            except (CancelledError, Exception):
+                pass
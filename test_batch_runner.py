@@ -0,0 +1,133 @@
+"""
+Тесты пакетного запуска: выполнение, продолжение после прерывания и удаленные промты.
+
+Запросы уходят на заглушку API из bench_network, очередь заданий - во временной БД.
+
+Запуск:
+    python -m unittest test_batch_runner
+"""
+import os
+from unittest import mock
+
+import batch_runner
+import db
+import network
+from test_network import StubServerTestCase, _unused_port
+
+
+def _interrupt_after(limit: int):
+    """Подменяет network.iter_prompt_jobs: после limit результатов перебор прерывается, как по Ctrl+C."""
+    iter_prompt_jobs = network.iter_prompt_jobs
+
+    def interrupted(*args, **kwargs):
+        results = iter_prompt_jobs(*args, **kwargs)
+
+        def generate():
+            try:
+                for count, item in enumerate(results):
+                    if count == limit:
+                        raise KeyboardInterrupt
+                    yield item
+            finally:
+                results.close()
+        return generate()
+    return mock.patch.object(network, "iter_prompt_jobs", interrupted)
+
+
+class BatchRunnerTest(StubServerTestCase):
+    """Задания промты × модели на заглушке с задержкой ответа."""
+
+    server_options = {"response_delay": 0.02}
+    PROMPTS = 6
+    MODELS = 3
+
+    def setUp(self):
+        super().setUp()
+        patcher = mock.patch.dict(os.environ, {"OPENROUTER_API_KEY": "test"})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.prompt_ids = [db.create_prompt(f"prompt {i}", "batch") for i in range(self.PROMPTS)]
+        self.model_ids = [db.create_model(f"vendor/model-{i}", self.server.url, "OPENROUTER_API_KEY", "openrouter")
+                          for i in range(self.MODELS)]
+        self.run_id = db.create_batch_run(self.prompt_ids, self.model_ids, "test")
+
+    def runner(self, **kwargs) -> batch_runner.BatchRunner:
+        return batch_runner.BatchRunner(self.run_id, concurrency=4, use_cache=False, flush_size=2,
+                                        report=None, **kwargs)
+
+    def set_model_url(self, model_id: int, url: str) -> None:
+        conn = db.get_connection()
+        conn.execute("UPDATE models SET api_url = ? WHERE id = ?", (url, model_id))
+        conn.commit()
+
+    def results_count(self) -> int:
+        return db.get_connection().execute("SELECT COUNT(*) FROM results").fetchone()[0]
+
+    def test_run_completes_all_jobs(self):
+        progress = self.runner().run()
+
+        total = self.PROMPTS * self.MODELS
+        self.assertEqual((progress.done, progress.failed), (total, 0))
+        run = db.get_batch_run(self.run_id)
+        self.assertEqual((run["done"], run["failed"], run["pending"]), (total, 0, 0))
+        self.assertIsNotNone(run["finished_at"])
+        self.assertEqual(self.server.requests_received, total)
+        self.assertEqual(self.results_count(), total)
+
+    def test_resume_sends_only_pending_jobs(self):
+        with self.assertRaises(KeyboardInterrupt):
+            with _interrupt_after(5):
+                self.runner().run()
+        run = db.get_batch_run(self.run_id)
+        self.assertGreaterEqual(run["done"], 5)
+        self.assertGreater(run["pending"], 0)
+        self.assertIsNone(run["finished_at"])
+        # Результаты, полученные до прерывания, сохранены вместе с отметкой заданий
+        self.assertEqual(self.results_count(), run["done"])
+
+        self.server.reset_counters()
+        progress = self.runner().run()
+
+        self.assertEqual(self.server.requests_received, run["pending"])
+        self.assertEqual((progress.done, progress.failed), (run["pending"], 0))
+        resumed = db.get_batch_run(self.run_id)
+        self.assertEqual((resumed["done"], resumed["pending"]), (self.PROMPTS * self.MODELS, 0))
+        self.assertIsNotNone(resumed["finished_at"])
+        self.assertEqual(self.results_count(), self.PROMPTS * self.MODELS)
+
+    def test_deleted_prompt_fails_its_jobs(self):
+        db.delete_prompt(self.prompt_ids[0])
+
+        progress = self.runner().run()
+
+        self.assertEqual(progress.failed, self.MODELS)
+        self.assertEqual(self.server.requests_received, (self.PROMPTS - 1) * self.MODELS)
+        run = db.get_batch_run(self.run_id)
+        self.assertEqual((run["failed"], run["pending"]), (self.MODELS, 0))
+        self.assertIsNotNone(run["finished_at"])
+        errors = db.get_connection().execute(
+            "SELECT DISTINCT error FROM batch_jobs WHERE run_id = ? AND status = ?",
+            (self.run_id, db.BATCH_FAILED)
+        ).fetchall()
+        self.assertEqual([row[0] for row in errors], [f"Промт с ID {self.prompt_ids[0]} не найден"])
+
+    def test_retry_failed_requeues_failed_jobs(self):
+        model_id = self.model_ids[0]
+        self.set_model_url(model_id, f"http://127.0.0.1:{_unused_port()}/api/v1/chat/completions")
+        # Предохранитель выключен, чтобы повтор не получил отказ разомкнутого предохранителя
+        breaker = network.CircuitBreaker(enabled=False)
+        breaker._loaded = True
+        with mock.patch.object(network, "_circuit_breaker", breaker), \
+                mock.patch.object(network._retry_policy, "base_delay", 0.01), \
+                mock.patch.object(network._retry_policy, "max_delay", 0.05):
+            progress = self.runner().run()
+            self.assertEqual((progress.done, progress.failed), (self.PROMPTS * (self.MODELS - 1), self.PROMPTS))
+
+            self.set_model_url(model_id, self.server.url)
+            self.server.reset_counters()
+            progress = self.runner().run(retry_failed=True)
+
+        self.assertEqual((progress.done, progress.failed), (self.PROMPTS, 0))
+        self.assertEqual(self.server.requests_received, self.PROMPTS)
+        run = db.get_batch_run(self.run_id)
+        self.assertEqual((run["done"], run["failed"]), (self.PROMPTS * self.MODELS, 0))
@@ -0,0 +1,423 @@
+"""
+Тесты слоя БД ChatList на временной базе.
+
+Запуск:
+    python -m unittest test_db
+"""
+import bisect
+import math
+import os
+import random
+import shutil
+import sqlite3
+import tempfile
+import unittest
+from unittest import mock
+
+import db
+
+try:
+    import windows
+except ImportError:
+    windows = None
+
+
+class DatabaseTestCase(unittest.TestCase):
+    """Временная БД со всеми миграциями и одной моделью."""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        db.set_db_path(os.path.join(self.tmpdir, "chatlist.db"))
+        db.init_database()
+        self.model_id = db.create_model("vendor/test-model", "http://127.0.0.1/api/v1/chat/completions",
+                                        "OPENROUTER_API_KEY", "openrouter")
+
+    def tearDown(self):
+        db.set_db_path(None)
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def execute(self, sql: str, params=()) -> list:
+        conn = db.get_connection()
+        rows = conn.execute(sql, params).fetchall()
+        conn.commit()
+        return rows
+
+
+class FullTextSearchTest(DatabaseTestCase):
+    """Индексы prompts_fts и results_fts следуют за таблицами через триггеры."""
+
+    def search_ids(self, query: str, scope: str = "prompts", **kwargs) -> list:
+        return [row["id"] for row in db.search(query, scope=scope, **kwargs)]
+
+    def assert_index_in_sync(self):
+        for table in ("prompts_fts", "results_fts"):
+            # rank = 1: сверка индекса с исходной таблицей (external content)
+            self.execute(f"INSERT INTO {table}({table}, rank) VALUES ('integrity-check', 1)")
+
+    def test_prompt_insert_update_delete(self):
+        prompt_id = db.create_prompt("Как настроить nginx как обратный прокси", "devops")
+        self.assertEqual(self.search_ids("nginx"), [prompt_id])
+        # Поиск по началу слова и по тегам
+        self.assertEqual(self.search_ids("ngi"), [prompt_id])
+        self.assertEqual(self.search_ids(None, tags="devops"), [prompt_id])
+
+        db.update_prompt(prompt_id, prompt_text="Как настроить apache", tags="web")
+        self.assertEqual(self.search_ids("nginx"), [])
+        self.assertEqual(self.search_ids(None, tags="devops"), [])
+        self.assertEqual(self.search_ids("apache"), [prompt_id])
+        self.assert_index_in_sync()
+
+        db.delete_prompt(prompt_id)
+        self.assertEqual(self.search_ids("apache"), [])
+        self.assert_index_in_sync()
+
+    def test_result_insert_update_delete(self):
+        prompt_id = db.create_prompt("Сравни базы данных")
+        result_id = db.create_result(prompt_id, self.model_id, "Для аналитики лучше подходит postgres")
+        self.assertEqual(self.search_ids("postgres", scope="results"), [result_id])
+        # Результат находится и по тексту своего промта
+        self.assertEqual(self.search_ids("базы", scope="results"), [result_id])
+
+        self.execute("UPDATE results SET response = ? WHERE id = ?", ("Лучше взять clickhouse", result_id))
+        self.assertEqual(self.search_ids("postgres", scope="results"), [])
+        self.assertEqual(self.search_ids("clickhouse", scope="results"), [result_id])
+        self.assert_index_in_sync()
+
+        db.delete_result(result_id)
+        self.assertEqual(self.search_ids("clickhouse", scope="results"), [])
+        self.assert_index_in_sync()
+
+    def test_ranking_and_snippet(self):
+        rare = db.create_prompt("Длинный текст про очереди, кэши, индексы, репликацию и один раз про redis")
+        frequent = db.create_prompt("redis: настройка redis и мониторинг redis")
+
+        found = db.search("redis")
+        self.assertEqual([row["id"] for row in found], [frequent, rare])
+        self.assertLessEqual(found[0]["rank"], found[1]["rank"])
+        self.assertIn(f"{db.SNIPPET_START}redis{db.SNIPPET_END}", found[0]["snippet"])
+
+        result_id = db.create_result(rare, self.model_id, "Используйте redis для кэша сессий")
+        hit, = db.search("сесс", scope="results")
+        self.assertEqual(hit["id"], result_id)
+        self.assertIn(f"{db.SNIPPET_START}сессий{db.SNIPPET_END}", hit["snippet"])
+
+
+class ResultsPaginationTest(DatabaseTestCase):
+    """Постраничная выдача истории по ключу (saved_at, id) при одинаковом времени сохранения."""
+
+    PAGE_SIZE = windows.RESULTS_PAGE_SIZE if windows is not None else 200
+    TOTAL = 2 * PAGE_SIZE + 57
+
+    def setUp(self):
+        super().setUp()
+        self.other_model_id = db.create_model("vendor/other-model", "http://127.0.0.1/api/v1/chat/completions",
+                                              "OPENROUTER_API_KEY", "openrouter")
+        prompt_ids = [db.create_prompt(f"prompt {i}") for i in range(3)]
+        # Две группы строк с общим временем сохранения: граница страниц попадает внутрь группы
+        ids, errors = db.create_results_bulk([
+            {'prompt_id': prompt_ids[i % 3], 'model_id': self.model_id if i % 2 else self.other_model_id,
+             'response': f"response {i}",
+             'saved_at': "2024-01-02 10:00:00" if i < self.TOTAL // 3 else "2024-01-01 10:00:00"}
+            for i in range(self.TOTAL)
+        ])
+        self.assertEqual(errors, [])
+
+    def expected_ids(self, where: str = "", params=()) -> list:
+        rows = self.execute(f"SELECT id FROM results {where} ORDER BY saved_at DESC, id DESC", params)
+        return [row["id"] for row in rows]
+
+    def page_through(self, filters=None) -> list:
+        ids = []
+        after_key = None
+        while True:
+            page = db.get_results_page(after_key, self.PAGE_SIZE, filters)
+            ids.extend(row["id"] for row in page)
+            if len(page) < self.PAGE_SIZE:
+                return ids
+            after_key = (page[-1]["saved_at"], page[-1]["id"])
+
+    def test_pages_match_full_query(self):
+        ids = self.page_through()
+        self.assertEqual(len(ids), self.TOTAL)
+        self.assertEqual(ids, self.expected_ids())
+
+    def test_filters_apply_to_every_page(self):
+        ids = self.page_through({'model_id': self.model_id})
+        self.assertEqual(ids, self.expected_ids("WHERE model_id = ?", (self.model_id,)))
+        self.assertGreater(len(ids), self.PAGE_SIZE)
+
+    @unittest.skipIf(windows is None, "PyQt не установлен")
+    def test_table_model_fetch_more(self):
+        model = windows.ResultsTableModel()
+        model.reset_browse()
+        while model.canFetchMore():
+            model.fetchMore()
+        self.assertEqual([model.result_at(row)["id"] for row in range(model.rowCount())], self.expected_ids())
+
+
+class BulkResultsTest(DatabaseTestCase):
+    """Пакетное сохранение результатов: ID, откат транзакции, поиск и агрегаты."""
+
+    def setUp(self):
+        super().setUp()
+        self.prompt_id = db.create_prompt("Объясни индексы")
+
+    def result(self, response: str, **kwargs) -> dict:
+        return dict({'prompt_id': self.prompt_id, 'model_id': self.model_id, 'response': response,
+                     'response_time': 1.2, 'tokens_used': 100}, **kwargs)
+
+    def count(self, table: str) -> int:
+        return self.execute(f"SELECT COUNT(*) FROM {table}")[0][0]
+
+    def test_ids_errors_and_metrics_links(self):
+        db.create_request_metrics_bulk([{'request_id': "req-1", 'model_id': self.model_id,
+                                         'created_at': "2024-01-01 10:00:00", 'success': 1,
+                                         'cached': 0, 'streamed': 0, 'hedged': 0}])
+        ids, errors = db.create_results_bulk([
+            self.result("btree ускоряет поиск", request_id="req-1"),
+            self.result("ответ к несуществующему промту", prompt_id=10 ** 6),
+            self.result(""),
+            self.result("hash подходит для равенства", model_id=10 ** 6),
+            self.result("gin индексирует массивы"),
+        ])
+
+        self.assertIsNone(ids[1])
+        self.assertIsNone(ids[2])
+        self.assertIsNone(ids[3])
+        self.assertEqual(ids[4], ids[0] + 1)
+        self.assertEqual([index for index, _ in errors], [1, 2, 3])
+        self.assertEqual([db.get_result(result_id)["response"] for result_id in (ids[0], ids[4])],
+                         ["btree ускоряет поиск", "gin индексирует массивы"])
+        self.assertEqual(self.execute("SELECT result_id FROM request_metrics WHERE request_id = 'req-1'")[0][0],
+                         ids[0])
+
+    def test_fulltext_and_rollups_follow_bulk_insert(self):
+        ids, _ = db.create_results_bulk([self.result("btree ускоряет поиск"),
+                                         self.result("gin индексирует массивы", response_time=None)])
+
+        self.assertEqual([row["id"] for row in db.search("btree", scope="results")], [ids[0]])
+        self.assertEqual([row["id"] for row in db.search("массивы", scope="results")], [ids[1]])
+        # В агрегаты попадают только результаты с известным временем ответа
+        stats, = db.get_model_latency_stats()
+        self.assertEqual((stats["model_id"], stats["count"], stats["tokens"]), (self.model_id, 1, 100))
+        self.assertEqual(db.check_rollups(), [])
+
+    def test_database_error_rolls_back_whole_batch(self):
+        with self.assertRaises(Exception):
+            # Список нельзя записать в SQLite: ошибка на второй строке отменяет и первую
+            db.create_results_bulk([self.result("btree ускоряет поиск"), self.result(["не", "строка"])])
+
+        self.assertEqual(self.count("results"), 0)
+        self.assertEqual(self.count("result_rollups"), 0)
+        self.assertEqual(db.search("btree", scope="results"), [])
+        # После отката соединение снова пригодно для записи
+        ids, errors = db.create_results_bulk([self.result("btree ускоряет поиск")])
+        self.assertEqual((len(ids), errors), (1, []))
+
+
+class RollupStatsTest(DatabaseTestCase):
+    """Перцентили по гистограммам result_rollups против точных значений по строкам results."""
+
+    ROWS = 3000
+
+    def setUp(self):
+        super().setUp()
+        self.other_model_id = db.create_model("vendor/other-model", "http://127.0.0.1/api/v1/chat/completions",
+                                              "OPENROUTER_API_KEY", "openrouter")
+        prompt_id = db.create_prompt("Объясни индексы")
+        rng = random.Random(20)
+        # Логнормальное время ответа с длинным хвостом, результаты за несколько суток
+        ids, errors = db.create_results_bulk([
+            {'prompt_id': prompt_id, 'model_id': self.model_id if i % 3 else self.other_model_id,
+             'response': f"response {i}", 'tokens_used': rng.randint(10, 500),
+             'response_time': round(rng.lognormvariate(0.5 if i % 3 else 1.5, 0.8), 3),
+             'saved_at': f"2024-01-{1 + i % 5:02d} {i % 24:02d}:{i % 60:02d}:00"}
+            for i in range(self.ROWS)
+        ])
+        self.assertEqual(errors, [])
+
+    def exact_times(self, model_id: int, since: str = "") -> list:
+        rows = self.execute("SELECT response_time FROM results WHERE model_id = ? AND saved_at >= ?",
+                            (model_id, since))
+        return sorted(row[0] for row in rows)
+
+    def assert_within_bucket(self, estimate: float, times: list, quantile: float):
+        # Точный перцентиль по ближайшему рангу, как в _histogram_percentile
+        exact = times[max(1, math.ceil(quantile * len(times))) - 1]
+        index = bisect.bisect_right(db.LATENCY_BUCKETS, exact)
+        lower = db.LATENCY_BUCKETS[index - 1] if index > 0 else 0.0
+        upper = db.LATENCY_BUCKETS[index] if index < len(db.LATENCY_BUCKETS) else times[-1]
+        self.assertGreaterEqual(estimate, max(lower, times[0]), (quantile, exact))
+        self.assertLessEqual(estimate, min(upper, times[-1]), (quantile, exact))
+
+    def assert_stats_match(self, since: str = None):
+        stats = db.get_model_latency_stats(since)
+        self.assertEqual({entry["model_id"] for entry in stats}, {self.model_id, self.other_model_id})
+        for entry in stats:
+            times = self.exact_times(entry["model_id"], since or "")
+            self.assertEqual(entry["count"], len(times))
+            self.assertAlmostEqual(entry["avg"], sum(times) / len(times))
+            for name, quantile in db.STATISTICS_PERCENTILES.items():
+                self.assert_within_bucket(entry[name], times, quantile)
+
+    def test_percentiles_within_one_bucket(self):
+        self.assert_stats_match()
+        # Почасовые агрегаты: выборка с начала суток
+        self.assert_stats_match("2024-01-03 00:00:00")
+        self.assertEqual(db.check_rollups(), [])
+
+        # Расхождение, внесенное в обход триггеров, обнаруживается и исправляется пересчетом
+        self.execute("UPDATE result_rollups SET h3 = h3 + 1 WHERE period = 'day' AND model_id = ?",
+                     (self.model_id,))
+        self.assertEqual({(entry["period"], entry["column"]) for entry in db.check_rollups()}, {('day', 'h3')})
+        db.rebuild_rollups()
+        self.assertEqual(db.check_rollups(), [])
+
+    def test_rollups_follow_updates_and_deletes(self):
+        self.execute("UPDATE results SET response_time = response_time * 4 WHERE id % 7 = 0")
+        self.execute("DELETE FROM results WHERE id % 11 = 0")
+        for result_id in (1, 2, 3):
+            db.delete_result(result_id)
+
+        self.assertEqual(db.check_rollups(), [])
+        self.assert_stats_match()
+
+
+class _Interrupted(Exception):
+    pass
+
+
+class MigrationTest(unittest.TestCase):
+    """Обновление базы, созданной до появления миграций (user_version = 0), с данными."""
+
+    PROMPTS = 30
+    RESULTS = 90
+    BATCH_SIZE = 7
+
+    # Схема первых версий приложения: таблицы создавались без номера версии
+    OLD_SCHEMA = """
+        CREATE TABLE prompts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            date TEXT NOT NULL,
+            prompt TEXT NOT NULL,
+            tags TEXT
+        );
+        CREATE TABLE models (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            name TEXT NOT NULL UNIQUE,
+            api_url TEXT NOT NULL,
+            api_id TEXT NOT NULL,
+            is_active INTEGER NOT NULL DEFAULT 1,
+            model_type TEXT,
+            created_at TEXT NOT NULL
+        );
+        CREATE TABLE results (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            prompt_id INTEGER NOT NULL,
+            model_id INTEGER NOT NULL,
+            response TEXT NOT NULL,
+            saved_at TEXT NOT NULL,
+            tokens_used INTEGER,
+            response_time REAL,
+            FOREIGN KEY (prompt_id) REFERENCES prompts(id) ON DELETE CASCADE,
+            FOREIGN KEY (model_id) REFERENCES models(id) ON DELETE CASCADE
+        );
+        CREATE TABLE settings (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            key TEXT NOT NULL UNIQUE,
+            value TEXT,
+            description TEXT,
+            updated_at TEXT NOT NULL
+        );
+    """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        path = os.path.join(self.tmpdir, "chatlist.db")
+        conn = sqlite3.connect(path)
+        conn.executescript(self.OLD_SCHEMA)
+        conn.execute("INSERT INTO models (name, api_url, api_id, model_type, created_at) "
+                     "VALUES ('vendor/old-model', 'http://127.0.0.1/api/v1/chat/completions', "
+                     "'OPENROUTER_API_KEY', 'openrouter', '2023-05-01 10:00:00')")
+        conn.executemany("INSERT INTO prompts (date, prompt, tags) VALUES ('2023-05-01 10:00:00', ?, 'old')",
+                         [(f"старый промт {i}",) for i in range(self.PROMPTS)])
+        conn.executemany("INSERT INTO results (prompt_id, model_id, response, saved_at, tokens_used, response_time) "
+                         "VALUES (?, 1, ?, ?, 50, ?)",
+                         [(1 + i % self.PROMPTS, f"старый ответ {i}", f"2023-05-{1 + i % 3:02d} 10:00:00",
+                           0.2 + i / 10) for i in range(self.RESULTS)])
+        conn.execute("INSERT INTO settings (key, value, updated_at) VALUES ('theme', 'dark', '2023-05-01 10:00:00')")
+        conn.commit()
+        conn.close()
+        db.set_db_path(path)
+        patcher = mock.patch.object(db, "MIGRATION_BATCH_SIZE", self.BATCH_SIZE)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def tearDown(self):
+        db.set_db_path(None)
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def execute(self, sql: str, params=()) -> list:
+        conn = db.get_connection()
+        rows = conn.execute(sql, params).fetchall()
+        conn.commit()
+        return rows
+
+    def columns(self, table: str) -> set:
+        return {row["name"] for row in self.execute(f"PRAGMA table_info({table})")}
+
+    def assert_upgraded(self):
+        self.assertEqual(db.get_schema_version(), db.SCHEMA_VERSION)
+        self.assertEqual(db.SCHEMA_VERSION, 10)
+        self.assertLessEqual({"resolved_name", "hedge"}, self.columns("models"))
+        self.assertIn("retryable", self.columns("request_metrics"))
+        for table in ("response_cache", "result_rollups", "batch_runs", "batch_jobs"):
+            self.assertTrue(self.columns(table), table)
+        self.assertEqual(self.execute("SELECT COUNT(*) FROM schema_backfills")[0][0], 0)
+
+        # Старые данные не изменились и попали в полнотекстовые индексы и агрегаты
+        self.assertEqual(db.get_setting("theme"), "dark")
+        self.assertEqual(self.execute("SELECT COUNT(*) FROM models")[0][0], 1)
+        self.assertEqual(len(db.search("старый", limit=1000)), self.PROMPTS)
+        self.assertEqual(len(db.search("ответ", scope="results", limit=1000)), self.RESULTS)
+        for table in ("prompts_fts", "results_fts"):
+            self.execute(f"INSERT INTO {table}({table}, rank) VALUES ('integrity-check', 1)")
+        stats, = db.get_model_latency_stats()
+        self.assertEqual((stats["count"], stats["tokens"]), (self.RESULTS, 50 * self.RESULTS))
+        self.assertEqual(db.check_rollups(), [])
+
+    def test_upgrade_from_unversioned_database(self):
+        self.assertEqual(db.get_schema_version(), 0)
+        batches = []
+
+        db.init_database()
+        self.assert_upgraded()
+        # Повторный запуск ничего не делает
+        self.assertEqual(db.migrate(lambda *args: batches.append(args)), db.SCHEMA_VERSION)
+        self.assertEqual(batches, [])
+
+    def test_interrupted_backfill_resumes(self):
+        batches = []
+
+        def interrupt(description, done, total):
+            batches.append((description, done, total))
+            if len(batches) == 3:
+                raise _Interrupted
+
+        with self.assertRaises(_Interrupted):
+            db.migrate(interrupt)
+        # Миграция полнотекстового поиска остановилась посреди заполнения
+        self.assertEqual(db.get_schema_version(), 1)
+        backfills = self.execute("SELECT name, position, target FROM schema_backfills ORDER BY name")
+        self.assertEqual([tuple(row) for row in backfills],
+                         [("prompts", 3 * self.BATCH_SIZE, self.PROMPTS), ("results", 0, self.RESULTS)])
+
+        resumed = []
+        db.migrate(lambda *args: resumed.append(args))
+        # Заполнение продолжилось с сохраненной позиции, а не с начала
+        self.assertEqual(resumed[0][1:], (4 * self.BATCH_SIZE, self.PROMPTS))
+        self.assert_upgraded()
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,452 @@
+"""
+Тесты сетевого слоя ChatList на локальном заглушечном сервере из bench_network.
+
+Сеть не нужна: запросы уходят на 127.0.0.1, настройки читаются из временной БД.
+
+Запуск:
+    python -m unittest test_network
+"""
+import asyncio
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+import bench_network
+import db
+import network
+
+
+def _unused_port() -> int:
+    """Порт localhost, на котором никто не слушает (соединение будет отклонено)."""
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class StubServerTestCase(unittest.TestCase):
+    """Временная БД и заглушка API; кэш ответов и запись метрик выключены."""
+
+    server_options = {}
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        db.set_db_path(os.path.join(self.tmpdir, "chatlist.db"))
+        db.init_database()
+        network.configure_response_cache(enabled=False)
+        network.configure_metrics(enabled=False)
+        network.configure_rate_limits(key_rpm=0, key_tpm=0, model_rpm=0, model_tpm=0)
+        self.server = bench_network.StubServer(**self.server_options)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        network.configure_rate_limits(key_rpm=0, key_tpm=0, model_rpm=0, model_tpm=0)
+        network.close_sessions()
+        self.server.shutdown()
+        self.server.server_close()
+        db.set_db_path(None)
+        shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+    def make_model(self, model_id: int, url: str = None) -> dict:
+        return {"id": model_id, "name": f"vendor/model-{model_id}", "api_key": "test",
+                "api_url": url or self.server.url, "model_type": "openrouter"}
+
+
+class RateLimiterTest(StubServerTestCase):
+    """Клиентский ограничитель под квоту сервера: без 429 и без простоя."""
+
+    RPM = 600
+    REQUESTS = 60
+    server_options = {"response_delay": 0.01, "rpm": RPM, "burst_seconds": 2.0}
+
+    def test_fanout_stays_within_quota(self):
+        network.configure_rate_limits(key_rpm=self.RPM)
+        models = [self.make_model(i) for i in range(self.REQUESTS)]
+
+        started = time.perf_counter()
+        results = network.send_prompt_to_multiple_models(models, "ping", timeout=10, max_workers=self.REQUESTS)
+        wall = time.perf_counter() - started
+
+        self.assertTrue(all(result["success"] for result in results))
+        self.assertEqual(self.server.rejected, 0)
+        self.assertEqual(self.server.requests_received, self.REQUESTS)
+        # Всплеск ведра клиента - секунда квоты, остальное идет с темпом квоты
+        rate = self.RPM / 60.0
+        expected = (self.REQUESTS - rate * network._rate_limiter.burst_seconds) / rate
+        self.assertGreater(wall, expected * 0.9)
+        self.assertLess(wall, expected * 1.5 + 1.0)
+
+
+class CircuitBreakerTest(StubServerTestCase):
+    """Предохранитель модели: closed -> open -> half_open -> closed."""
+
+    OPEN_SECONDS = 0.3
+
+    def setUp(self):
+        super().setUp()
+        breaker = network.CircuitBreaker()
+        breaker.OPEN_SECONDS = self.OPEN_SECONDS
+        patcher = mock.patch.object(network, "_circuit_breaker", breaker)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.breaker = breaker
+        network.configure_circuit_breaker(enabled=True)
+        for name, value in (("base_delay", 0.01), ("max_delay", 0.05)):
+            patcher = mock.patch.object(network._retry_policy, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def state(self, model_id: int) -> str:
+        return network.get_circuit_states()[model_id]["state"]
+
+    def test_open_half_open_closed(self):
+        model = self.make_model(1, f"http://127.0.0.1:{_unused_port()}/api/v1/chat/completions")
+
+        # Три неудачные попытки подряд (запрос и два повтора) размыкают предохранитель
+        with self.assertRaises(network.APIError) as raised:
+            network.send_prompt_to_model(model, "ping", max_retries=2, use_cache=False)
+        self.assertNotIsInstance(raised.exception, network.CircuitOpenError)
+        self.assertEqual(self.state(1), network.CircuitBreaker.OPEN)
+
+        # Разомкнутый предохранитель отвечает сразу, без попыток соединения
+        started = time.perf_counter()
+        with self.assertRaises(network.CircuitOpenError):
+            network.send_prompt_to_model(model, "ping", use_cache=False)
+        self.assertLess(time.perf_counter() - started, 0.2)
+
+        time.sleep(self.OPEN_SECONDS)
+        self.assertEqual(self.state(1), network.CircuitBreaker.HALF_OPEN)
+
+        # Проверка, упавшая не с APIError, снимается без исхода: следующая попытка - снова проверка
+        with mock.patch.object(network, "_async_attempt", side_effect=KeyError("choices")):
+            with self.assertRaises(KeyError):
+                network.send_prompt_to_model(model, "ping", use_cache=False)
+        self.assertFalse(self.breaker._circuits[1]["probing"])
+        self.assertEqual(self.state(1), network.CircuitBreaker.HALF_OPEN)
+
+        # Успешная проверка замыкает предохранитель
+        model["api_url"] = self.server.url
+        result = network.send_prompt_to_model(model, "ping", use_cache=False)
+        self.assertTrue(result["response"])
+        self.assertEqual(self.state(1), network.CircuitBreaker.CLOSED)
+        self.assertEqual(self.server.requests_received, 1)
+
+    def test_failed_probe_doubles_open_time(self):
+        model = self.make_model(2)
+        outage = network.APIError("HTTP 503", status=503, retryable=True)
+        for _ in range(network.CircuitBreaker.FAILURE_THRESHOLD):
+            self.breaker.record(model, self.breaker.acquire(model), outage)
+        self.assertEqual(self.state(2), network.CircuitBreaker.OPEN)
+
+        time.sleep(self.OPEN_SECONDS)
+        probe = self.breaker.acquire(model)
+        self.assertTrue(probe)
+        # Пока идет проверка, остальные запросы отклоняются
+        with self.assertRaises(network.CircuitOpenError):
+            self.breaker.acquire(model)
+        self.breaker.record(model, probe, outage)
+        self.assertEqual(self.state(2), network.CircuitBreaker.OPEN)
+        self.assertEqual(self.breaker._circuits[2]["open_seconds"], self.OPEN_SECONDS * 2)
+
+    def test_error_rate_trips_breaker(self):
+        model = self.make_model(3)
+        outage = network.APIError("HTTP 502", status=502, retryable=True)
+        # Неудачи не подряд: размыкает доля неудач в окне, а не их серия
+        for index in range(network.CircuitBreaker.MIN_CALLS):
+            error = outage if index % 2 else None
+            self.breaker.record(model, self.breaker.acquire(model), error)
+        self.assertEqual(self.state(3), network.CircuitBreaker.OPEN)
+
+    def test_quota_errors_are_not_outages(self):
+        model = self.make_model(4)
+        quota = network.APIError("HTTP 429", status=429, retryable=True)
+        for _ in range(network.CircuitBreaker.WINDOW):
+            self.breaker.record(model, self.breaker.acquire(model), quota)
+        self.assertNotIn(4, network.get_circuit_states())
+
+
+class CancellationTest(StubServerTestCase):
+    """Прерванная рассылка: после возврата управления запросы к серверу больше не уходят."""
+
+    MODELS = 40
+    server_options = {"response_delay": 0.05}
+
+    def iterate(self, **kwargs):
+        models = [self.make_model(i) for i in range(self.MODELS)]
+        return network.iter_prompt_to_multiple_models(models, "ping", timeout=10, max_workers=4,
+                                                      use_cache=False, **kwargs)
+
+    def assert_no_more_requests(self):
+        received = self.server.requests_received
+        self.assertLess(received, self.MODELS)
+        time.sleep(0.3)
+        self.assertEqual(self.server.requests_received, received)
+
+        async def engine_tasks():
+            return len(asyncio.all_tasks()) - 1
+        # Отмененные запросы завершены и не держат места в лимитах
+        self.assertEqual(network._engine.submit(engine_tasks()).result(), 0)
+
+    def test_closing_iterator_stops_requests(self):
+        results = self.iterate()
+        for count, result in enumerate(results, 1):
+            self.assertTrue(result["success"])
+            if count == 4:
+                break
+        results.close()
+        self.assert_no_more_requests()
+
+    def test_cancel_token_stops_requests(self):
+        cancel_token = network.CancelToken()
+        results = []
+        for result in self.iterate(cancel_token=cancel_token):
+            results.append(result)
+            if len(results) == 4:
+                cancel_token.cancel()
+        self.assertEqual(len(results), self.MODELS)
+        self.assertTrue(any(result.get("cancelled") for result in results))
+        self.assert_no_more_requests()
+
+
+class MalformedResponseTest(StubServerTestCase):
+    """Битое тело успешного ответа: без повторов и без сигналов перегрузки."""
+
+    def setUp(self):
+        super().setUp()
+        send_json = bench_network.StubHandler._send_json
+
+        def send_malformed(handler, status, data, headers=None):
+            if status != 200:
+                return send_json(handler, status, data, headers)
+            body = b'{"choices": ['
+            handler.send_response(status)
+            handler.send_header("Content-Type", "application/json")
+            handler.send_header("Content-Length", str(len(body)))
+            handler.end_headers()
+            handler.wfile.write(body)
+        patcher = mock.patch.object(bench_network.StubHandler, "_send_json", send_malformed)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        breaker = network.CircuitBreaker(enabled=True)
+        breaker._loaded = True
+        limiter = network.AdaptiveConcurrency(enabled=True, initial_limit=8)
+        limiter._loaded = True
+        for name, value in (("_circuit_breaker", breaker), ("_adaptive_concurrency", limiter)):
+            patcher = mock.patch.object(network, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def test_malformed_json_is_not_retried(self):
+        results = network.send_prompt_to_multiple_models([self.make_model(1)], "ping", use_cache=False)
+
+        self.assertFalse(results[0]["success"])
+        self.assertIn("Некорректный JSON", results[0]["error"])
+        self.assertEqual(self.server.requests_received, 1)
+        self.assertNotIn(1, network.get_circuit_states())
+        state, = network.get_concurrency_state()
+        self.assertEqual((state["limit"], state["cuts"]), (8, 0))
+
+    def test_malformed_json_error(self):
+        with self.assertRaises(network.APIError) as raised:
+            network.send_prompt_to_model(self.make_model(2), "ping", max_retries=2, use_cache=False)
+        self.assertFalse(raised.exception.retryable)
+        self.assertEqual(raised.exception.status, 200)
+        self.assertEqual(self.server.requests_received, 1)
+
+
+class ResponseCacheTest(StubServerTestCase):
+    """Кэш ответов: ключ запроса, срок жизни, вытеснение и переключатель в настройках."""
+
+    def setUp(self):
+        super().setUp()
+        self.cache = network.ResponseCache(enabled=True, ttl=60.0)
+        self.cache._loaded = True
+        patcher = mock.patch.object(network, "_response_cache", self.cache)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.model = self.make_model(1)
+
+    def key(self, prompt: str = "ping", model: dict = None, temperature: float = None) -> str:
+        return network.ResponseCache.make_key(model or self.model, [{"role": "user", "content": prompt}], temperature)
+
+    def put(self, key: str, response: str = "pong") -> None:
+        self.cache.put(key, self.model, {"response": response, "tokens_used": 5, "response_time": 0.5})
+
+    def test_key_covers_model_messages_and_params(self):
+        self.assertEqual(self.key(), self.key())
+        other_model = dict(self.model, name="vendor/other-model")
+        other_url = dict(self.model, api_url="http://127.0.0.1:1/api/v1/chat/completions")
+        keys = {self.key(), self.key("pong"), self.key(model=other_model), self.key(model=other_url),
+                self.key(temperature=0.0)}
+        self.assertEqual(len(keys), 5)
+
+    def test_ttl_expiry(self):
+        key = self.key()
+        self.put(key)
+        self.assertEqual(self.cache.get(key)["response"], "pong")
+        with mock.patch.object(network.time, "time", return_value=time.time() + self.cache.ttl + 1):
+            self.assertIsNone(self.cache.get(key))
+        # Устаревшая запись удаляется при промахе
+        self.assertIsNone(db.get_cached_response(key))
+
+    def test_least_recently_used_entry_is_evicted(self):
+        self.cache.TOUCH_INTERVAL = 0.0
+        self.cache.max_bytes = 2500
+        first, second, third = (self.key(f"prompt {i}") for i in range(3))
+        self.put(first, "a" * 1000)
+        self.put(second, "b" * 1000)
+        time.sleep(0.01)
+        self.assertIsNotNone(self.cache.get(first))
+        self.put(third, "c" * 1000)
+
+        self.assertIsNotNone(db.get_cached_response(first))
+        self.assertIsNone(db.get_cached_response(second))
+        self.assertIsNotNone(db.get_cached_response(third))
+        self.assertLessEqual(db.get_response_cache_size(), self.cache.max_bytes)
+
+    def test_setting_toggles_cache(self):
+        db.set_setting("response_cache_enabled", "1")
+        network.configure_response_cache()
+        first = network.send_prompt_to_model(self.model, "ping")
+        second = network.send_prompt_to_model(self.model, "ping")
+        self.assertNotIn("cached", first)
+        self.assertTrue(second.get("cached"))
+        self.assertEqual(second["response"], first["response"])
+        self.assertEqual(self.server.requests_received, 1)
+
+        db.set_setting("response_cache_enabled", "0")
+        network.configure_response_cache()
+        self.assertNotIn("cached", network.send_prompt_to_model(self.model, "ping"))
+        self.assertEqual(self.server.requests_received, 2)
+
+
+class SingleFlightTest(StubServerTestCase):
+    """Одинаковые одновременные запросы уходят в API один раз."""
+
+    server_options = {"response_delay": 0.2}
+    WAITERS = 5
+
+    def setUp(self):
+        super().setUp()
+        breaker = network.CircuitBreaker(enabled=False)
+        breaker._loaded = True
+        for name, value in (("_circuit_breaker", breaker), ("_single_flight", network.SingleFlight())):
+            patcher = mock.patch.object(network, name, value)
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.model = self.make_model(1)
+
+    def send_concurrently(self) -> list:
+        jobs = [(self.model, "ping")] * self.WAITERS
+        return [result for _, result in sorted(network.iter_prompt_jobs(jobs, use_cache=False))]
+
+    def test_identical_requests_share_one_call(self):
+        results = self.send_concurrently()
+
+        self.assertEqual(self.server.requests_received, 1)
+        self.assertTrue(all(result["success"] for result in results))
+        self.assertEqual(len({result["response"] for result in results}), 1)
+        self.assertEqual(network._single_flight.in_flight(), 0)
+
+    def test_failure_reaches_all_waiters_and_is_not_kept(self):
+        send_json = bench_network.StubHandler._send_json
+
+        def send_error(handler, status, data, headers=None):
+            send_json(handler, 400, {"error": {"message": "Bad request"}})
+        with mock.patch.object(bench_network.StubHandler, "_send_json", send_error):
+            results = self.send_concurrently()
+
+        self.assertEqual(self.server.requests_received, 1)
+        self.assertFalse(any(result["success"] for result in results))
+        self.assertEqual(len({result["error"] for result in results}), 1)
+        self.assertEqual(network._single_flight.in_flight(), 0)
+        # Ошибка не запоминается: следующий такой же запрос снова уходит в API
+        result = network.send_prompt_to_model(self.model, "ping", use_cache=False)
+        self.assertNotIn("shared", result)
+        self.assertEqual(self.server.requests_received, 2)
+
+
+class AdaptiveConcurrencyTest(unittest.TestCase):
+    """Подбор лимита хоста по синтетическим задержкам и перегрузкам."""
+
+    def setUp(self):
+        self.limiter = network.AdaptiveConcurrency(enabled=True, initial_limit=8, min_limit=2, max_limit=24)
+        self.limiter._loaded = True
+        self.host = network._HostConcurrency(float(self.limiter.initial_limit))
+
+    def window(self, rtt: float, in_flight: int = None) -> float:
+        """Закрывает окно с одной задержкой rtt и возвращает новый лимит."""
+        self.host.window_start -= 10.0
+        self.limiter._on_success(self.host, rtt, self.host.limit if in_flight is None else in_flight)
+        return self.host.limit
+
+    def overload(self) -> float:
+        """Сообщает о перегрузке после паузы, большей текущего среднего времени ответа."""
+        self.host.last_cut -= 10.0
+        self.limiter._on_overload(self.host)
+        return self.host.limit
+
+    def test_limit_grows_while_latency_is_stable(self):
+        limits = [self.window(0.1) for _ in range(5)]
+        self.assertEqual(limits, sorted(limits))
+        self.assertGreater(limits[0], 8)
+        # Рост без перегрузок упирается в max_limit
+        for _ in range(100):
+            self.window(0.1)
+        self.assertEqual(self.host.limit, 24)
+
+    def test_limit_kept_when_window_is_underused(self):
+        self.window(0.1)
+        limit = self.host.limit
+        for _ in range(5):
+            self.assertEqual(self.window(0.1, in_flight=1), limit)
+
+    def test_success_inside_window_does_not_change_limit(self):
+        self.window(0.1)
+        limit = self.host.limit
+        self.host.window_start = network.time.monotonic()
+        self.limiter._on_success(self.host, 0.1, int(limit))
+        self.assertEqual(self.host.limit, limit)
+        self.assertEqual(self.host.window_count, 1)
+
+    def test_latency_growth_decreases_limit(self):
+        for _ in range(10):
+            self.window(0.1)
+        grown = self.host.limit
+        # Задержка выросла вдесятеро: градиент 0.5, лимит снижается окно за окном
+        limits = [self.window(1.0) for _ in range(5)]
+        self.assertLess(limits[0], grown)
+        self.assertEqual(limits, sorted(limits, reverse=True))
+        self.assertGreater(limits[0], grown * 0.5)
+        # Умеренный рост задержки в пределах RTT_TOLERANCE лимит не снижает
+        self.host = network._HostConcurrency(8.0)
+        for _ in range(10):
+            self.window(0.1)
+        limit = self.host.limit
+        self.assertGreaterEqual(self.window(0.14), limit)
+
+    def test_overload_cuts_limit_multiplicatively(self):
+        for _ in range(5):
+            self.window(0.1)
+        limit = self.host.limit
+        self.assertAlmostEqual(self.overload(), limit * self.limiter.BACKOFF)
+        # Одновременные отказы в пределах одного времени ответа - одна перегрузка
+        self.limiter._on_overload(self.host)
+        self.assertAlmostEqual(self.host.limit, limit * self.limiter.BACKOFF)
+        self.assertEqual(self.host.cuts, 1)
+
+    def test_overload_clamps_to_min_limit(self):
+        for _ in range(20):
+            self.overload()
+        self.assertEqual(self.host.limit, 2)
+        self.assertEqual(self.host.cuts, 20)
+        # После перегрузок лимит снова растет от нижней границы
+        self.assertGreater(self.window(0.1), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
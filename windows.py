@@ -3,29 +3,43 @@
 Содержит окна для управления промтами, моделями, результатами и настройками.
 """
 import sys
-from typing import Optional
+from datetime import datetime, timedelta
+from typing import List, Dict, Optional
 import db
 import models
+import network
 import prompt_improver
 
 try:
     from PyQt6.QtWidgets import (
         QDialog, QVBoxLayout, QHBoxLayout, QTableWidget, QTableWidgetItem,
         QPushButton, QLabel, QLineEdit, QTextEdit, QCheckBox, QComboBox,
-        QMessageBox, QHeaderView, QGroupBox, QProgressBar, QTabWidget, QWidget
+        QMessageBox, QHeaderView, QGroupBox, QProgressBar, QTabWidget, QWidget,
+        QTableView, QAbstractItemView
     )
-    from PyQt6.QtCore import Qt, QThread, pyqtSignal
+    from PyQt6.QtCore import Qt, QThread, QTimer, pyqtSignal, QAbstractTableModel, QModelIndex
     PYQT_VERSION = 6
 except ImportError:
     from PyQt5.QtWidgets import (
         QDialog, QVBoxLayout, QHBoxLayout, QTableWidget, QTableWidgetItem,
         QPushButton, QLabel, QLineEdit, QTextEdit, QCheckBox, QComboBox,
-        QMessageBox, QHeaderView, QGroupBox, QProgressBar, QTabWidget, QWidget
+        QMessageBox, QHeaderView, QGroupBox, QProgressBar, QTabWidget, QWidget,
+        QTableView, QAbstractItemView
     )
-    from PyQt5.QtCore import Qt, QThread, pyqtSignal
+    from PyQt5.QtCore import Qt, QThread, QTimer, pyqtSignal, QAbstractTableModel, QModelIndex
     PYQT_VERSION = 5
 
 
+# Задержка поиска после последнего нажатия клавиши, мс
+SEARCH_DELAY_MS = 250
+# Максимум строк, которые показывает поиск по результатам
+SEARCH_RESULTS_LIMIT = 500
+# Размер страницы при прокрутке истории результатов
+RESULTS_PAGE_SIZE = 200
+# Периоды статистики моделей: (подпись, число дней; None - за все время)
+STATISTICS_WINDOWS = [("24 часа", 1), ("7 дней", 7), ("30 дней", 30), ("Все время", None)]
+
+
 class ManagePromptsWindow(QDialog):
     """Окно для управления промтами."""
     
@@ -45,17 +59,23 @@ class ManagePromptsWindow(QDialog):
         search_layout.addWidget(QLabel("Поиск:"))
         self.search_input = QLineEdit()
         self.search_input.setPlaceholderText("Введите текст для поиска...")
-        self.search_input.textChanged.connect(self.filter_prompts)
+        self.search_input.textChanged.connect(self.search_timer_restart)
         search_layout.addWidget(self.search_input)
         
         search_layout.addWidget(QLabel("Теги:"))
         self.tags_filter = QLineEdit()
         self.tags_filter.setPlaceholderText("Фильтр по тегам...")
-        self.tags_filter.textChanged.connect(self.filter_prompts)
+        self.tags_filter.textChanged.connect(self.search_timer_restart)
         search_layout.addWidget(self.tags_filter)
         
         layout.addLayout(search_layout)
         
+        # Поиск выполняется в БД после паузы во вводе, а не на каждое нажатие
+        self.search_timer = QTimer(self)
+        self.search_timer.setSingleShot(True)
+        self.search_timer.setInterval(SEARCH_DELAY_MS)
+        self.search_timer.timeout.connect(self.filter_prompts)
+        
         # Таблица промтов
         self.table = QTableWidget()
         self.table.setColumnCount(4)
@@ -84,65 +104,57 @@ class ManagePromptsWindow(QDialog):
         layout.addLayout(buttons_layout)
     
     def load_prompts(self):
-        """Загружает промты в таблицу."""
+        """Загружает промты в таблицу с учетом текущего поиска."""
         try:
-            prompts = db.get_all_prompts()
-            self.table.setRowCount(len(prompts))
-            
-            for row, prompt in enumerate(prompts):
-                # Дата
-                date_item = QTableWidgetItem(prompt['date'])
-                if PYQT_VERSION == 6:
-                    date_item.setFlags(date_item.flags() & ~Qt.ItemFlag.ItemIsEditable)
-                else:
-                    date_item.setFlags(date_item.flags() & ~Qt.ItemIsEditable)
-                self.table.setItem(row, 0, date_item)
-                
-                # Промт
-                prompt_text = prompt['prompt'][:100] + "..." if len(prompt['prompt']) > 100 else prompt['prompt']
-                prompt_item = QTableWidgetItem(prompt_text)
-                prompt_item.setData(Qt.ItemDataRole.UserRole, prompt['id'])
-                if PYQT_VERSION == 6:
-                    prompt_item.setFlags(prompt_item.flags() & ~Qt.ItemFlag.ItemIsEditable)
-                else:
-                    prompt_item.setFlags(prompt_item.flags() & ~Qt.ItemIsEditable)
-                self.table.setItem(row, 1, prompt_item)
-                
-                # Теги
-                tags_item = QTableWidgetItem(prompt.get('tags', '') or '')
-                if PYQT_VERSION == 6:
-                    tags_item.setFlags(tags_item.flags() & ~Qt.ItemFlag.ItemIsEditable)
-                else:
-                    tags_item.setFlags(tags_item.flags() & ~Qt.ItemIsEditable)
-                self.table.setItem(row, 2, tags_item)
-                
-                # Кнопка редактирования
-                edit_btn = QPushButton("Редактировать")
-                edit_btn.clicked.connect(lambda checked, p=prompt: self.edit_prompt(p))
-                self.table.setCellWidget(row, 3, edit_btn)
+            prompts = db.search_prompts(self.search_input.text(), self.tags_filter.text())
+            self.fill_table(prompts)
         except Exception as e:
             QMessageBox.critical(self, "Ошибка", f"Не удалось загрузить промты: {str(e)}")
     
-    def filter_prompts(self):
-        """Фильтрует промты по поисковому запросу и тегам."""
-        search_text = self.search_input.text().lower()
-        tags_text = self.tags_filter.text().lower()
-        
-        for row in range(self.table.rowCount()):
-            prompt_item = self.table.item(row, 1)
-            tags_item = self.table.item(row, 2)
+    def fill_table(self, prompts: List[Dict]):
+        """Заполняет таблицу промтами."""
+        self.table.setRowCount(len(prompts))
+        for row, prompt in enumerate(prompts):
+            # Дата
+            date_item = QTableWidgetItem(prompt['date'])
+            if PYQT_VERSION == 6:
+                date_item.setFlags(date_item.flags() & ~Qt.ItemFlag.ItemIsEditable)
+            else:
+                date_item.setFlags(date_item.flags() & ~Qt.ItemIsEditable)
+            self.table.setItem(row, 0, date_item)
             
-            if prompt_item and tags_item:
-                prompt_text = prompt_item.text().lower()
-                tags = tags_item.text().lower()
-                
-                show = True
-                if search_text and search_text not in prompt_text:
-                    show = False
-                if tags_text and tags_text not in tags:
-                    show = False
-                
-                self.table.setRowHidden(row, not show)
+            # Промт (при поиске - фрагмент с выделенными совпадениями)
+            prompt_text = prompt['prompt'][:100] + "..." if len(prompt['prompt']) > 100 else prompt['prompt']
+            if prompt.get('snippet'):
+                prompt_text = prompt['snippet']
+            prompt_item = QTableWidgetItem(prompt_text)
+            prompt_item.setData(Qt.ItemDataRole.UserRole, prompt['id'])
+            if PYQT_VERSION == 6:
+                prompt_item.setFlags(prompt_item.flags() & ~Qt.ItemFlag.ItemIsEditable)
+            else:
+                prompt_item.setFlags(prompt_item.flags() & ~Qt.ItemIsEditable)
+            self.table.setItem(row, 1, prompt_item)
+            
+            # Теги
+            tags_item = QTableWidgetItem(prompt.get('tags', '') or '')
+            if PYQT_VERSION == 6:
+                tags_item.setFlags(tags_item.flags() & ~Qt.ItemFlag.ItemIsEditable)
+            else:
+                tags_item.setFlags(tags_item.flags() & ~Qt.ItemIsEditable)
+            self.table.setItem(row, 2, tags_item)
+            
+            # Кнопка редактирования
+            edit_btn = QPushButton("Редактировать")
+            edit_btn.clicked.connect(lambda checked, p=prompt: self.edit_prompt(p))
+            self.table.setCellWidget(row, 3, edit_btn)
+    
+    def search_timer_restart(self):
+        """Откладывает поиск до паузы во вводе."""
+        self.search_timer.start()
+    
+    def filter_prompts(self):
+        """Фильтрует промты по поисковому запросу и тегам (полнотекстовый поиск в БД)."""
+        self.load_prompts()
     
     def edit_prompt(self, prompt):
         """Редактирует промт."""
@@ -446,6 +458,15 @@ class EditModelDialog(QDialog):
             self.active_checkbox.setChecked(True)
         layout.addWidget(self.active_checkbox)
         
+        self.hedge_checkbox = QCheckBox("Дублировать медленные запросы")
+        self.hedge_checkbox.setToolTip(
+            "Если модель не ответила за обычное для нее время (90-й перцентиль по сохраненным результатам), "
+            "отправляется повторный запрос и берется первый ответ"
+        )
+        if self.model:
+            self.hedge_checkbox.setChecked(bool(self.model.get('hedge', 0)))
+        layout.addWidget(self.hedge_checkbox)
+        
         buttons_layout = QHBoxLayout()
         buttons_layout.addStretch()
         save_btn = QPushButton("Сохранить")
@@ -478,6 +499,7 @@ class EditModelDialog(QDialog):
         api_id = self.api_id_input.text().strip()
         model_type = self.type_combo.currentText()
         is_active = 1 if self.active_checkbox.isChecked() else 0
+        hedge = 1 if self.hedge_checkbox.isChecked() else 0
         
         if not name or not api_url or not api_id:
             QMessageBox.warning(self, "Предупреждение", "Заполните все обязательные поля")
@@ -491,17 +513,109 @@ class EditModelDialog(QDialog):
                     api_url=api_url,
                     api_id=api_id,
                     model_type=model_type,
-                    is_active=is_active
+                    is_active=is_active,
+                    hedge=hedge
                 )
             else:
                 models.ModelManager.create_model(
-                    name, api_url, api_id, model_type, is_active
+                    name, api_url, api_id, model_type, is_active, hedge
                 )
             self.accept()
         except Exception as e:
             QMessageBox.critical(self, "Ошибка", f"Не удалось сохранить модель: {str(e)}")
 
 
+class ResultsTableModel(QAbstractTableModel):
+    """
+    Модель истории результатов с подгрузкой страниц при прокрутке.
+    
+    Хранит только превью строк. В режиме обзора строки подгружаются
+    страницами через db.get_results_page (canFetchMore/fetchMore), в режиме
+    поиска модель показывает ранжированный ответ db.search целиком.
+    """
+    
+    HEADERS = ["Дата", "Промт", "Модель", "Ответ"]
+    
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.rows: List[Dict] = []
+        self.next_key = None
+        self.has_more = False
+        self.filters: Dict = {}
+    
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.rows)
+    
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.HEADERS)
+    
+    def headerData(self, section, orientation, role=Qt.ItemDataRole.DisplayRole):
+        if role == Qt.ItemDataRole.DisplayRole and orientation == Qt.Orientation.Horizontal:
+            return self.HEADERS[section]
+        return None
+    
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if not index.isValid():
+            return None
+        result = self.rows[index.row()]
+        column = index.column()
+        if role == Qt.ItemDataRole.DisplayRole:
+            if column == 0:
+                return result['saved_at']
+            if column == 1:
+                prompt_text = result.get('prompt_text') or ''
+                return prompt_text[:50] + "..." if len(prompt_text) > 50 else prompt_text
+            if column == 2:
+                return result.get('model_name', '')
+            if column == 3:
+                # При поиске - фрагмент с выделенными совпадениями
+                if result.get('snippet'):
+                    return result['snippet']
+                response_text = result.get('response_preview') or ''
+                return response_text[:100] + "..." if len(response_text) > 100 else response_text
+        elif role == Qt.ItemDataRole.UserRole:
+            return result['id']
+        return None
+    
+    def reset_browse(self, filters: Optional[Dict] = None):
+        """Переходит в режим обзора истории и загружает первую страницу."""
+        self.beginResetModel()
+        self.rows = []
+        self.next_key = None
+        self.has_more = True
+        self.filters = filters or {}
+        self.endResetModel()
+        self.fetchMore(QModelIndex())
+    
+    def set_search_results(self, results: List[Dict]):
+        """Показывает результаты поиска (без подгрузки страниц)."""
+        self.beginResetModel()
+        self.rows = results
+        self.next_key = None
+        self.has_more = False
+        self.endResetModel()
+    
+    def canFetchMore(self, parent=QModelIndex()):
+        return not parent.isValid() and self.has_more
+    
+    def fetchMore(self, parent=QModelIndex()):
+        if parent.isValid() or not self.has_more:
+            return
+        page = db.get_results_page(self.next_key, RESULTS_PAGE_SIZE, self.filters)
+        self.has_more = len(page) == RESULTS_PAGE_SIZE
+        if not page:
+            return
+        self.next_key = (page[-1]['saved_at'], page[-1]['id'])
+        first = len(self.rows)
+        self.beginInsertRows(QModelIndex(), first, first + len(page) - 1)
+        self.rows.extend(page)
+        self.endInsertRows()
+    
+    def result_at(self, row: int) -> Dict:
+        """Возвращает строку модели по номеру."""
+        return self.rows[row]
+
+
 class ViewResultsWindow(QDialog):
     """Окно для просмотра сохраненных результатов."""
     
@@ -521,30 +635,40 @@ class ViewResultsWindow(QDialog):
         filters_layout.addWidget(QLabel("Поиск:"))
         self.search_input = QLineEdit()
         self.search_input.setPlaceholderText("Поиск по тексту...")
-        self.search_input.textChanged.connect(self.filter_results)
+        self.search_input.textChanged.connect(self.search_timer_restart)
         filters_layout.addWidget(self.search_input)
         layout.addLayout(filters_layout)
         
-        # Таблица результатов
-        self.table = QTableWidget()
-        self.table.setColumnCount(5)
-        self.table.setHorizontalHeaderLabels(["Дата", "Промт", "Модель", "Ответ", "Действия"])
+        # Поиск выполняется в БД после паузы во вводе
+        self.search_timer = QTimer(self)
+        self.search_timer.setSingleShot(True)
+        self.search_timer.setInterval(SEARCH_DELAY_MS)
+        self.search_timer.timeout.connect(self.filter_results)
+        
+        # Таблица результатов: данные подгружаются страницами при прокрутке
+        self.model = ResultsTableModel(self)
+        self.table = QTableView()
+        self.table.setModel(self.model)
+        self.table.doubleClicked.connect(self.view_current)
         if PYQT_VERSION == 6:
+            self.table.setSelectionBehavior(QAbstractItemView.SelectionBehavior.SelectRows)
             self.table.horizontalHeader().setSectionResizeMode(0, QHeaderView.ResizeMode.ResizeToContents)
             self.table.horizontalHeader().setSectionResizeMode(1, QHeaderView.ResizeMode.Stretch)
             self.table.horizontalHeader().setSectionResizeMode(2, QHeaderView.ResizeMode.ResizeToContents)
             self.table.horizontalHeader().setSectionResizeMode(3, QHeaderView.ResizeMode.Stretch)
-            self.table.horizontalHeader().setSectionResizeMode(4, QHeaderView.ResizeMode.ResizeToContents)
         else:
+            self.table.setSelectionBehavior(QAbstractItemView.SelectRows)
             self.table.horizontalHeader().setSectionResizeMode(0, QHeaderView.ResizeToContents)
             self.table.horizontalHeader().setSectionResizeMode(1, QHeaderView.Stretch)
             self.table.horizontalHeader().setSectionResizeMode(2, QHeaderView.ResizeToContents)
             self.table.horizontalHeader().setSectionResizeMode(3, QHeaderView.Stretch)
-            self.table.horizontalHeader().setSectionResizeMode(4, QHeaderView.ResizeToContents)
         layout.addWidget(self.table)
         
         # Кнопки
         buttons_layout = QHBoxLayout()
+        view_btn = QPushButton("Просмотр")
+        view_btn.clicked.connect(self.view_current)
+        buttons_layout.addWidget(view_btn)
         delete_btn = QPushButton("Удалить выбранные")
         delete_btn.clicked.connect(self.delete_selected)
         buttons_layout.addWidget(delete_btn)
@@ -555,71 +679,37 @@ class ViewResultsWindow(QDialog):
         layout.addLayout(buttons_layout)
     
     def load_results(self):
-        """Загружает результаты в таблицу."""
+        """Загружает результаты с учетом текущего поиска."""
         try:
-            results = db.get_all_results()
-            self.table.setRowCount(len(results))
-            
-            for row, result in enumerate(results):
-                # Дата
-                date_item = QTableWidgetItem(result['saved_at'])
-                if PYQT_VERSION == 6:
-                    date_item.setFlags(date_item.flags() & ~Qt.ItemFlag.ItemIsEditable)
-                else:
-                    date_item.setFlags(date_item.flags() & ~Qt.ItemIsEditable)
-                self.table.setItem(row, 0, date_item)
-                
-                # Промт
-                prompt_text = result.get('prompt_text', '')[:50] + "..." if len(result.get('prompt_text', '')) > 50 else result.get('prompt_text', '')
-                prompt_item = QTableWidgetItem(prompt_text)
-                prompt_item.setData(Qt.ItemDataRole.UserRole, result['id'])
-                if PYQT_VERSION == 6:
-                    prompt_item.setFlags(prompt_item.flags() & ~Qt.ItemFlag.ItemIsEditable)
-                else:
-                    prompt_item.setFlags(prompt_item.flags() & ~Qt.ItemIsEditable)
-                self.table.setItem(row, 1, prompt_item)
-                
-                # Модель
-                model_item = QTableWidgetItem(result.get('model_name', ''))
-                if PYQT_VERSION == 6:
-                    model_item.setFlags(model_item.flags() & ~Qt.ItemFlag.ItemIsEditable)
-                else:
-                    model_item.setFlags(model_item.flags() & ~Qt.ItemIsEditable)
-                self.table.setItem(row, 2, model_item)
-                
-                # Ответ
-                response_text = result['response'][:100] + "..." if len(result['response']) > 100 else result['response']
-                response_item = QTableWidgetItem(response_text)
-                if PYQT_VERSION == 6:
-                    response_item.setFlags(response_item.flags() & ~Qt.ItemFlag.ItemIsEditable)
-                else:
-                    response_item.setFlags(response_item.flags() & ~Qt.ItemIsEditable)
-                self.table.setItem(row, 3, response_item)
-                
-                # Кнопка просмотра
-                view_btn = QPushButton("Просмотр")
-                view_btn.clicked.connect(lambda checked, r=result: self.view_result(r))
-                self.table.setCellWidget(row, 4, view_btn)
+            search_text = self.search_input.text().strip()
+            if search_text:
+                self.model.set_search_results(
+                    db.search(search_text, scope="results", limit=SEARCH_RESULTS_LIMIT)
+                )
+            else:
+                self.model.reset_browse()
         except Exception as e:
             QMessageBox.critical(self, "Ошибка", f"Не удалось загрузить результаты: {str(e)}")
     
+    def search_timer_restart(self):
+        """Откладывает поиск до паузы во вводе."""
+        self.search_timer.start()
+    
     def filter_results(self):
-        """Фильтрует результаты по поисковому запросу."""
-        search_text = self.search_input.text().lower()
-        
-        for row in range(self.table.rowCount()):
-            prompt_item = self.table.item(row, 1)
-            response_item = self.table.item(row, 3)
-            
-            if prompt_item and response_item:
-                prompt_text = prompt_item.text().lower()
-                response_text = response_item.text().lower()
-                
-                show = search_text in prompt_text or search_text in response_text
-                self.table.setRowHidden(row, not show)
+        """Фильтрует результаты по поисковому запросу (полнотекстовый поиск в БД)."""
+        self.load_results()
+    
+    def view_current(self):
+        """Показывает результат в текущей строке таблицы."""
+        index = self.table.currentIndex()
+        if index.isValid():
+            self.view_result(self.model.result_at(index.row()))
     
     def view_result(self, result):
         """Показывает полный результат."""
+        if 'response' not in result:
+            # В таблице хранятся только превью, полный текст читаем из БД
+            result = db.get_result_details(result['id']) or result
         text = f"Дата: {result['saved_at']}\n"
         text += f"Промт: {result.get('prompt_text', '')}\n"
         text += f"Модель: {result.get('model_name', '')}\n"
@@ -629,9 +719,7 @@ class ViewResultsWindow(QDialog):
     
     def delete_selected(self):
         """Удаляет выбранные результаты."""
-        selected_rows = set()
-        for item in self.table.selectedItems():
-            selected_rows.add(item.row())
+        selected_rows = {index.row() for index in self.table.selectionModel().selectedRows()}
         
         if not selected_rows:
             QMessageBox.warning(self, "Предупреждение", "Выберите результаты для удаления")
@@ -643,16 +731,189 @@ class ViewResultsWindow(QDialog):
         
         if reply == QMessageBox.StandardButton.Yes:
             for row in selected_rows:
-                prompt_item = self.table.item(row, 1)
-                if prompt_item:
-                    result_id = prompt_item.data(Qt.ItemDataRole.UserRole)
-                    try:
-                        db.delete_result(result_id)
-                    except Exception as e:
-                        QMessageBox.critical(self, "Ошибка", f"Не удалось удалить результат: {str(e)}")
+                result_id = self.model.result_at(row)['id']
+                try:
+                    db.delete_result(result_id)
+                except Exception as e:
+                    QMessageBox.critical(self, "Ошибка", f"Не удалось удалить результат: {str(e)}")
             self.load_results()
 
 
+def _format_stat(value, digits: int = 2, percent: bool = False) -> str:
+    """Форматирует значение статистики для таблицы ("—", если данных нет)."""
+    if value is None:
+        return "—"
+    if percent:
+        return f"{value * 100:.1f}%"
+    return f"{value:.{digits}f}"
+
+
+class StatisticsWindow(QDialog):
+    """Окно статистики моделей: время ответа, скорость генерации, ошибки и их динамика."""
+    
+    COLUMNS = ["Модель", "Ответов", "p50, с", "p95, с", "p99, с", "Среднее, с", "Токенов/с",
+               "Запросов", "Ошибки"]
+    TREND_COLUMNS = ["Период", "Ответов", "p50, с", "p95, с", "Среднее, с", "Токенов/с",
+                     "Запросов", "Ошибки"]
+    
+    def __init__(self, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("Статистика моделей")
+        self.setGeometry(100, 100, 1000, 700)
+        self.model_ids = []  # ID моделей в порядке строк таблицы
+        self.init_ui()
+        self.load_statistics()
+    
+    def init_ui(self):
+        layout = QVBoxLayout()
+        self.setLayout(layout)
+        
+        period_layout = QHBoxLayout()
+        period_layout.addWidget(QLabel("Период:"))
+        self.window_combo = QComboBox()
+        for label, days in STATISTICS_WINDOWS:
+            self.window_combo.addItem(label, days)
+        self.window_combo.setCurrentIndex(1)
+        self.window_combo.currentIndexChanged.connect(self.load_statistics)
+        period_layout.addWidget(self.window_combo)
+        period_layout.addStretch()
+        layout.addLayout(period_layout)
+        
+        # Сводка по моделям
+        self.table = self._create_table(self.COLUMNS)
+        self.table.itemSelectionChanged.connect(self.load_trend)
+        layout.addWidget(self.table)
+        
+        # Динамика выбранной модели
+        trend_group = QGroupBox("Динамика выбранной модели")
+        trend_layout = QVBoxLayout()
+        trend_group.setLayout(trend_layout)
+        trend_period_layout = QHBoxLayout()
+        trend_period_layout.addWidget(QLabel("Группировка:"))
+        self.trend_combo = QComboBox()
+        self.trend_combo.addItem("По дням", 'day')
+        self.trend_combo.addItem("По часам", 'hour')
+        self.trend_combo.currentIndexChanged.connect(self.load_trend)
+        trend_period_layout.addWidget(self.trend_combo)
+        trend_period_layout.addStretch()
+        trend_layout.addLayout(trend_period_layout)
+        self.trend_table = self._create_table(self.TREND_COLUMNS)
+        trend_layout.addWidget(self.trend_table)
+        layout.addWidget(trend_group)
+        
+        hint_label = QLabel("Время ответа и скорость - по сохраненным результатам (без ответов из кэша), "
+                            "запросы и ошибки - по всем отправленным запросам")
+        hint_label.setWordWrap(True)
+        hint_label.setStyleSheet("color: #666; font-size: 10pt;")
+        layout.addWidget(hint_label)
+        
+        buttons_layout = QHBoxLayout()
+        refresh_btn = QPushButton("Обновить")
+        refresh_btn.clicked.connect(self.load_statistics)
+        buttons_layout.addWidget(refresh_btn)
+        buttons_layout.addStretch()
+        close_btn = QPushButton("Закрыть")
+        close_btn.clicked.connect(self.accept)
+        buttons_layout.addWidget(close_btn)
+        layout.addLayout(buttons_layout)
+    
+    @staticmethod
+    def _create_table(columns: List[str]) -> QTableWidget:
+        """Создает таблицу только для чтения с выделением строк."""
+        table = QTableWidget()
+        table.setColumnCount(len(columns))
+        table.setHorizontalHeaderLabels(columns)
+        if PYQT_VERSION == 6:
+            table.setEditTriggers(QAbstractItemView.EditTrigger.NoEditTriggers)
+            table.setSelectionBehavior(QAbstractItemView.SelectionBehavior.SelectRows)
+            table.setSelectionMode(QAbstractItemView.SelectionMode.SingleSelection)
+            table.horizontalHeader().setSectionResizeMode(0, QHeaderView.ResizeMode.Stretch)
+        else:
+            table.setEditTriggers(QAbstractItemView.NoEditTriggers)
+            table.setSelectionBehavior(QAbstractItemView.SelectRows)
+            table.setSelectionMode(QAbstractItemView.SingleSelection)
+            table.horizontalHeader().setSectionResizeMode(0, QHeaderView.Stretch)
+        return table
+    
+    @staticmethod
+    def _fill_row(table: QTableWidget, row: int, values: List[str]) -> None:
+        for column, value in enumerate(values):
+            table.setItem(row, column, QTableWidgetItem(value))
+    
+    def since(self) -> Optional[str]:
+        """Начало выбранного периода в формате БД (None - за все время)."""
+        days = self.window_combo.currentData()
+        if days is None:
+            return None
+        return (datetime.now() - timedelta(days=days)).strftime("%Y-%m-%d %H:%M:%S")
+    
+    def load_statistics(self):
+        """Загружает сводную статистику моделей за выбранный период."""
+        try:
+            since = self.since()
+            stats = db.get_model_latency_stats(since)
+            error_rates = db.get_model_error_rates(since)
+        except Exception as e:
+            QMessageBox.critical(self, "Ошибка", f"Не удалось загрузить статистику: {str(e)}")
+            return
+        
+        # Модели, по которым есть только неудачные запросы, тоже попадают в таблицу
+        rows = [dict(entry) for entry in stats]
+        known = {entry['model_id'] for entry in rows}
+        rows.extend({'model_id': model_id, 'model_name': errors['model_name'], 'count': 0}
+                    for model_id, errors in error_rates.items() if model_id not in known)
+        
+        self.model_ids = [entry['model_id'] for entry in rows]
+        self.table.setRowCount(len(rows))
+        for row, entry in enumerate(rows):
+            errors = error_rates.get(entry['model_id'])
+            self._fill_row(self.table, row, [
+                entry.get('model_name') or f"ID {entry['model_id']}",
+                str(entry['count']),
+                _format_stat(entry.get('p50')),
+                _format_stat(entry.get('p95')),
+                _format_stat(entry.get('p99')),
+                _format_stat(entry.get('avg')),
+                _format_stat(entry.get('tokens_per_sec'), 1),
+                str(errors['requests']) if errors else "—",
+                _format_stat(errors['error_rate'] if errors else None, percent=True),
+            ])
+        self.table.resizeColumnsToContents()
+        if rows:
+            # Сигнал выбора не приходит, если строка уже была выбрана, поэтому динамика обновляется явно
+            self.table.blockSignals(True)
+            self.table.selectRow(0)
+            self.table.blockSignals(False)
+        self.load_trend()
+    
+    def load_trend(self):
+        """Загружает динамику по периодам для выбранной модели."""
+        row = self.table.currentRow()
+        if row < 0 or row >= len(self.model_ids):
+            self.trend_table.setRowCount(0)
+            return
+        try:
+            trend = db.get_model_latency_trend(self.model_ids[row], self.trend_combo.currentData(), self.since())
+        except Exception as e:
+            QMessageBox.critical(self, "Ошибка", f"Не удалось загрузить динамику: {str(e)}")
+            return
+        
+        self.trend_table.setRowCount(len(trend))
+        # Новые периоды сверху
+        for row, entry in enumerate(reversed(trend)):
+            self._fill_row(self.trend_table, row, [
+                entry['period'],
+                str(entry['count']),
+                _format_stat(entry['p50']),
+                _format_stat(entry['p95']),
+                _format_stat(entry['avg']),
+                _format_stat(entry['tokens_per_sec'], 1),
+                str(entry['requests']),
+                _format_stat(entry['error_rate'], percent=True),
+            ])
+        self.trend_table.resizeColumnsToContents()
+
+
 class PromptImprovementThread(QThread):
     """Поток для асинхронного улучшения промта."""
     finished = pyqtSignal(dict)  # Сигнал с результатом улучшения
@@ -997,6 +1258,23 @@ class SettingsWindow(QDialog):
         
         layout.addWidget(appearance_group)
         
+        # Группа "Запросы"
+        requests_group = QGroupBox("Запросы")
+        requests_layout = QVBoxLayout()
+        requests_group.setLayout(requests_layout)
+        
+        cache_layout = QHBoxLayout()
+        self.cache_checkbox = QCheckBox("Кэшировать ответы моделей")
+        self.cache_checkbox.setToolTip("Повторный одинаковый запрос к той же модели берется из кэша без обращения к API")
+        cache_layout.addWidget(self.cache_checkbox)
+        cache_layout.addStretch()
+        clear_cache_btn = QPushButton("Очистить кэш")
+        clear_cache_btn.clicked.connect(self.clear_response_cache)
+        cache_layout.addWidget(clear_cache_btn)
+        requests_layout.addLayout(cache_layout)
+        
+        layout.addWidget(requests_group)
+        
         layout.addStretch()
         
         # Кнопки
@@ -1051,6 +1329,9 @@ class SettingsWindow(QDialog):
                     if self.font_size_combo.itemData(i) == default_font_size:
                         self.font_size_combo.setCurrentIndex(i)
                         break
+            
+            # Загружаем настройку кэша ответов
+            self.cache_checkbox.setChecked(db.get_setting("response_cache_enabled") == "1")
         except Exception as e:
             QMessageBox.warning(self, "Ошибка", f"Не удалось загрузить настройки: {str(e)}")
     
@@ -1075,6 +1356,11 @@ class SettingsWindow(QDialog):
             font_size = self.font_size_combo.currentData()
             db.set_setting("font_size", font_size, "Размер шрифта панелей в пунктах")
             
+            # Сохраняем настройку кэша ответов
+            db.set_setting("response_cache_enabled", "1" if self.cache_checkbox.isChecked() else "0",
+                           "Кэшировать ответы моделей (0/1)")
+            network.configure_response_cache()
+            
             # Применяем настройки к текущему окну
             if self.parent_window:
                 self.parent_window.apply_theme(theme)
@@ -1084,6 +1370,14 @@ class SettingsWindow(QDialog):
         except Exception as e:
             QMessageBox.critical(self, "Ошибка", f"Не удалось применить настройки: {str(e)}")
     
+    def clear_response_cache(self):
+        """Удаляет все сохраненные ответы моделей из кэша."""
+        try:
+            network.clear_response_cache()
+            QMessageBox.information(self, "Успех", "Кэш ответов очищен")
+        except Exception as e:
+            QMessageBox.critical(self, "Ошибка", f"Не удалось очистить кэш: {str(e)}")
+    
     def apply_and_close(self):
         """Применяет настройки и закрывает окно."""
         self.apply_settings()